@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Пакетные консультации: JSONL на входе, JSONL с ответами на выходе
+
+Для массовых прогонов с той же ролью HR-консультанта, что и у бота (ответы
+из опросов, заметки exit-интервью, библиотеки сценариев для обучения):
+
+    python batch_consult.py input.jsonl output.jsonl
+    python batch_consult.py input.jsonl output.jsonl --mode batches
+
+В режиме concurrent записи идут параллельными запросами (не больше
+--concurrency одновременно) с повторами ResilientClaude. В режиме batches
+они отправляются пакетами через Message Batches API: это вдвое дешевле, но
+результат приходит в течение 24 часов.
+
+Строка входа: {"id": ..., "text": "..."} (без id используется номер строки).
+Строка выхода: {"id": ..., "response": "...", "usage": {...}} или {"id": ..., "error": "..."}.
+
+Вход читается потоком, ответы пишутся в порядке входа, а в памяти держится
+только окно незавершенных записей (или записи отправленных пакетов), поэтому
+объем входа не ограничен. Позиция во входе, размер выхода и отправленные
+пакеты сохраняются в контрольную точку: повторный запуск с теми же
+аргументами продолжает с места остановки.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from itertools import islice
+from types import SimpleNamespace
+from typing import Any, Deque, Dict, Iterator, List, NamedTuple, Optional
+
+import anthropic
+import httpx
+from dotenv import load_dotenv
+
+from context_window import estimate_tokens
+from http_pool import HttpPool
+from knowledge_base import KnowledgeBase
+from llm_client import ResilientClaude, cacheable_system, min_cacheable_tokens, record_usage
+from markdown_cleaner import clean_markdown
+from metrics import Counter
+from prompts import CORE_PROMPT, SYSTEM_PROMPT
+from structured_logging import setup_from_env as setup_logging
+
+logger = logging.getLogger(__name__)
+
+BATCH_RECORDS = Counter("hr_bot_batch_records_total", "Записи пакетного прогона по результату", ["mode", "result"])
+
+NO_TEXT = "Нет текста: ожидается JSON-объект с полем text"
+
+
+class Record(NamedTuple):
+    """Запись входа и ее место в файле"""
+    line: int  # номер строки, с 1
+    start: int  # смещение начала строки в байтах
+    end: int  # смещение после строки
+    id: Any
+    text: Optional[str]  # None — строка не разобрана
+
+
+def read_records(path: str, offset: int = 0, line: int = 0) -> Iterator[Record]:
+    """Читать записи JSONL потоком, начиная со смещения offset (номер строки перед ним — line)"""
+    with open(path, "rb") as file:
+        file.seek(offset)
+        for raw in file:
+            start, offset, line = offset, offset + len(raw), line + 1
+            if not raw.strip():
+                continue
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                yield Record(line, start, offset, line, None)
+                continue
+            if not isinstance(data, dict):
+                yield Record(line, start, offset, line, None)
+                continue
+            text = data.get("text")
+            yield Record(line, start, offset, data.get("id", line), text if isinstance(text, str) and text else None)
+
+
+class Checkpoint:
+    """
+    Состояние прогона.
+
+    offset и line — сколько входа уже записано в выход, output_size — размер
+    выхода на этот момент, batches — отправленные, но еще не записанные пакеты.
+    Файл заменяется атомарно (временный файл и os.replace).
+    """
+
+    def __init__(self, path: str, input_path: str):
+        self.path = path
+        self.input_path = os.path.abspath(input_path)
+        self.offset = 0
+        self.line = 0
+        self.output_size = 0
+        self.batches: List[Dict] = []
+
+    def load(self) -> bool:
+        """Прочитать сохраненное состояние; False — прогон начинается с начала"""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding="utf-8") as file:
+            state = json.load(file)
+        if state["input"] != self.input_path:
+            raise ValueError(f"Контрольная точка {self.path} относится к другому входу: {state['input']}")
+        self.offset, self.line = state["offset"], state["line"]
+        self.output_size, self.batches = state["output_size"], state["batches"]
+        return True
+
+    def save(self):
+        state = {"input": self.input_path, "offset": self.offset, "line": self.line,
+                 "output_size": self.output_size, "batches": self.batches}
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(state, file, ensure_ascii=False)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+
+
+class ResultWriter:
+    """Выход JSONL в порядке входа; контрольная точка сохраняется только после сброса выхода на диск"""
+
+    def __init__(self, path: str, checkpoint: Checkpoint, save_every: int = 100):
+        self.checkpoint = checkpoint
+        self.save_every = save_every
+        self.written = 0
+        self.file = open(path, "r+b" if os.path.exists(path) else "wb")
+        # Хвост после контрольной точки мог записаться не полностью: эти записи будут получены заново
+        self.file.truncate(checkpoint.output_size)
+        self.file.seek(checkpoint.output_size)
+
+    def write(self, record: Record, result: Dict):
+        self.file.write(json.dumps({"id": record.id, **result}, ensure_ascii=False).encode("utf-8") + b"\n")
+        self.checkpoint.offset, self.checkpoint.line = record.end, record.line
+        self.written += 1
+        if self.written % self.save_every == 0:
+            self.commit()
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.checkpoint.output_size = self.file.tell()
+        self.checkpoint.save()
+
+    def close(self):
+        self.commit()
+        self.file.close()
+
+
+class Consultant:
+    """Запросы от имени HR-консультанта: тот же системный промпт и база знаний, что у бота"""
+
+    def __init__(self, llm: ResilientClaude, knowledge: Optional[KnowledgeBase] = None, instruction: str = "",
+                 max_tokens: Optional[int] = None, prompt_caching: bool = True):
+        """
+        Args:
+            llm: Клиент Claude с повторами
+            knowledge: База знаний (None — полный SYSTEM_PROMPT)
+            instruction: Задание для всего прогона, добавляется перед текстом каждой записи
+            max_tokens: Ограничение длины ответа (по умолчанию CLAUDE_MAX_TOKENS)
+            prompt_caching: Кэшировать системный промпт на стороне Anthropic (если он не короче минимума модели)
+        """
+        self.llm = llm
+        self.knowledge = knowledge
+        self.instruction = instruction
+        self.max_tokens = max_tokens or llm.max_tokens
+        self.prompt_caching = prompt_caching
+        self.tokens = {"input": 0, "output": 0, "cache_read": 0, "cache_creation": 0}
+
+    def params(self, text: str) -> Dict:
+        """Параметры Messages API для одной записи"""
+        prompt = CORE_PROMPT if self.knowledge is not None else SYSTEM_PROMPT
+        cacheable = self.prompt_caching and estimate_tokens(prompt) >= min_cacheable_tokens(self.llm.model)
+        system = cacheable_system(prompt) if cacheable else [{"type": "text", "text": prompt}]
+        if self.knowledge is not None:
+            context = self.knowledge.context(text)
+            if context:
+                # Запрос из одного хода, а блок идет после точки кэша: кэш промпта он не ломает
+                system = system + [{"type": "text", "text": context}]
+        content = f"{self.instruction}\n\n{text}" if self.instruction else text
+        return {
+            "model": self.llm.model,
+            "max_tokens": self.max_tokens,
+            "system": system,
+            "messages": [{"role": "user", "content": content}],
+        }
+
+    def _result(self, text: str, usage) -> Dict:
+        counts = record_usage(usage)
+        for kind, value in counts.items():
+            self.tokens[kind] += value
+        return {"response": clean_markdown(text), "usage": counts}
+
+    async def answer(self, record: Record) -> Dict:
+        """Ответ на запись обычным запросом; ошибка возвращается в поле error"""
+        if record.text is None:
+            return {"error": NO_TEXT}
+        try:
+            response = await self.llm.create(self.params(record.text), mode="batch")
+        except Exception as e:
+            logger.warning(f"Ошибка записи {record.id}: {type(e).__name__}: {e}")
+            return {"error": f"{type(e).__name__}: {e}"}
+        return self._result("".join(block.text for block in response.content if block.type == "text"),
+                            response.usage)
+
+    def batch_result(self, result: Dict) -> Dict:
+        """Ответ из результата Message Batches API"""
+        if result["type"] != "succeeded":
+            error = (result.get("error") or {}).get("error") or {}
+            return {"error": error.get("message") or result["type"]}
+        message = result["message"]
+        text = "".join(block["text"] for block in message["content"] if block["type"] == "text")
+        return self._result(text, SimpleNamespace(**message["usage"]))
+
+
+class MessageBatches:
+    """Message Batches API через низкоуровневые вызовы клиента (в этой версии SDK нет готовой обертки)"""
+
+    def __init__(self, client: anthropic.AsyncAnthropic):
+        self.client = client
+
+    async def create(self, requests: List[Dict]) -> Dict:
+        response = await self.client.post("/v1/messages/batches", cast_to=httpx.Response, body={"requests": requests})
+        return response.json()
+
+    async def retrieve(self, batch_id: str) -> Dict:
+        response = await self.client.get(f"/v1/messages/batches/{batch_id}", cast_to=httpx.Response)
+        return response.json()
+
+    async def results(self, batch: Dict) -> Iterator[Dict]:
+        """Результаты завершенного пакета (в памяти не больше одного пакета)"""
+        response = await self.client.get(batch["results_url"], cast_to=httpx.Response)
+        return (json.loads(line) for line in response.text.splitlines() if line.strip())
+
+
+class BatchJob:
+    """Прогон файла записей с контрольными точками"""
+
+    def __init__(self, consultant: Consultant, input_path: str, output_path: str,
+                 checkpoint_path: Optional[str] = None, concurrency: int = 8, window: Optional[int] = None,
+                 batch_size: int = 2000, max_batches: int = 4, poll_interval: float = 30.0,
+                 save_every: int = 100):
+        """
+        Args:
+            consultant: Формирование запросов и разбор ответов
+            input_path: Вход JSONL
+            output_path: Выход JSONL (дописывается при продолжении прогона)
+            checkpoint_path: Файл контрольной точки (по умолчанию <выход>.checkpoint)
+            concurrency: Одновременных запросов в режиме concurrent
+            window: Сколько записей может ждать записи в выход (по умолчанию 16 × concurrency);
+                ограничивает память, когда одна запись отвечает долго, а следующие уже готовы
+            batch_size: Записей в одном пакете Message Batches API
+            max_batches: Сколько пакетов может обрабатываться одновременно
+            poll_interval: Пауза между проверками статуса пакета (секунды)
+            save_every: Сохранять контрольную точку каждые N записанных записей
+        """
+        self.consultant = consultant
+        self.input_path = input_path
+        self.output_path = output_path
+        self.checkpoint = Checkpoint(checkpoint_path or f"{output_path}.checkpoint", input_path)
+        self.concurrency = concurrency
+        self.window = window or 16 * concurrency
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.poll_interval = poll_interval
+        self.save_every = save_every
+
+    async def run(self, mode: str = "concurrent") -> Dict:
+        """Обработать вход до конца и вернуть сводку"""
+        if self.checkpoint.load():
+            logger.info(f"Продолжение прогона со строки {self.checkpoint.line + 1}")
+        writer = ResultWriter(self.output_path, self.checkpoint, self.save_every)
+        started = time.perf_counter()
+        try:
+            if mode == "batches":
+                await self._run_batches(writer)
+            elif mode == "concurrent":
+                await self._run_concurrent(writer)
+            else:
+                raise ValueError(f"Неизвестный режим: {mode}")
+        finally:
+            writer.close()
+        summary = {"mode": mode, "records": writer.written, "seconds": round(time.perf_counter() - started, 1),
+                   **{f"{kind}_tokens": value for kind, value in self.consultant.tokens.items()}}
+        logger.info(f"Прогон завершен: {summary}")
+        return summary
+
+    def _write(self, writer: ResultWriter, record: Record, result: Dict, mode: str):
+        BATCH_RECORDS.labels(mode=mode, result="error" if "error" in result else "ok").inc()
+        writer.write(record, result)
+
+    async def _run_concurrent(self, writer: ResultWriter):
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+        slots = asyncio.Semaphore(self.window)
+        order: Deque[Record] = deque()
+        results: Dict[int, Dict] = {}
+
+        def drain():
+            while order and order[0].line in results:
+                record = order.popleft()
+                self._write(writer, record, results.pop(record.line), "concurrent")
+                slots.release()
+
+        async def worker():
+            while True:
+                record = await queue.get()
+                if record is None:
+                    return
+                results[record.line] = await self.consultant.answer(record)
+                drain()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            for record in read_records(self.input_path, self.checkpoint.offset, self.checkpoint.line):
+                await slots.acquire()
+                order.append(record)
+                await queue.put(record)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def _run_batches(self, writer: ResultWriter):
+        api = MessageBatches(self.consultant.llm.client)
+        in_flight: Deque[Dict] = deque(self.checkpoint.batches)
+        last = in_flight[-1] if in_flight else {"end": self.checkpoint.offset, "last_line": self.checkpoint.line}
+        records = read_records(self.input_path, last["end"], last["last_line"])
+        exhausted = False
+
+        while in_flight or not exhausted:
+            while not exhausted and len(in_flight) < self.max_batches:
+                chunk = list(islice(records, self.batch_size))
+                if not chunk:
+                    exhausted = True
+                    break
+                in_flight.append(await self._submit(api, chunk))
+                self.checkpoint.batches = list(in_flight)
+                self.checkpoint.save()
+            if not in_flight:
+                break
+
+            # Пакеты записываются в порядке отправки, чтобы выход шел в порядке входа
+            entry = in_flight[0]
+            results = await self._collect(api, entry)
+            for record in read_records(self.input_path, entry["start"], entry["line"]):
+                if record.line > entry["last_line"]:
+                    break
+                if record.line <= self.checkpoint.line:
+                    # Уже записано до остановки прогона
+                    continue
+                custom_id = f"line-{record.line}"
+                if record.text is None:
+                    result = {"error": NO_TEXT}
+                elif custom_id in results:
+                    result = self.consultant.batch_result(results[custom_id])
+                else:
+                    result = {"error": "Нет результата в пакете"}
+                self._write(writer, record, result, "batches")
+            in_flight.popleft()
+            self.checkpoint.batches = list(in_flight)
+            writer.commit()
+
+    async def _submit(self, api: MessageBatches, chunk: List[Record]) -> Dict:
+        """Отправить записи пакетом; записи без текста в пакет не попадают"""
+        requests = [{"custom_id": f"line-{record.line}", "params": self.consultant.params(record.text)}
+                    for record in chunk if record.text is not None]
+        batch_id = (await api.create(requests))["id"] if requests else None
+        logger.info(f"Отправлен пакет {batch_id}: строки {chunk[0].line}–{chunk[-1].line}, запросов {len(requests)}")
+        return {"id": batch_id, "start": chunk[0].start, "line": chunk[0].line - 1,
+                "end": chunk[-1].end, "last_line": chunk[-1].line}
+
+    async def _collect(self, api: MessageBatches, entry: Dict) -> Dict[str, Dict]:
+        """Дождаться завершения пакета и получить результаты по custom_id"""
+        if entry["id"] is None:
+            return {}
+        while True:
+            batch = await api.retrieve(entry["id"])
+            if batch["processing_status"] == "ended":
+                break
+            logger.info(f"Пакет {entry['id']}: {batch.get('request_counts')}")
+            await asyncio.sleep(self.poll_interval)
+        return {item["custom_id"]: item["result"] for item in await api.results(batch)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетные консультации HR-ассистента: JSONL -> JSONL")
+    parser.add_argument("input", help="Вход JSONL: {\"id\": ..., \"text\": \"...\"} в каждой строке")
+    parser.add_argument("output", help="Выход JSONL (при продолжении прогона дописывается)")
+    parser.add_argument("--mode", choices=("concurrent", "batches"), default="concurrent",
+                        help="Параллельные запросы или Message Batches API (дешевле, результат до 24 ч)")
+    parser.add_argument("--instruction", default="", help="Задание для всех записей, например «Выдели причины ухода»")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("BATCH_CONCURRENCY", 8)),
+                        help="Одновременных запросов в режиме concurrent")
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("BATCH_SIZE", 2000)),
+                        help="Записей в одном пакете Message Batches API")
+    parser.add_argument("--max-batches", type=int, default=4, help="Пакетов в обработке одновременно")
+    parser.add_argument("--poll-interval", type=float, default=30.0, help="Пауза между проверками пакета (с)")
+    parser.add_argument("--max-tokens", type=int, help="Ограничение длины ответа (по умолчанию CLAUDE_MAX_TOKENS)")
+    parser.add_argument("--checkpoint", help="Файл контрольной точки (по умолчанию <выход>.checkpoint)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    setup_logging()
+    api_key = os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        raise ValueError("Не установлена переменная окружения ANTHROPIC_API_KEY")
+
+    async def run():
+        client = anthropic.AsyncAnthropic(
+            api_key=api_key, max_retries=0,
+            http_client=HttpPool.from_env().client("anthropic", max(args.concurrency, args.max_batches) + 2),
+        )
+        consultant = Consultant(
+            ResilientClaude.from_env(client), KnowledgeBase.from_env(), args.instruction, args.max_tokens,
+            prompt_caching=os.getenv("PROMPT_CACHING", "1") == "1",
+        )
+        job = BatchJob(consultant, args.input, args.output, args.checkpoint, concurrency=args.concurrency,
+                       batch_size=args.batch_size, max_batches=args.max_batches, poll_interval=args.poll_interval)
+        try:
+            return await job.run(args.mode)
+        finally:
+            await client.close()
+
+    print(json.dumps(asyncio.run(run()), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
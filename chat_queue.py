@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Очередь ходов по чатам: склейка сообщений, отправленных подряд, и строгий порядок обработки
+"""
+
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+CHAT_TURNS = Counter("hr_bot_chat_turns_total", "Обработанные ходы пользователей")
+CHAT_MERGED = Counter("hr_bot_chat_merged_messages_total", "Сообщения, склеенные с соседними в один ход")
+CHAT_CANCELLED = Counter("hr_bot_chat_cancelled_total", "Ходы, отмененные командой очистки разговора")
+
+TurnProcessor = Callable[[int, str, Any], Awaitable[None]]
+
+
+class _ChatState:
+    """Состояние одного чата"""
+
+    __slots__ = ("texts", "waiters", "update", "first_arrival", "last_arrival", "worker")
+
+    def __init__(self):
+        self.texts: List[str] = []
+        self.waiters: List[asyncio.Future] = []
+        self.update: Any = None
+        self.first_arrival = 0.0
+        self.last_arrival = 0.0
+        self.worker: Optional[asyncio.Task] = None
+
+
+class ChatTurnQueue:
+    """
+    Один обработчик (актор) на чат.
+
+    Все сообщения, пришедшие пока обрабатывается предыдущий ход,
+    склеиваются в один следующий ход пользователя. Ходы одного чата
+    обрабатываются строго по очереди, поэтому история не перемешивается,
+    а за серию сообщений платим одним запросом к Claude.
+
+    По умолчанию первый ход уходит сразу, без таймера. Пауза debounce
+    дополнительно склеивает сообщения, отправленные подряд до начала хода,
+    но прибавляется к задержке каждого ответа.
+    """
+
+    def __init__(self, process: TurnProcessor, debounce: float = 0.0, max_delay: float = 3.0):
+        """
+        Args:
+            process: Корутина (chat_id, склеенный текст, последнее обновление)
+            debounce: Пауза без новых сообщений, после которой ход отправляется (секунды, 0 — сразу)
+            max_delay: Максимальная задержка первого сообщения хода (секунды)
+        """
+        self.process = process
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._chats: Dict[int, _ChatState] = {}
+
+    @classmethod
+    def from_env(cls, process: TurnProcessor) -> "ChatTurnQueue":
+        """Создать очередь с настройками из переменных окружения"""
+        return cls(
+            process,
+            debounce=float(os.getenv("CHAT_DEBOUNCE_SECONDS", 0)),
+            max_delay=float(os.getenv("CHAT_MAX_DELAY_SECONDS", 3.0)),
+        )
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    async def submit(self, chat_id: int, text: str, update: Any):
+        """Поставить сообщение в очередь чата и дождаться обработки хода, в который оно попало"""
+        loop = asyncio.get_running_loop()
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatState()
+
+        now = loop.time()
+        if not state.texts:
+            state.first_arrival = now
+        else:
+            CHAT_MERGED.inc()
+        state.last_arrival = now
+        state.texts.append(text)
+        state.update = update
+
+        waiter = loop.create_future()
+        state.waiters.append(waiter)
+        if state.worker is None or state.worker.done():
+            state.worker = loop.create_task(self._run(chat_id, state))
+        await waiter
+
+    def cancel(self, chat_id: int):
+        """Отменить текущий и ожидающие ходы чата (например, после /new)"""
+        state = self._chats.pop(chat_id, None)
+        if state is None:
+            return
+        if state.worker is not None and not state.worker.done():
+            state.worker.cancel()
+            CHAT_CANCELLED.inc()
+        _resolve(state.waiters)
+        state.waiters = []
+        state.texts = []
+
+    async def _run(self, chat_id: int, state: _ChatState):
+        loop = asyncio.get_running_loop()
+        try:
+            while state.texts:
+                # Ждем паузы в сообщениях, но не дольше max_delay с первого сообщения хода
+                while True:
+                    wake = min(state.last_arrival + self.debounce, state.first_arrival + self.max_delay)
+                    delay = wake - loop.time()
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+
+                texts, waiters, update = state.texts, state.waiters, state.update
+                state.texts, state.waiters = [], []
+                try:
+                    CHAT_TURNS.inc()
+                    await self.process(chat_id, "\n\n".join(texts), update)
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке хода {chat_id}: {e}")
+                finally:
+                    _resolve(waiters)
+        finally:
+            if self._chats.get(chat_id) is state and not state.texts:
+                del self._chats[chat_id]
+
+
+def _resolve(waiters: List[asyncio.Future]):
+    for waiter in waiters:
+        if not waiter.done():
+            waiter.set_result(None)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Окно контекста: обрезка истории по бюджету токенов и сворачивание старых ходов в краткое содержание
+"""
+
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_ROLE = "summary"
+
+# Накладные расходы API на одно сообщение (роль, разметка)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+CONTEXT_TOKENS = Histogram(
+    "hr_bot_context_tokens",
+    "Оценка токенов истории, отправляемой в запросе",
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000),
+)
+CONTEXT_SUMMARIES = Counter("hr_bot_context_summaries_total", "Обновления краткого содержания разговора", ["result"])
+
+Summarizer = Callable[[int, str, List[Dict]], Awaitable[str]]
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Быстрая оценка числа токенов без токенизатора.
+
+    Около 4 байт UTF-8 на токен: для английского это ~4 символа,
+    для кириллицы ~2 символа — с небольшим запасом.
+    """
+    return len(text.encode("utf-8")) // 4 + MESSAGE_OVERHEAD_TOKENS
+
+
+def message_tokens(message: Dict) -> int:
+    """Токены сообщения; оценка считается один раз и сохраняется в самом сообщении"""
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = message["tokens"] = estimate_tokens(message["content"])
+    return tokens
+
+
+class ContextWindow:
+    """
+    Держит историю в пределах бюджета входных токенов.
+
+    История хранится как список сообщений, где первым может идти служебная
+    запись с ролью "summary" — краткое содержание вытесненных ходов.
+    Вытесненные ходы сворачиваются в краткое содержание в фоне, вне пути
+    обработки сообщения, поэтому размер запроса не растет с длиной консультации.
+    """
+
+    def __init__(self, budget_tokens: int = 6000, summarizer: Optional[Summarizer] = None):
+        """
+        Args:
+            budget_tokens: Бюджет токенов на историю вместе с кратким содержанием
+            summarizer: Корутина (user_id, старое содержание, вытесненные сообщения) -> новое содержание
+        """
+        self.budget_tokens = budget_tokens
+        self.summarizer = summarizer
+        self._pending: Dict[int, List[Dict]] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    @classmethod
+    def from_env(cls, summarizer: Optional[Summarizer] = None) -> "ContextWindow":
+        """Создать окно контекста с настройками из переменных окружения"""
+        if os.getenv("HISTORY_SUMMARY", "1") != "1":
+            summarizer = None
+        return cls(budget_tokens=int(os.getenv("HISTORY_TOKEN_BUDGET", 6000)), summarizer=summarizer)
+
+    def trim(self, history: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """
+        Обрезать историю по бюджету.
+
+        Считаются только токены сообщений, у которых еще нет оценки, так что
+        каждый ход оценивается один раз. Оставшаяся история всегда начинается
+        с реплики пользователя.
+
+        Returns:
+            (оставленная история, вытесненные сообщения)
+        """
+        summary = history[0] if history and history[0]["role"] == SUMMARY_ROLE else None
+        turns = history[1:] if summary else history
+        budget = self.budget_tokens - (message_tokens(summary) if summary else 0)
+
+        used = 0
+        start = len(turns)
+        while start > 0:
+            tokens = message_tokens(turns[start - 1])
+            # Последнее сообщение оставляем всегда, даже если оно больше бюджета
+            if used + tokens > budget and start < len(turns):
+                break
+            used += tokens
+            start -= 1
+        # Реплики консультанта в начале окна уходят в краткое содержание
+        while start < len(turns) and turns[start]["role"] != "user":
+            start += 1
+
+        if start == 0:
+            return history, []
+        kept = ([summary] if summary else []) + turns[start:]
+        return kept, turns[:start]
+
+    def request_parts(self, history: List[Dict]) -> Tuple[Optional[str], List[Dict]]:
+        """Разделить историю на краткое содержание и сообщения в формате API"""
+        summary = None
+        messages = []
+        for message in history:
+            if message["role"] == SUMMARY_ROLE:
+                summary = message["content"]
+            else:
+                messages.append({"role": message["role"], "content": message["content"]})
+        CONTEXT_TOKENS.observe(sum(message_tokens(message) for message in history))
+        return summary, messages
+
+    def schedule_summary(self, user_id: int, dropped: List[Dict],
+                         load: Callable[[int], Awaitable[List[Dict]]],
+                         save: Callable[[int, List[Dict]], Awaitable[None]]):
+        """
+        Свернуть вытесненные сообщения в краткое содержание в фоне.
+
+        Args:
+            user_id: ID пользователя
+            dropped: Вытесненные сообщения
+            load: Корутина чтения текущей истории пользователя
+            save: Корутина сохранения истории пользователя
+        """
+        if self.summarizer is None or not dropped:
+            return
+        self._pending.setdefault(user_id, []).extend(dropped)
+        task = self._tasks.get(user_id)
+        if task is None or task.done():
+            self._tasks[user_id] = asyncio.get_running_loop().create_task(self._summarize(user_id, load, save))
+
+    def cancel(self, user_id: int):
+        """Отменить сворачивание (например, при очистке разговора)"""
+        self._pending.pop(user_id, None)
+        task = self._tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def _summarize(self, user_id: int, load, save):
+        try:
+            while self._pending.get(user_id):
+                dropped = self._pending.pop(user_id)
+                history = await load(user_id)
+                previous = history[0]["content"] if history and history[0]["role"] == SUMMARY_ROLE else ""
+                try:
+                    summary = await self.summarizer(user_id, previous, dropped)
+                except Exception as e:
+                    CONTEXT_SUMMARIES.labels(result="error").inc()
+                    logger.warning(f"Не удалось обновить краткое содержание для {user_id}: {e}")
+                    return
+
+                # История могла измениться, пока генерировалось содержание
+                history = await load(user_id)
+                if history and history[0]["role"] == SUMMARY_ROLE:
+                    history = history[1:]
+                entry = {"role": SUMMARY_ROLE, "content": summary}
+                message_tokens(entry)
+                await save(user_id, [entry] + history)
+                CONTEXT_SUMMARIES.labels(result="ok").inc()
+        finally:
+            if self._tasks.get(user_id) is asyncio.current_task():
+                del self._tasks[user_id]
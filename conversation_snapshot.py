@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Снимок разговоров на диске для переноса истории через перезапуск
+
+Формат файла:
+    заголовок   MAGIC (8 байт), алгоритм сжатия (1 байт)
+    записи      длина (uint32) + ходы одного пользователя
+    ход         роль (uint8: user, assistant, summary), флаги (uint8), токены (int32, -1 — нет),
+                длина (uint32), текст UTF-8
+    индекс      (user_id int64, смещение записи uint64, длина uint32), по возрастанию user_id
+    концовка    смещение индекса uint64, число записей uint64, MAGIC
+
+Текст длинных ходов сжат (флаг 1) тем же алгоритмом, что и старые ходы в
+ConversationStore, поэтому они копируются в снимок из памяти без
+пересжатия. Записи пишутся по одной, снимок не собирается в памяти целиком.
+При запуске файл отображается в память (mmap) и читается только концовка:
+история пользователя находится двоичным поиском по индексу и распаковывается
+при первом обращении, поэтому время запуска не зависит от числа разговоров.
+
+Выгрузка в JSONL и сборка снимка из JSONL (перенос между хранилищами):
+    python conversation_snapshot.py dump conversations.snap > conversations.jsonl
+    python conversation_snapshot.py load conversations.jsonl conversations.snap
+"""
+
+import argparse
+import array
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"HRCONV01"
+_LENGTH = struct.Struct("<I")
+_TURN = struct.Struct("<BBiI")
+_INDEX = struct.Struct("<qQI")
+_FOOTER = struct.Struct("<QQ8s")
+
+# Номер алгоритма в заголовке -> имя
+CODECS = {0: "none", 1: "zlib", 2: "zstd"}
+# Коды ролей только дописываются в конец: по ним читаются снимки прошлых версий.
+# summary — краткое содержание вытесненных ходов (context_window.SUMMARY_ROLE)
+_ROLES = ("user", "assistant", "summary")
+_ROLE_CODES = {role: code for code, role in enumerate(_ROLES)}
+_PACKED = 1
+
+# Ход: (роль, текст UTF-8, сжат ли текст, оценка токенов)
+Turn = Tuple[str, bytes, bool, Optional[int]]
+
+
+def codec(name: str) -> Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]:
+    """Функции (сжать, распаковать) для текста ходов"""
+    if name == "zlib":
+        return (lambda data: zlib.compress(data, 6)), zlib.decompress
+    if name == "zstd":
+        import zstandard
+
+        compressor, decompressor = zstandard.ZstdCompressor(level=3), zstandard.ZstdDecompressor()
+        return compressor.compress, decompressor.decompress
+    raise ValueError(f"Неизвестный алгоритм сжатия снимка: {name}")
+
+
+class SnapshotWriter:
+    """
+    Потоковая запись снимка во временный файл; commit() атомарно заменяет им старый.
+
+    В памяти остается только индекс: 20 байт на пользователя.
+    """
+
+    def __init__(self, path: str, compression: str = "zlib", min_compress_bytes: int = 256):
+        self.path = path
+        self.compression = compression
+        self.min_compress_bytes = min_compress_bytes
+        self._compress = codec(compression)[0] if compression != "none" else None
+        self._temporary = f"{path}.tmp"
+        self._file = open(self._temporary, "wb")
+        self._file.write(MAGIC + bytes([{name: code for code, name in CODECS.items()}[compression]]))
+        self._user_ids = array.array("q")
+        self._offsets = array.array("Q")
+        self._lengths = array.array("I")
+
+    def __len__(self) -> int:
+        return len(self._user_ids)
+
+    def __enter__(self) -> "SnapshotWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def add(self, user_id: int, messages: List[Dict]):
+        """Записать историю пользователя"""
+        self.add_turns(user_id, (
+            (message["role"], message["content"].encode("utf-8"), False, message.get("tokens"))
+            for message in messages
+        ))
+
+    def add_turns(self, user_id: int, turns: Iterable[Turn]):
+        """Записать историю из ходов; уже сжатые ходы должны быть сжаты алгоритмом снимка"""
+        parts = []
+        for role, data, packed, tokens in turns:
+            if role not in _ROLE_CODES:
+                raise ValueError(f"Неизвестная роль хода в снимке: {role}")
+            if not packed and self._compress is not None and len(data) >= self.min_compress_bytes:
+                compressed = self._compress(data)
+                if len(compressed) < len(data):
+                    data, packed = compressed, True
+            parts.append(_TURN.pack(_ROLE_CODES[role], _PACKED if packed else 0,
+                                    -1 if tokens is None else tokens, len(data)))
+            parts.append(data)
+        self.add_frame(user_id, b"".join(parts))
+
+    def add_frame(self, user_id: int, frame: bytes):
+        """Записать уже сжатую запись (тем же алгоритмом), например из предыдущего снимка"""
+        self._user_ids.append(user_id)
+        self._offsets.append(self._file.tell())
+        self._lengths.append(len(frame))
+        self._file.write(_LENGTH.pack(len(frame)))
+        self._file.write(frame)
+
+    def copy_from(self, reader: "SnapshotReader", skip: Set[int] = frozenset()):
+        """Перенести неиспользованные записи предыдущего снимка (без пересжатия, если алгоритм тот же)"""
+        same = reader.compression == self.compression
+        for user_id, frame in reader.iter_frames(skip):
+            if same:
+                self.add_frame(user_id, frame)
+            else:
+                self.add(user_id, reader.decode(frame))
+
+    def commit(self):
+        """Дописать индекс и концовку, сбросить на диск и заменить старый снимок"""
+        index_offset = self._file.tell()
+        order = sorted(range(len(self._user_ids)), key=self._user_ids.__getitem__)
+        for position in order:
+            self._file.write(_INDEX.pack(self._user_ids[position], self._offsets[position], self._lengths[position]))
+        self._file.write(_FOOTER.pack(index_offset, len(order), MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._temporary, self.path)
+
+    def abort(self):
+        """Отказаться от записи: старый снимок остается на месте"""
+        self._file.close()
+        os.unlink(self._temporary)
+
+
+class SnapshotReader:
+    """
+    Снимок, отображенный в память.
+
+    take() отдает историю пользователя один раз: после этого актуальная
+    версия живет в хранилище, а в следующий снимок переносятся только
+    неиспользованные записи (iter_frames).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < len(MAGIC) + 1 + _FOOTER.size or self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} не является снимком разговоров")
+        self.compression = CODECS[self._mmap[len(MAGIC)]]
+        self._decompress = codec(self.compression)[1] if self.compression != "none" else None
+        self._index_offset, self._count, magic = _FOOTER.unpack_from(self._mmap, len(self._mmap) - _FOOTER.size)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"Снимок {path} записан не полностью")
+        self._taken: Set[int] = set()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _entry(self, position: int) -> Tuple[int, int, int]:
+        return _INDEX.unpack_from(self._mmap, self._index_offset + position * _INDEX.size)
+
+    def _find(self, user_id: int) -> Optional[Tuple[int, int]]:
+        """Смещение и длина записи пользователя (двоичный поиск по индексу)"""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            current, offset, length = self._entry(middle)
+            if current == user_id:
+                return offset, length
+            if current < user_id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def _frame(self, offset: int, length: int) -> bytes:
+        start = offset + _LENGTH.size
+        return self._mmap[start:start + length]
+
+    def decode(self, frame: bytes) -> List[Dict]:
+        """Сообщения из записи"""
+        messages = []
+        position = 0
+        while position < len(frame):
+            role, flags, tokens, length = _TURN.unpack_from(frame, position)
+            position += _TURN.size
+            data = frame[position:position + length]
+            position += length
+            if flags & _PACKED:
+                data = self._decompress(data)
+            message = {"role": _ROLES[role], "content": data.decode("utf-8")}
+            if tokens >= 0:
+                message["tokens"] = tokens
+            messages.append(message)
+        return messages
+
+    def get(self, user_id: int) -> Optional[List[Dict]]:
+        """История пользователя из снимка или None"""
+        found = self._find(user_id)
+        if found is None:
+            return None
+        return self.decode(self._frame(*found))
+
+    def take(self, user_id: int) -> Optional[List[Dict]]:
+        """История пользователя при первом обращении; дальше — None"""
+        if user_id in self._taken:
+            return None
+        self._taken.add(user_id)
+        return self.get(user_id)
+
+    def discard(self, user_ids):
+        """Отметить записи устаревшими: у пользователей есть более новая история или она удалена"""
+        self._taken.update(user_ids)
+
+    def iter_frames(self, skip: Set[int] = frozenset()) -> Iterator[Tuple[int, bytes]]:
+        """Неиспользованные записи (user_id, сжатые данные) в порядке индекса"""
+        for position in range(self._count):
+            user_id, offset, length = self._entry(position)
+            if user_id not in self._taken and user_id not in skip:
+                yield user_id, self._frame(offset, length)
+
+    def items(self) -> Iterator[Tuple[int, List[Dict]]]:
+        """Все истории снимка (user_id, сообщения)"""
+        for position in range(self._count):
+            user_id, offset, length = self._entry(position)
+            yield user_id, self.decode(self._frame(offset, length))
+
+    def close(self):
+        self._mmap.close()
+
+
+def open_snapshot(path: str) -> Optional[SnapshotReader]:
+    """Открыть снимок, если он есть; поврежденный снимок пропускается с предупреждением"""
+    if not os.path.exists(path):
+        return None
+    try:
+        return SnapshotReader(path)
+    except (ValueError, KeyError, OSError, struct.error) as e:
+        logger.warning(f"Снимок разговоров {path} не прочитан: {e}")
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Снимок разговоров: выгрузка в JSONL и сборка из JSONL")
+    commands = parser.add_subparsers(dest="command", required=True)
+    dump = commands.add_parser("dump", help="Выгрузить снимок в JSONL ({\"user_id\", \"messages\"} в строке)")
+    dump.add_argument("snapshot")
+    load = commands.add_parser("load", help="Собрать снимок из JSONL")
+    load.add_argument("jsonl")
+    load.add_argument("snapshot")
+    load.add_argument("--compression", choices=sorted(CODECS.values()), default="zlib")
+    args = parser.parse_args()
+
+    if args.command == "dump":
+        reader = SnapshotReader(args.snapshot)
+        for user_id, messages in reader.items():
+            sys.stdout.write(json.dumps({"user_id": user_id, "messages": messages}, ensure_ascii=False) + "\n")
+        reader.close()
+    else:
+        with open(args.jsonl, encoding="utf-8") as source, SnapshotWriter(args.snapshot, args.compression) as writer:
+            for line in source:
+                if line.strip():
+                    record = json.loads(line)
+                    writer.add(int(record["user_id"]), record["messages"])
+        print(f"Записано разговоров: {len(writer)} -> {args.snapshot}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
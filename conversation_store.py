@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Хранилище истории разговоров: горячий LRU-кэш в памяти поверх долговременного бэкенда
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from conversation_snapshot import SnapshotReader, SnapshotWriter, codec, open_snapshot
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+STORE_HOT_USERS = Gauge("hr_bot_store_hot_users", "Разговоры в горячем кэше памяти")
+STORE_HOT_BYTES = Gauge("hr_bot_store_hot_bytes", "Оценка памяти, занятой горячим кэшем разговоров")
+STORE_DIRTY = Gauge("hr_bot_store_dirty", "Разговоры, ожидающие записи в бэкенд")
+STORE_EVICTIONS = Counter("hr_bot_store_evictions_total", "Вытеснения разговоров из горячего кэша", ["reason"])
+STORE_LOADS = Counter("hr_bot_store_loads_total", "Обращения к истории разговора", ["result"])
+STORE_RESTORED = Counter("hr_bot_store_restored_total", "Разговоры, восстановленные из снимка при первом обращении")
+
+
+def _dumps(messages: List[Dict]) -> str:
+    return json.dumps(messages, ensure_ascii=False, separators=(",", ":"))
+
+
+class ConversationBackend:
+    """Интерфейс долговременного хранилища истории"""
+
+    async def load(self, user_id: int) -> Optional[List[Dict]]:
+        """Загрузить историю пользователя или None, если ее нет"""
+        raise NotImplementedError
+
+    async def save_many(self, conversations: Dict[int, List[Dict]]):
+        """Сохранить пачку историй"""
+        raise NotImplementedError
+
+    async def delete_many(self, user_ids: Iterable[int]):
+        """Удалить истории пользователей"""
+        raise NotImplementedError
+
+    async def close(self):
+        """Освободить ресурсы"""
+
+
+class MemoryBackend(ConversationBackend):
+    """
+    Бэкенд без долговременного хранения: история живет только в горячем кэше.
+
+    Разговор, вытесненный из кэша по простою (idle_ttl) или бюджету памяти,
+    теряется без возврата, в том числе для снимка: в снимок попадают только
+    разговоры, которые к остановке еще лежат в кэше.
+    """
+
+    async def load(self, user_id: int) -> Optional[List[Dict]]:
+        return None
+
+    async def save_many(self, conversations: Dict[int, List[Dict]]):
+        pass
+
+    async def delete_many(self, user_ids: Iterable[int]):
+        pass
+
+
+class SQLiteBackend(ConversationBackend):
+    """Локальное хранилище SQLite в режиме WAL"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "user_id INTEGER PRIMARY KEY, messages TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def _load(self, user_id: int) -> Optional[List[Dict]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT messages FROM conversations WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save_many(self, conversations: Dict[int, List[Dict]]):
+        now = time.time()
+        rows = [(user_id, _dumps(messages), now) for user_id, messages in conversations.items()]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO conversations (user_id, messages, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET messages = excluded.messages, "
+                    "updated_at = excluded.updated_at",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _delete_many(self, user_ids: List[int]):
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM conversations WHERE user_id = ?", [(user_id,) for user_id in user_ids]
+            )
+
+    async def load(self, user_id: int) -> Optional[List[Dict]]:
+        return await asyncio.to_thread(self._load, user_id)
+
+    async def save_many(self, conversations: Dict[int, List[Dict]]):
+        await asyncio.to_thread(self._save_many, conversations)
+
+    async def delete_many(self, user_ids: Iterable[int]):
+        await asyncio.to_thread(self._delete_many, list(user_ids))
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisBackend(ConversationBackend):
+    """
+    Хранилище в Redis-совместимом сервере.
+
+    Принимает любой асинхронный клиент с методами get/set/delete
+    (например, redis.asyncio.Redis), поэтому в тестах его можно заменить заглушкой.
+    """
+
+    def __init__(self, client, key_prefix: str = "hr_bot:conv:", ttl: Optional[int] = None):
+        self.client = client
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+
+    def _key(self, user_id: int) -> str:
+        return f"{self.key_prefix}{user_id}"
+
+    async def load(self, user_id: int) -> Optional[List[Dict]]:
+        raw = await self.client.get(self._key(user_id))
+        if raw is None:
+            return None
+        if isinstance(raw, bytes):
+            raw = raw.decode("utf-8")
+        return json.loads(raw)
+
+    async def save_many(self, conversations: Dict[int, List[Dict]]):
+        if hasattr(self.client, "pipeline"):
+            async with self.client.pipeline(transaction=False) as pipe:
+                for user_id, messages in conversations.items():
+                    pipe.set(self._key(user_id), _dumps(messages), ex=self.ttl)
+                await pipe.execute()
+        else:
+            for user_id, messages in conversations.items():
+                await self.client.set(self._key(user_id), _dumps(messages), ex=self.ttl)
+
+    async def delete_many(self, user_ids: Iterable[int]):
+        keys = [self._key(user_id) for user_id in user_ids]
+        if keys:
+            await self.client.delete(*keys)
+
+    async def close(self):
+        close = getattr(self.client, "aclose", None) or getattr(self.client, "close", None)
+        if close is not None:
+            result = close()
+            if asyncio.iscoroutine(result):
+                await result
+
+
+class SnapshotBackend(ConversationBackend):
+    """
+    Бэкенд поверх снимка с прошлого запуска.
+
+    История пользователя берется из снимка, только если ее нет в основном
+    бэкенде, и только при первом обращении. Более новые версии и удаления
+    помечают запись снимка устаревшей.
+    """
+
+    def __init__(self, inner: ConversationBackend, snapshot: Optional[SnapshotReader]):
+        self.inner = inner
+        self.snapshot = snapshot
+
+    async def load(self, user_id: int) -> Optional[List[Dict]]:
+        messages = await self.inner.load(user_id)
+        if self.snapshot is not None:
+            restored = self.snapshot.take(user_id)
+            if messages is None and restored is not None:
+                STORE_RESTORED.inc()
+                return restored
+        return messages
+
+    async def save_many(self, conversations: Dict[int, List[Dict]]):
+        if self.snapshot is not None:
+            self.snapshot.discard(conversations)
+        await self.inner.save_many(conversations)
+
+    async def delete_many(self, user_ids: Iterable[int]):
+        user_ids = list(user_ids)
+        if self.snapshot is not None:
+            self.snapshot.discard(user_ids)
+        await self.inner.delete_many(user_ids)
+
+    async def close(self):
+        await self.inner.close()
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+
+
+class _Turn:
+    """
+    Ход в компактном виде.
+
+    Текст хранится в UTF-8: кириллица в str занимает 2 байта на символ плюс
+    заголовок объекта, а без словаря на каждый ход экономится еще ~200 байт.
+    Старые ходы (за пределами горячего окна) дополнительно сжаты; для них
+    хранятся длина и CRC32 исходного текста, чтобы узнавать ход в новой
+    версии истории без распаковки.
+    """
+
+    __slots__ = ("role", "data", "packed", "tokens", "checksum")
+
+    def __init__(self, role: str, data: bytes, packed: bool, tokens: Optional[int],
+                 checksum: Optional[Tuple[int, int]] = None):
+        self.role = role
+        self.data = data
+        self.packed = packed
+        self.tokens = tokens
+        self.checksum = checksum
+
+
+class _Entry:
+    """
+    Запись горячего кэша: история как кортеж компактных ходов.
+
+    Последние hot_turns ходов лежат в UTF-8 как есть, более старые сжаты
+    (если это дает выигрыш). Словари сообщений собираются только когда
+    история нужна для запроса; разобранные версии нескольких последних
+    разговоров хранит ConversationStore, чтобы повторные get() в рамках
+    одного сообщения не распаковывали историю заново.
+    """
+
+    __slots__ = ("turns", "size", "touched")
+
+    def __init__(self, turns: Tuple[_Turn, ...]):
+        self.turns = turns
+        self.size = _estimate_size(turns)
+        self.touched = time.monotonic()
+
+
+def _estimate_size(turns: Tuple[_Turn, ...]) -> int:
+    """Память, занятая историей: кортеж, записи ходов и их байты"""
+    size = sys.getsizeof(turns)
+    for turn in turns:
+        size += sys.getsizeof(turn) + sys.getsizeof(turn.data)
+    return size
+
+
+class ConversationStore:
+    """
+    История разговоров с горячим LRU+TTL кэшем в памяти.
+
+    Изменения записываются в бэкенд отложенно и пачками (write-behind):
+    фоновая задача сбрасывает накопленные изменения раз в flush_interval
+    секунд или когда их набирается batch_size.
+    """
+
+    def __init__(self, backend: Optional[ConversationBackend] = None, max_bytes: int = 64 * 1024 * 1024,
+                 idle_ttl: float = 24 * 3600, flush_interval: float = 1.0, batch_size: int = 256,
+                 hot_turns: int = 4, compression: Optional[str] = "zlib", min_compress_bytes: int = 256,
+                 snapshot_path: Optional[str] = None, decoded_users: int = 32):
+        """
+        Args:
+            backend: Долговременное хранилище (по умолчанию только память)
+            max_bytes: Бюджет памяти горячего кэша
+            idle_ttl: Через сколько секунд простоя разговор вытесняется из памяти
+            flush_interval: Период отложенной записи в бэкенд (секунды)
+            batch_size: Размер пачки, при котором запись начинается досрочно
+            hot_turns: Сколько последних ходов хранить несжатыми
+            compression: Сжатие старых ходов: "zlib", "zstd" или None
+            min_compress_bytes: Более короткие ходы не сжимаются
+            snapshot_path: Куда записать снимок разговоров при закрытии (None — не записывать)
+            decoded_users: Для скольких последних разговоров держать разобранную историю
+        """
+        self.backend = backend or MemoryBackend()
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.hot_turns = hot_turns
+        self.min_compress_bytes = min_compress_bytes
+        self.compression = compression or "none"
+        self.snapshot_path = snapshot_path
+        self._compress, self._decompress = codec(compression) if compression else (None, None)
+
+        self._hot: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._hot_bytes = 0
+        self.decoded_users = decoded_users
+        self._decoded: "OrderedDict[int, Tuple[Dict, ...]]" = OrderedDict()
+        self._dirty: Dict[int, List[Dict]] = {}
+        self._deleted: set = set()
+        self._evictions_warned = False
+        self._flush_event: Optional[asyncio.Event] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+        STORE_HOT_USERS.set_function(lambda: len(self._hot))
+        STORE_HOT_BYTES.set_function(lambda: self._hot_bytes)
+        STORE_DIRTY.set_function(lambda: len(self._dirty) + len(self._deleted))
+
+    @classmethod
+    def from_env(cls) -> "ConversationStore":
+        """Создать хранилище с настройками из переменных окружения"""
+        kind = os.getenv("CONVERSATION_STORE", "memory").lower()
+        if kind == "sqlite":
+            backend = SQLiteBackend(os.getenv("CONVERSATION_DB_PATH", "conversations.db"))
+        elif kind == "redis":
+            import redis.asyncio as aioredis
+
+            ttl = os.getenv("CONVERSATION_REDIS_TTL")
+            backend = RedisBackend(
+                aioredis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0")),
+                ttl=int(ttl) if ttl else None,
+            )
+        elif kind == "memory":
+            backend = MemoryBackend()
+        else:
+            raise ValueError(f"Неизвестный тип хранилища CONVERSATION_STORE: {kind}")
+
+        # Снимок переносит разговоры через перезапуск (у воркеров — свой файл, {worker} — номер воркера)
+        snapshot_path = os.getenv("CONVERSATION_SNAPSHOT", "").replace("{worker}", os.getenv("WORKER_INDEX", "0"))
+        if snapshot_path:
+            started = time.perf_counter()
+            snapshot = open_snapshot(snapshot_path)
+            backend = SnapshotBackend(backend, snapshot)
+            if snapshot is not None:
+                logger.info(f"Снимок разговоров {snapshot_path}: {len(snapshot)} разговоров, "
+                            f"открыт за {(time.perf_counter() - started) * 1000:.1f} мс")
+
+        compression = os.getenv("CONVERSATION_COMPRESSION", "zlib").lower()
+        logger.info(f"Хранилище разговоров: {kind}")
+        return cls(
+            backend,
+            max_bytes=int(os.getenv("CONVERSATION_CACHE_MB", 64)) * 1024 * 1024,
+            idle_ttl=float(os.getenv("CONVERSATION_IDLE_TTL", 24 * 3600)),
+            flush_interval=float(os.getenv("CONVERSATION_FLUSH_INTERVAL", 1.0)),
+            hot_turns=int(os.getenv("CONVERSATION_HOT_TURNS", 4)),
+            compression=None if compression == "none" else compression,
+            snapshot_path=snapshot_path or None,
+        )
+
+    def __len__(self) -> int:
+        return len(self._hot)
+
+    async def get(self, user_id: int) -> List[Dict]:
+        """
+        Получить историю пользователя.
+
+        Возвращается новый список (история в кэше хранится в компактном
+        виде), его можно изменять, после изменений нужно вызвать put().
+        """
+        entry = self._hot.get(user_id)
+        if entry is not None:
+            self._hot.move_to_end(user_id)
+            entry.touched = time.monotonic()
+            STORE_LOADS.labels(result="hot").inc()
+            return self._decoded_copy(user_id, entry)
+
+        if user_id in self._dirty:
+            messages = self._dirty[user_id]
+            STORE_LOADS.labels(result="pending").inc()
+        elif user_id in self._deleted:
+            messages = []
+            STORE_LOADS.labels(result="deleted").inc()
+        else:
+            messages = await self.backend.load(user_id) or []
+            STORE_LOADS.labels(result="backend" if messages else "empty").inc()
+            # Пока шла загрузка, история могла появиться в кэше
+            entry = self._hot.get(user_id)
+            if entry is not None:
+                return self._decoded_copy(user_id, entry)
+
+        self._insert(user_id, messages)
+        # Список из _dirty может сериализоваться в save_many в другом потоке — отдаем копию
+        return [dict(message) for message in messages]
+
+    async def put(self, user_id: int, messages: List[Dict]):
+        """Сохранить историю пользователя (запись в бэкенд — отложенная)"""
+        self._insert(user_id, messages)
+        self._deleted.discard(user_id)
+        self._dirty[user_id] = messages
+        self._schedule_flush()
+
+    async def clear(self, user_id: int):
+        """Удалить историю пользователя"""
+        entry = self._hot.pop(user_id, None)
+        if entry is not None:
+            self._hot_bytes -= entry.size
+        self._decoded.pop(user_id, None)
+        self._dirty.pop(user_id, None)
+        self._deleted.add(user_id)
+        self._schedule_flush()
+
+    def _pack(self, messages: List[Dict], previous: Optional[_Entry]) -> Tuple[_Turn, ...]:
+        """
+        Перевести историю в компактный вид.
+
+        Обычно история меняется с концов (новые ходы в конце, обрезка и
+        краткое содержание в начале), поэтому уже сжатые ходы прошлой версии
+        переиспользуются, а сжимается только ход, вышедший из горячего окна.
+        """
+        packed_before: Dict[Tuple, _Turn] = {}
+        if previous is not None:
+            for turn in previous.turns:
+                if turn.packed and turn.checksum is not None:
+                    packed_before[(turn.role, turn.tokens, turn.checksum)] = turn
+
+        cold = len(messages) - self.hot_turns
+        turns = []
+        for index, message in enumerate(messages):
+            role, tokens = sys.intern(message["role"]), message.get("tokens")
+            data = message["content"].encode("utf-8")
+            turn = None
+            if index < cold and self._compress is not None and len(data) >= self.min_compress_bytes:
+                # Ход сравнивается по длине и CRC32 без распаковки прежней версии
+                checksum = (len(data), zlib.crc32(data))
+                turn = packed_before.get((role, tokens, checksum))
+                if turn is None:
+                    compressed = self._compress(data)
+                    if len(compressed) < len(data):
+                        turn = _Turn(role, compressed, True, tokens, checksum)
+            turns.append(turn or _Turn(role, data, False, tokens))
+        return tuple(turns)
+
+    def _unpack(self, turns: Tuple[_Turn, ...]) -> List[Dict]:
+        """Собрать словари сообщений из компактных ходов"""
+        messages = []
+        for turn in turns:
+            data = self._decompress(turn.data) if turn.packed else turn.data
+            message = {"role": turn.role, "content": data.decode("utf-8")}
+            if turn.tokens is not None:
+                message["tokens"] = turn.tokens
+            messages.append(message)
+        return messages
+
+    def _decoded_copy(self, user_id: int, entry: _Entry) -> List[Dict]:
+        """Копия разобранной истории; распаковка — только если ее нет среди последних разговоров"""
+        view = self._decoded.get(user_id)
+        if view is None:
+            view = tuple(self._unpack(entry.turns))
+            self._remember_decoded(user_id, view)
+        else:
+            self._decoded.move_to_end(user_id)
+        # Вызывающий код может менять и список, и словари сообщений
+        return [dict(message) for message in view]
+
+    def _remember_decoded(self, user_id: int, view: Tuple[Dict, ...]):
+        if self.decoded_users <= 0:
+            return
+        self._decoded[user_id] = view
+        self._decoded.move_to_end(user_id)
+        while len(self._decoded) > self.decoded_users:
+            self._decoded.popitem(last=False)
+
+    def _insert(self, user_id: int, messages: List[Dict]):
+        old = self._hot.pop(user_id, None)
+        if old is not None:
+            self._hot_bytes -= old.size
+        entry = _Entry(self._pack(messages, old))
+        self._hot[user_id] = entry
+        self._hot_bytes += entry.size
+        # Только что записанная версия уже разобрана: следующий get() обойдется без распаковки
+        self._remember_decoded(user_id, tuple(dict(message) for message in messages))
+        self._evict()
+
+    def _evict(self):
+        """Вытеснить простаивающие и самые старые разговоры"""
+        now = time.monotonic()
+        while self._hot:
+            user_id, entry = next(iter(self._hot.items()))
+            if now - entry.touched > self.idle_ttl:
+                reason = "ttl"
+            elif self._hot_bytes > self.max_bytes and len(self._hot) > 1:
+                reason = "memory"
+            else:
+                break
+            # Несохраненные изменения остаются в _dirty до ближайшей записи
+            del self._hot[user_id]
+            self._decoded.pop(user_id, None)
+            self._hot_bytes -= entry.size
+            STORE_EVICTIONS.labels(reason=reason).inc()
+            if not self._evictions_warned and self._volatile():
+                self._evictions_warned = True
+                logger.warning(f"Разговор вытеснен из памяти ({reason}) без долговременного хранилища: "
+                               f"история потеряна; увеличьте CONVERSATION_CACHE_MB/CONVERSATION_IDLE_TTL "
+                               f"или задайте CONVERSATION_STORE=sqlite|redis")
+
+    def _volatile(self) -> bool:
+        """Вытесненная история нигде не хранится (бэкенд только в памяти)"""
+        backend = self.backend.inner if isinstance(self.backend, SnapshotBackend) else self.backend
+        return isinstance(backend, MemoryBackend)
+
+    def _schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_event = asyncio.Event()
+            self._flush_task = loop.create_task(self._flush_loop())
+        if len(self._dirty) + len(self._deleted) >= self.batch_size:
+            self._flush_event.set()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи истории разговоров: {e}")
+            if not self._dirty and not self._deleted:
+                # Нечего писать — задача завершится и перезапустится при следующем изменении
+                self._flush_task = None
+                return
+
+    async def flush(self):
+        """Записать все накопленные изменения в бэкенд"""
+        dirty, self._dirty = self._dirty, {}
+        deleted, self._deleted = self._deleted, set()
+        try:
+            if deleted:
+                await self.backend.delete_many(deleted)
+            if dirty:
+                await self.backend.save_many(dirty)
+        except BaseException:
+            # Возвращаем изменения в очередь, не затирая более свежие
+            for user_id in deleted:
+                if user_id not in self._dirty:
+                    self._deleted.add(user_id)
+            for user_id, messages in dirty.items():
+                if user_id not in self._deleted:
+                    self._dirty.setdefault(user_id, messages)
+            raise
+
+    def export_snapshot(self, path: str) -> int:
+        """
+        Записать снимок: разговоры из горячего кэша и неиспользованные записи прошлого снимка
+
+        Returns:
+            Число разговоров в снимке
+        """
+        previous = self.backend.snapshot if isinstance(self.backend, SnapshotBackend) else None
+        with SnapshotWriter(path, self.compression, self.min_compress_bytes) as writer:
+            for user_id, entry in list(self._hot.items()):
+                if entry.turns:
+                    # Сжатые ходы копируются как есть, сжимаются только ходы горячего окна.
+                    # Запись собирается целиком до записи в файл, поэтому ошибка в одном
+                    # разговоре не портит снимок остальных
+                    try:
+                        writer.add_turns(user_id, [(turn.role, turn.data, turn.packed, turn.tokens)
+                                                   for turn in entry.turns])
+                    except ValueError as e:
+                        logger.warning(f"Разговор {user_id} не попал в снимок: {e}")
+            if previous is not None:
+                writer.copy_from(previous, skip=set(self._hot))
+        return len(writer)
+
+    async def close(self):
+        """Записать изменения, снимок (если задан snapshot_path) и закрыть бэкенд"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        if self.snapshot_path:
+            started = time.perf_counter()
+            try:
+                count = self.export_snapshot(self.snapshot_path)
+            except Exception as e:
+                logger.error(f"Не удалось записать снимок разговоров {self.snapshot_path}: {e}")
+            else:
+                logger.info(f"Снимок разговоров {self.snapshot_path}: {count} разговоров "
+                            f"за {(time.perf_counter() - started) * 1000:.0f} мс")
+        await self.backend.close()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Горизонтальное масштабирование: диспетчер обновлений и воркеры
+
+Диспетчер (приемник вебхука или единственный поллер) закрепляет каждый чат
+за одним воркером по хешу chat_id и передает ему обновления через очередь:
+очереди multiprocessing на одном хосте или списки в Redis для нескольких
+машин. Обновления одного чата всегда попадают к одному воркеру в исходном
+порядке, поэтому история и очередь ходов чата остаются локальными.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import secrets
+from typing import Callable, Dict, List, Optional
+
+from telegram import Bot, Update
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+import startup
+from metrics import Counter, Gauge
+from telegram_outbox import retry_seconds
+from web_server import BotWebServer, wait_for_stop_signal
+
+logger = logging.getLogger(__name__)
+
+DISPATCHED_UPDATES = Counter("hr_bot_dispatched_updates_total", "Обновления, переданные воркерам", ["worker"])
+WORKERS_ALIVE = Gauge("hr_bot_workers_alive", "Работающие процессы-воркеры")
+WORKER_RESTARTS = Counter("hr_bot_worker_restarts_total", "Перезапуски упавших воркеров")
+DISPATCH_ERRORS = Counter("hr_bot_dispatch_errors_total", "Ошибки передачи обновлений воркерам", ["type"])
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Консистентный хеш Lamping–Veach: при изменении числа воркеров переезжает минимум чатов"""
+    result, candidate = -1, 0
+    while candidate < buckets:
+        result = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((result + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return result
+
+
+def worker_for(chat_id: int, workers: int) -> int:
+    """Номер воркера, за которым закреплен чат"""
+    digest = hashlib.blake2b(str(chat_id).encode(), digest_size=8).digest()
+    return jump_hash(int.from_bytes(digest, "little"), workers)
+
+
+def chat_id_of(data: Dict) -> int:
+    """ID чата (или пользователя) из JSON обновления Telegram"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        sender = value.get("from")
+        if sender and "id" in sender:
+            return sender["id"]
+    return 0
+
+
+class UpdateTransport:
+    """Очереди обновлений к воркерам"""
+
+    async def put(self, worker: int, data: Dict):
+        """Поставить обновление в очередь воркера"""
+        raise NotImplementedError
+
+    async def get(self, worker: int, timeout: float = 1.0) -> Optional[Dict]:
+        """Взять следующее обновление воркера или None, если за timeout ничего не пришло"""
+        raise NotImplementedError
+
+    async def close(self):
+        """Освободить ресурсы"""
+
+
+class ProcessTransport(UpdateTransport):
+    """Очереди multiprocessing: диспетчер и воркеры — процессы одного хоста"""
+
+    def __init__(self, workers: int):
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue() for _ in range(workers)]
+
+    async def put(self, worker: int, data: Dict):
+        # Очередь неограниченная: put не блокирует, запись в pipe идет в фоновом потоке
+        self.queues[worker].put_nowait(json.dumps(data, ensure_ascii=False))
+
+    async def get(self, worker: int, timeout: float = 1.0) -> Optional[Dict]:
+        try:
+            item = await asyncio.to_thread(self.queues[worker].get, True, timeout)
+        except queue.Empty:
+            return None
+        return json.loads(item)
+
+
+class RedisTransport(UpdateTransport):
+    """
+    Списки в Redis-совместимом сервере: диспетчер и воркеры на разных машинах.
+
+    Клиент создается лениво в каждом процессе.
+    """
+
+    def __init__(self, url: str, key_prefix: str = "hr_bot:updates:"):
+        self.url = url
+        self.key_prefix = key_prefix
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis.asyncio as aioredis
+
+            self._client = aioredis.from_url(self.url)
+        return self._client
+
+    async def put(self, worker: int, data: Dict):
+        await self.client.lpush(f"{self.key_prefix}{worker}", json.dumps(data, ensure_ascii=False))
+
+    async def get(self, worker: int, timeout: float = 1.0) -> Optional[Dict]:
+        item = await self.client.brpop(f"{self.key_prefix}{worker}", timeout=max(1, int(timeout)))
+        if item is None:
+            return None
+        return json.loads(item[1])
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def transport_from_env(workers: int) -> UpdateTransport:
+    """Создать очереди к воркерам по переменной WORKER_QUEUE"""
+    kind = os.getenv("WORKER_QUEUE", "process").lower()
+    if kind == "process":
+        return ProcessTransport(workers)
+    if kind == "redis":
+        return RedisTransport(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    raise ValueError(f"Неизвестный тип очереди WORKER_QUEUE: {kind}")
+
+
+class Dispatcher:
+    """Распределение обновлений по воркерам с закреплением чатов"""
+
+    def __init__(self, transport: UpdateTransport, workers: int):
+        """
+        Args:
+            transport: Очереди к воркерам
+            workers: Число воркеров
+        """
+        if workers < 1:
+            raise ValueError("Число воркеров должно быть не меньше 1")
+        self.transport = transport
+        self.workers = workers
+        self._poll_task: Optional[asyncio.Task] = None
+
+    @property
+    def healthy(self) -> bool:
+        """Поллер (если он запущен) работает: иначе обновления никуда не доходят"""
+        return self._poll_task is None or not self._poll_task.done()
+
+    def start_polling(self, bot: Bot) -> asyncio.Task:
+        """Запустить poll() в фоне; падение задачи логируется и делает healthy ложным"""
+        self._poll_task = asyncio.create_task(self.poll(bot))
+        self._poll_task.add_done_callback(_log_poll_exit)
+        return self._poll_task
+
+    async def route(self, data: Dict):
+        """Передать обновление воркеру, за которым закреплен его чат"""
+        worker = worker_for(chat_id_of(data), self.workers)
+        await self.transport.put(worker, data)
+        DISPATCHED_UPDATES.labels(worker=worker).inc()
+
+    async def poll(self, bot: Bot, timeout: int = 30, retry_delay: float = 1.0, max_retry_delay: float = 30.0):
+        """
+        Единственный поллер: получать обновления getUpdates и раздавать воркерам
+
+        Если обновление не удалось передать (например, Redis недоступен),
+        передача повторяется с нарастающей паузой, а offset не сдвигается:
+        обновление не теряется и порядок в чате сохраняется.
+        """
+        await bot.delete_webhook()
+        offset = 0
+        failures = 0
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=offset, timeout=timeout, allowed_updates=Update.ALL_TYPES,
+                    read_timeout=timeout + 10,
+                )
+            except RetryAfter as e:
+                await asyncio.sleep(retry_seconds(e))
+                continue
+            except (NetworkError, TimedOut) as e:
+                logger.warning(f"Ошибка getUpdates: {e}")
+                await asyncio.sleep(retry_delay)
+                continue
+            for update in updates:
+                while True:
+                    try:
+                        await self.route(update.to_dict())
+                    except Exception as e:
+                        failures += 1
+                        delay = min(max_retry_delay, retry_delay * 2 ** (failures - 1))
+                        DISPATCH_ERRORS.labels(type=type(e).__name__).inc()
+                        logger.error(f"Не удалось передать обновление {update.update_id} воркеру: "
+                                     f"{type(e).__name__}: {e}, повтор через {delay:.0f} с")
+                        await asyncio.sleep(delay)
+                    else:
+                        failures = 0
+                        break
+                offset = update.update_id + 1
+
+
+def _log_poll_exit(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Поллер диспетчера остановился: {task.exception()!r}", exc_info=task.exception())
+
+
+class WorkerPool:
+    """Процессы-воркеры на этом хосте с перезапуском упавших"""
+
+    def __init__(self, target: Callable, transport: UpdateTransport, workers: int):
+        """
+        Args:
+            target: Функция процесса воркера (номер воркера, transport)
+            transport: Очереди к воркерам
+            workers: Число процессов
+        """
+        self.target = target
+        self.transport = transport
+        self.workers = workers
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: List[multiprocessing.Process] = []
+        WORKERS_ALIVE.set_function(lambda: sum(process.is_alive() for process in self._processes))
+
+    def _spawn(self, index: int) -> multiprocessing.Process:
+        process = self._context.Process(
+            target=self.target, args=(index, self.transport), name=f"hr-bot-worker-{index}"
+        )
+        process.start()
+        return process
+
+    def start(self):
+        self._processes = [self._spawn(index) for index in range(self.workers)]
+        logger.info(f"Запущено воркеров: {self.workers}")
+
+    async def supervise(self, interval: float = 5.0):
+        """Перезапускать воркеры, которые завершились с ошибкой"""
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logger.error(f"Воркер {index} завершился с кодом {process.exitcode}, перезапуск")
+                    WORKER_RESTARTS.inc()
+                    self._processes[index] = self._spawn(index)
+
+    async def stop(self, timeout: float = 30.0):
+        """Попросить воркеры завершиться (SIGTERM) и дождаться их"""
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                process.kill()
+
+
+async def run_dispatcher(bot: Bot, transport: UpdateTransport, workers: int, pool: Optional[WorkerPool] = None):
+    """
+    Диспетчер: вебхук (если задан WEBHOOK_URL) или поллинг, плюс health check и метрики на PORT
+
+    Args:
+        bot: Бот Telegram (только для getUpdates/setWebhook)
+        transport: Очереди к воркерам
+        workers: Число воркеров
+        pool: Локальные процессы-воркеры (None — воркеры запущены отдельно)
+    """
+    dispatcher = Dispatcher(transport, workers)
+    webhook_url = os.getenv("WEBHOOK_URL")
+    port = int(os.getenv("PORT", 8080))
+
+    if webhook_url:
+        webhook_path = os.getenv("WEBHOOK_PATH", "telegram")
+        secret_token = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+        server = BotWebServer(port, webhook_path=webhook_path, secret_token=secret_token,
+                              on_update=dispatcher.route)
+    else:
+        # Health check отвечает 503, если поллер остановился
+        server = BotWebServer(port, health_check=lambda: dispatcher.healthy)
+
+    tasks = []
+    if pool is not None:
+        pool.start()
+        tasks.append(asyncio.create_task(pool.supervise()))
+    await server.start()
+    try:
+        async with bot:
+            if webhook_url:
+                await bot.set_webhook(
+                    url=f"{webhook_url.rstrip('/')}/{webhook_path.strip('/')}",
+                    secret_token=secret_token,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+            else:
+                tasks.append(dispatcher.start_polling(bot))
+            logger.info(f"Диспетчер запущен: воркеров {workers}, режим {'вебхук' if webhook_url else 'поллинг'}")
+            startup.TIMER.report()
+
+            await wait_for_stop_signal()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await server.stop()
+        if pool is not None:
+            await pool.stop()
+        await transport.close()
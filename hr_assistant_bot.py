@@ -7,13 +7,31 @@ HR Assistant Telegram Bot
 """
 
 import os
+import asyncio
 import logging
-import re
-from typing import Dict, List
+import math
+import secrets
+import time
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 
+from dotenv import load_dotenv
+
+import startup
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+# Быстрый старт: порт health check/вебхука открывается до импорта тяжелых зависимостей
+if __name__ == "__main__" and startup.fast_start_enabled():
+    startup.open_port_early(int(os.getenv("PORT", 8080)))
+startup.TIMER.mark("port")
+
 import anthropic
-from telegram import Update
+startup.TIMER.mark("import anthropic")
+
+from telegram import Bot, Message, Update
+from telegram.request import BaseRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -21,228 +39,65 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-from dotenv import load_dotenv
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import threading
-
-# Загружаем переменные окружения из .env файла
-load_dotenv()
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+startup.TIMER.mark("import telegram")
+
+from chat_queue import ChatTurnQueue
+from context_window import ContextWindow, estimate_tokens, message_tokens
+from conversation_store import ConversationStore
+from dispatcher import UpdateTransport, WorkerPool, run_dispatcher, transport_from_env
+from http_pool import HttpPool
+from knowledge_base import KnowledgeBase
+from llm_client import (
+    ClaudeScheduler, LLMUnavailable, ResilientClaude, cacheable_system, min_cacheable_tokens, record_usage,
+    with_cache_breakpoint,
 )
+from markdown_cleaner import clean_markdown
+from metrics import Counter, Histogram
+from phase_router import PHASE_CONTINUATIONS, PhaseRouter, Route
+from prompts import CORE_PROMPT, SUMMARY_PROMPT, SYSTEM_PROMPT
+from rate_limiter import RATE_LIMITED, Admission, RateLimiter
+from response_cache import ResponseCache
+from structured_logging import log_context, setup_from_env as setup_logging, trace_id
+from telegram_outbox import PRIORITY_COMMAND, TelegramOutbox
+from telegram_stream import StreamingReply, send_message_parts, split_message
+from usage_ledger import UsageLedger, UsageRecord, format_stats
+from web_server import BotWebServer, wait_for_stop_signal
+startup.TIMER.mark("import bot modules")
+
+# Настройка логирования: JSON с полями обновления, запись в stderr из фонового потока
+setup_logging()
 logger = logging.getLogger(__name__)
 
-# Системный промпт для Claude
-SYSTEM_PROMPT = """# **РОЛЬ: Ассистент по управлению персоналом**
-
-Вы — опытный консультант по управлению людьми, который помогает руководителям эффективно работать со своими подчиненными, а также помогает подчиненным эффективно работаь со своими руководителями и коллегами. Ваша задача — давать краткие, практичные, применимые на практике рекомендации.
-
----
-
-## **ОБЛАСТИ ЭКСПЕРТИЗЫ:**
-
-- Мотивация сотрудников
-- Постановка задач и целей
-- Делегирование полномочий
-- Обратная связь (позитивная и конструктивная)
-- Развитие и рост сотрудников
-- Разрешение конфликтов
-- Управление производительностью
-- Адаптация новых сотрудников (onboarding)
-- Управление выгоранием и перегрузкой
-- Сложные разговоры (увольнения, понижения, отказы)
-- Удержание ключевых сотрудников
-
----
-
-## **БАЗОВЫЕ МОДЕЛИ И ФРЕЙМВОРКИ:**
-
-### **Модель PAEI Адизеса**
-Используйте для диагностики типа сотрудника и подбора подхода:
-- **P (Producer)** — Производитель: делает, достигает результатов, фокус на "что"
-- **A (Administrator)** — Администратор: систематизирует, организует, фокус на "как"
-- **E (Entrepreneur)** — Предприниматель: генерирует идеи, меняет, фокус на "зачем/что если"
-- **I (Integrator)** — Интегратор: объединяет команду, создает атмосферу, фокус на "кто"
-
-**Применение:** Определите доминирующий стиль сотрудника, чтобы правильно мотивировать, делегировать и давать обратную связь.
-
-### **Ситуационное лидерство Херси-Бланшара**
-Выбирайте стиль управления в зависимости от уровня зрелости сотрудника:
-
-**Уровень зрелости = Компетентность × Мотивация**
-
-- **S1 — Директивный** (Низкая компетентность + Низкая мотивация): Четкие инструкции, контроль, структура
-- **S2 — Наставнический** (Низкая компетентность + Высокая мотивация): Объяснения, обучение, поддержка
-- **S3 — Поддерживающий** (Высокая компетентность + Низкая мотивация): Вовлечение, обсуждение, вдохновение
-- **S4 — Делегирующий** (Высокая компетентность + Высокая мотивация): Автономия, доверие, минимальный контроль
-
-**Применение:** Перед рекомендациями оцените, на каком уровне находится сотрудник, и предложите соответствующий стиль.
-
----
-
-## **АЛГОРИТМ РАБОТЫ:**
-
-### **Шаг 0: Быстрая диагностика**
-Перед вопросами мысленно определите тип ситуации:
-- Проблема производительности vs. поведенческая проблема
-- Новый сотрудник vs. опытный
-- Острая ситуация vs. хроническая
-- Индивидуальная vs. командная проблема
-
-### **Шаг 1: Уточнение ситуации**
-Когда руководитель или сотрудник обращается с проблемой, задайте **по одному вопросу за раз**, дожидайтесь ответа:
-
-**Базовые вопросы:**
-1. Что уже было предпринято?
-2. Как долго длится ситуация?
-3. Какова специфика сотрудника / руководителя (опыт, роль, особенности)?
-4. Каков желаемый результат?
-
-**Контекстные вопросы (при необходимости):**
-- Размер вашей команды?
-- Ваш опыт в роли руководителя (новый/опытный)?
-- Есть ли ограничения (политика компании, сроки, бюджет)?
-- Корпоративная культура (формальная/свободная, иерархичная/плоская)?
-
-### **Шаг 2: Анализ и рекомендации**
-
-После получения ответов предоставьте структурированный ответ:
-
-**1. ДИАГНОСТИКА (2-3 предложения)**
-- Корень проблемы
-- Тип сотрудника по PAEI (если применимо)
-- Уровень зрелости по Херси-Бланшару (S1/S2/S3/S4)
-
-**2. ПЛАН ДЕЙСТВИЙ**
-- Что конкретно сделать
-
-**3. ЧТО СКАЗАТЬ**
-Готовые формулировки или скрипты для разговора
-
-**4. ЧЕГО ИЗБЕГАТЬ**
-Топ-3 распространенные ошибки в данной ситуации
-
-**5. КРАСНЫЕ ФЛАГИ** (если применимо)
-Признаки, требующие немедленного внимания HR/юриста:
-- Угрозы, агрессия, конфликт интересов
-- Дискриминация, харассмент
-- Признаки выгорания или психологического кризиса
-- Нарушения этики/комплаенса
-
----
-
-## **БЫСТРЫЕ ШАБЛОНЫ**
-
-Для типовых ситуаций давайте готовые мини-скрипты:
-
-**Сложная обратная связь:**
-"[Имя], я хочу обсудить [конкретная ситуация]. Я заметил [факт без оценки]. Это влияет на [последствия]. Давай вместе разберемся, что происходит?"
-
-**Отказ в повышении/премии:**
-"Ценю твой вклад в [конкретные достижения]. Сейчас решение по повышению — [причина]. Чтобы двигаться к этой цели, нужно [конкретные шаги]. Готов поддержать тебя в этом."
-
-**Делегирование задачи:**
-"У меня есть задача [название]. Результат должен быть [описание]. Ресурсы: [что доступно]. Срок: [когда]. Что тебе нужно от меня для успеха?"
-
-**1-on-1 встреча:**
-"Три вопроса: Как у тебя дела? Что тебе сейчас нужно от меня? Что я могу сделать лучше как руководитель?"
-
----
-
-## **СТИЛЬ ОБЩЕНИЯ:**
-
-- Общайтесь в пользователем на "вы"
-- Пишите конкретно и по делу — никакой воды
-- Давайте примеры фраз и действий, а не абстрактные советы
-- Будьте эмпатичным к обеим сторонам (руководителю и сотруднику)
-- Учитывайте реальность бизнеса (сроки, ресурсы, политику компании)
-- Если ситуация требует вмешательства HR или юриста — скажите об этом прямо
-- Фокус на быстрых точечных решениях
-- **НЕ используйте markdown форматирование**: не используйте ** для жирного текста, * для курсива, # для заголовков, ``` для кода. Пишите обычным текстом.
-- Для выделения используйте ЗАГЛАВНЫЕ БУКВЫ или "кавычки"
-- Для списков используйте простые маркеры: •, -, цифры
-
----
-
-## **ВАЖНЫЕ ПРИНЦИПЫ:**
-
-1. **Каждый сотрудник уникален** — нет универсальных решений
-2. **Сначала понять, потом действовать** — диагностика важнее скорости
-3. **Фокус на поведении и результатах**, а не на личности
-4. **Развитие важнее наказания** — но есть ситуации, требующие жестких мер
-5. **Документирование важных разговоров** — хорошая практика (особенно при проблемах)
-6. **Баланс между срочностью бизнеса и развитием людей** — помогай руководителю найти эту грань
-7. **Адаптируйте стиль под ситуацию** — используй модели PAEI и Херси-Бланшара
-
----
-
-## **НАЧАЛО РАБОТЫ:**
-
-Начинайте работу после того, как пользователь опишет свою ситуацию. 
-
-**Задавайте вопросы по одному за раз, дожидайся ответа, затем следующий вопрос.**"""
+# Метрики этапов обработки сообщения
+HANDLE_MESSAGE_SECONDS = Histogram(
+    "hr_bot_handle_message_seconds", "Полное время обработки сообщения пользователя", ["mode"]
+)
+RESPONSE_PARTS = Histogram(
+    "hr_bot_response_parts", "Число сообщений Telegram, на которые разбит ответ", ["mode"],
+    buckets=(1, 2, 3, 4, 6, 8),
+)
+ERRORS = Counter("hr_bot_errors_total", "Ошибки по этапам и типам исключений", ["stage", "type"])
 
 
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    """HTTP handler для health checks облачных платформ"""
-    
-    def do_GET(self):
-        """Обработка GET запросов для проверки здоровья"""
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'HR Assistant Bot is running')
-    
-    def log_message(self, format, *args):
-        """Отключаем логирование health check запросов"""
-        pass
+def apology_for(error: Exception) -> str:
+    """Текст для пользователя, когда ответ Claude получить не удалось"""
+    if isinstance(error, (LLMUnavailable, anthropic.RateLimitError, anthropic.InternalServerError,
+                          anthropic.APIConnectionError, asyncio.TimeoutError)):
+        return "⏳ Сервис ответов сейчас перегружен. Пожалуйста, повторите через минуту."
+    return "Извините, произошла ошибка при обработке вашего запроса. Попробуйте еще раз."
 
 
 def start_health_server():
-    """Запуск HTTP сервера для health checks"""
+    """Запуск HTTP сервера для health checks (или перевод порта, открытого при быстром старте, в рабочий режим)"""
     port = int(os.getenv('PORT', 8080))
     try:
-        server = HTTPServer(('0.0.0.0', port), HealthCheckHandler)
-        thread = threading.Thread(target=server.serve_forever, daemon=True)
-        thread.start()
+        server = startup.take_early_server(port) or startup.EarlyServer(port)
+        server.set_ready()
         logger.info(f"Health check server started on port {port}")
     except Exception as e:
         logger.warning(f"Could not start health check server: {e}")
 
 
-def clean_markdown(text: str) -> str:
-    """Удаляет markdown форматирование из текста для чистого отображения в Telegram"""
-    try:
-        # Удаляем жирный текст (**text** или __text__)
-        text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)
-        text = re.sub(r'__(.+?)__', r'\1', text)
-        
-        # Удаляем курсив простым способом
-        text = text.replace('*', '')
-        text = text.replace('_', '')
-        
-        # Удаляем заголовки (# ## ### и т.д.)
-        text = re.sub(r'^#{1,6}\s+', '', text, flags=re.MULTILINE)
-        
-        # Удаляем блоки кода
-        text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)
-        
-        # Удаляем инлайн код
-        text = re.sub(r'`([^`]+)`', r'\1', text)
-        
-        # Удаляем тильды
-        text = text.replace('~~', '')
-        
-        return text.strip()
-    except Exception as e:
-        # Если что-то пошло не так, вернем оригинальный текст
-        logger.warning(f"Error in clean_markdown: {e}")
-        return text
-
-
 class HRAssistantBot:
     """Класс для управления HR-ассистентом ботом"""
     
@@ -255,77 +110,375 @@ class HRAssistantBot:
             anthropic_api_key: API ключ Anthropic
         """
         self.telegram_token = telegram_token
-        self.anthropic_client = anthropic.Anthropic(api_key=anthropic_api_key)
+        
+        # Ограничение параллельных запросов к Claude со справедливой очередью по пользователям
+        self.llm_scheduler = ClaudeScheduler.from_env()
+        
+        # Пулы соединений: keep-alive между сообщениями, размер по параллельности, HTTP/2
+        self.http_pool = HttpPool.from_env()
+        # Запас на дублирующие запросы и краткие содержания сверх слотов планировщика
+        anthropic_pool_size = int(os.getenv("ANTHROPIC_POOL_SIZE", 2 * self.llm_scheduler.max_concurrency))
+        
+        # Повторы делает ResilientClaude, встроенные повторы SDK отключены
+        self.anthropic_client = anthropic.AsyncAnthropic(
+            api_key=anthropic_api_key, max_retries=0,
+            http_client=self.http_pool.client("anthropic", anthropic_pool_size),
+        )
+        self.llm = ResilientClaude.from_env(self.anthropic_client)
+        
+        # Кэширование промпта на стороне Anthropic: системный промпт и, опционально, префикс истории
+        self.prompt_caching = os.getenv("PROMPT_CACHING", "1") == "1"
+        self.prompt_cache_history = os.getenv("PROMPT_CACHE_HISTORY", "0") == "1"
+        
+        # Потоковый вывод ответа с редактированием сообщения не чаще раза в STREAM_EDIT_INTERVAL секунд
+        self.stream_responses = os.getenv("STREAM_RESPONSES", "0") == "1"
+        self.stream_edit_interval = float(os.getenv("STREAM_EDIT_INTERVAL", 1.0))
+        
+        # Все вызовы Bot API идут через общую очередь с учетом лимитов Telegram
+        self.outbox = TelegramOutbox.from_env()
         
         # Хранилище истории разговоров по пользователям
-        self.conversations: Dict[int, List[Dict]] = {}
+        self.conversation_store = ConversationStore.from_env()
+        
+        # Окно контекста: бюджет токенов на историю и краткое содержание старых ходов
+        self.context_window = ContextWindow.from_env(summarizer=self.summarize_history)
         
-    def get_conversation_history(self, user_id: int) -> List[Dict]:
+        # Очередь ходов по чатам: склейка сообщений подряд и строгий порядок обработки
+        self.chat_queue = ChatTurnQueue.from_env(self.process_turn)
+        
+        # Лимиты запросов и токенов на пользователя и на весь бот
+        self.rate_limiter = RateLimiter.from_env()
+        self.output_tokens_estimate = int(os.getenv("RATE_LIMIT_OUTPUT_ESTIMATE", 1000))
+        
+        # База знаний: краткий промпт и подобранные к ситуации фрагменты (включается KNOWLEDGE_RETRIEVAL=1)
+        self.knowledge = KnowledgeBase.from_env()
+        if self.knowledge is not None:
+            self.system_prompt = CORE_PROMPT
+            prompt_parts = (CORE_PROMPT, self.knowledge.fingerprint)
+            # Фрагменты базы — русский текст, около 2 символов на токен
+            self.system_prompt_tokens = estimate_tokens(CORE_PROMPT) + self.knowledge.max_chars // 2
+        else:
+            self.system_prompt = SYSTEM_PROMPT
+            prompt_parts = (SYSTEM_PROMPT,)
+            self.system_prompt_tokens = estimate_tokens(SYSTEM_PROMPT)
+        
+        # Кэш создается, только если префикс не короче минимума модели (у claude-haiku-4-5 — 4096 токенов)
+        self.static_prompt_tokens = estimate_tokens(self.system_prompt)
+        minimum = min_cacheable_tokens(self.llm.model)
+        if self.prompt_caching and self.static_prompt_tokens < minimum:
+            logger.info(
+                f"Системный промпт (~{self.static_prompt_tokens} токенов) короче минимума кэширования "
+                f"{self.llm.model} ({minimum}): "
+                + ("кэшируется только префикс истории от этой длины" if self.prompt_cache_history
+                   else "кэш промпта не создается, включите PROMPT_CACHE_HISTORY=1")
+            )
+        
+        # Модель и max_tokens по фазе разговора: уточняющие вопросы или рекомендации (включается PHASE_ROUTING=1)
+        self.phase_router = PhaseRouter.from_env(self.llm.model, self.llm.max_tokens)
+        if self.phase_router is not None:
+            prompt_parts += (self.phase_router.fingerprint,)
+        
+        # Кэш ответов на первые сообщения (включается RESPONSE_CACHE=1)
+        self.response_cache = ResponseCache.from_env(*prompt_parts, self.llm.model, str(self.llm.max_tokens))
+        
+        # Журнал расхода токенов и дневные бюджеты (включается USAGE_LEDGER=1)
+        self.usage_ledger = UsageLedger.from_env()
+        self.admin_ids = {int(value) for value in os.getenv("ADMIN_USER_IDS", "").split(",") if value.strip()}
+        
+        # Фоновое открытие соединения с API после запуска (см. post_init)
+        self._warm_up_task: Optional[asyncio.Task] = None
+        
+    async def get_conversation_history(self, user_id: int) -> List[Dict]:
         """Получить историю разговора пользователя"""
-        if user_id not in self.conversations:
-            self.conversations[user_id] = []
-        return self.conversations[user_id]
+        return await self.conversation_store.get(user_id)
     
-    def add_message_to_history(self, user_id: int, role: str, content: str):
+    async def add_message_to_history(self, user_id: int, role: str, content: str):
         """Добавить сообщение в историю"""
-        if user_id not in self.conversations:
-            self.conversations[user_id] = []
+        history = await self.conversation_store.get(user_id)
         
-        self.conversations[user_id].append({
+        history.append({
             "role": role,
             "content": content
         })
         
-        # Ограничиваем историю последними 20 сообщениями (10 пар)
-        if len(self.conversations[user_id]) > 20:
-            self.conversations[user_id] = self.conversations[user_id][-20:]
+        # Ограничиваем историю бюджетом токенов; вытесненные ходы сворачиваются в фоне
+        history, dropped = self.context_window.trim(history)
+        
+        await self.conversation_store.put(user_id, history)
+        self.context_window.schedule_summary(
+            user_id, dropped, self.conversation_store.get, self.conversation_store.put
+        )
     
-    def clear_conversation(self, user_id: int):
+    async def clear_conversation(self, user_id: int):
         """Очистить историю разговора"""
-        self.conversations[user_id] = []
+        # Ответ на устаревший разговор уже не нужен
+        self.chat_queue.cancel(user_id)
+        self.context_window.cancel(user_id)
+        await self.conversation_store.clear(user_id)
+    
+    async def summarize_history(self, user_id: int, previous_summary: str, dropped: List[Dict]) -> str:
+        """
+        Обновить краткое содержание разговора с учетом вытесненных сообщений
+        
+        Args:
+            user_id: ID пользователя Telegram
+            previous_summary: Текущее краткое содержание (может быть пустым)
+            dropped: Сообщения, вытесненные из окна контекста
+            
+        Returns:
+            Новое краткое содержание
+        """
+        transcript = "\n\n".join(
+            f"{'Руководитель' if message['role'] == 'user' else 'Консультант'}: {message['content']}"
+            for message in dropped
+        )
+        prompt = (
+            f"Текущее краткое содержание:\n{previous_summary or '(пока нет)'}\n\n"
+            f"Новые реплики:\n{transcript}"
+        )
+        
+        async with self.llm_scheduler.slot(user_id):
+            started = time.perf_counter()
+            response = await self.llm.create({
+                "model": self.llm.model,
+                "max_tokens": 512,
+                "system": SUMMARY_PROMPT,
+                "messages": [{"role": "user", "content": prompt}],
+            }, mode="summary")
+        
+        self._log_usage(user_id, response, "summary", time.perf_counter() - started)
+        return response.content[0].text.strip()
+    
+    async def is_first_turn(self, user_id: int) -> bool:
+        """Первое сообщение разговора, ответ на которое можно кэшировать"""
+        return self.response_cache is not None and not await self.get_conversation_history(user_id)
+    
+    async def get_cached_response(self, user_id: int, user_message: str) -> Optional[str]:
+        """
+        Найти готовый ответ на первое сообщение разговора
+        
+        При попадании вопрос и ответ записываются в историю, как после обычного запроса.
+        """
+        if not await self.is_first_turn(user_id):
+            return None
+        response = self.response_cache.get(user_message)
+        if response is not None:
+            logger.info(f"Ответ для {user_id} взят из кэша первых сообщений", extra={"event": "cache"})
+            await self.add_message_to_history(user_id, "user", user_message)
+            await self.add_message_to_history(user_id, "assistant", response)
+        return response
+    
+    async def admit_request(self, user_id: int, user_message: str) -> Admission:
+        """
+        Проверить, можно ли сейчас отправить запрос к Claude
+        
+        При перегрузке очереди запрос отклоняется сразу, иначе списываются
+        лимиты пользователя и бота по числу запросов и оценке токенов.
+        """
+        if self.llm_scheduler.overloaded:
+            RATE_LIMITED.labels(reason="overload").inc()
+            return Admission(False, math.ceil(self.llm_scheduler.estimated_wait()), "overload")
+        
+        history = await self.get_conversation_history(user_id)
+        estimated_tokens = (
+            self.system_prompt_tokens
+            + sum(message_tokens(message) for message in history)
+            + estimate_tokens(user_message)
+            + self.output_tokens_estimate
+        )
+        return await self.rate_limiter.admit(user_id, estimated_tokens)
+    
+    async def _build_claude_request(self, user_id: int, user_message: str,
+                                    max_tokens: Optional[int] = None) -> Tuple[Dict, Optional[Route]]:
+        """
+        Добавить сообщение пользователя в историю и собрать параметры запроса к Claude
+
+        Returns:
+            (параметры запроса, решение маршрутизатора фаз или None, если он выключен)
+        """
+        # Добавляем сообщение пользователя в историю
+        await self.add_message_to_history(user_id, "user", user_message)
+        
+        # Получаем историю разговора
+        conversation_history = await self.get_conversation_history(user_id)
+        summary, messages = self.context_window.request_parts(conversation_history)
+        
+        route = None
+        model, max_tokens = self.llm.model, max_tokens or self.llm.max_tokens
+        if self.phase_router is not None:
+            route = self.phase_router.route(conversation_history, max_tokens)
+            model, max_tokens = route.model, route.max_tokens
+            logger.info(
+                f"Фаза разговора {user_id}: {route.phase} ({route.reason}), {model}, max_tokens={max_tokens}",
+                extra={"event": "phase", "phase": route.phase, "reason": route.reason, "model": model},
+            )
+        
+        # Содержание меняется только при сворачивании истории, поэтому идет в системный промпт
+        # после кэшируемого блока. Справочные материалы меняются каждый ход и добавляются к
+        # текущему сообщению: в системном промпте они сбрасывали бы кэш префикса истории
+        system = [{"type": "text", "text": self.system_prompt}]
+        if summary:
+            system.append({"type": "text", "text": f"КРАТКОЕ СОДЕРЖАНИЕ ПРЕДЫДУЩЕЙ ЧАСТИ РАЗГОВОРА:\n{summary}"})
+        if self.knowledge is not None:
+            context = self.knowledge.context(self._knowledge_query(conversation_history))
+            if context:
+                messages[-1] = {"role": "user", "content": [
+                    {"type": "text", "text": context}, {"type": "text", "text": messages[-1]["content"]},
+                ]}
+        
+        if self.prompt_caching:
+            # Граница кэша ставится, только если префикс до нее не короче минимума модели
+            minimum = min_cacheable_tokens(model)
+            if self.static_prompt_tokens >= minimum:
+                system[0] = cacheable_system(self.system_prompt)[0]
+            # Префикс истории — до предыдущего ответа: на следующем ходе он совпадет целиком
+            prefix_tokens = self.static_prompt_tokens + sum(map(message_tokens, conversation_history[:-1]))
+            if self.prompt_cache_history and len(messages) > 1 and prefix_tokens >= minimum:
+                messages = with_cache_breakpoint(messages, -2)
+        
+        return {
+            "model": model,
+            "max_tokens": max_tokens,
+            "system": system,
+            "messages": messages,
+        }, route
     
-    async def get_claude_response(self, user_id: int, user_message: str) -> str:
+    @staticmethod
+    def _continuation(request: Dict, route: Optional[Route], response) -> Optional[Dict]:
+        """
+        Запрос на продолжение уточняющего ответа, упершегося в лимит фазы
+
+        Модель могла сразу перейти к рекомендациям: вместо обрезанного ответа
+        он дописывается с того же места (начало ответа передается как префикс).
+        """
+        if route is None or route.extra_tokens <= 0 or response.stop_reason != "max_tokens":
+            return None
+        partial = "".join(block.text for block in response.content if block.type == "text").rstrip()
+        if not partial:
+            return None
+        PHASE_CONTINUATIONS.labels(model=response.model).inc()
+        return dict(request, max_tokens=route.extra_tokens,
+                    messages=request["messages"] + [{"role": "assistant", "content": partial}])
+    
+    @staticmethod
+    def _knowledge_query(history: List[Dict], user_turns: int = 3) -> str:
+        """Запрос к базе знаний: последние реплики пользователя (ситуация обычно описана в начале)"""
+        recent = [message["content"] for message in history if message["role"] == "user"][-user_turns:]
+        return "\n".join(content for content in recent if isinstance(content, str))
+    
+    def _log_usage(self, user_id: int, response, mode: str, latency: float, route: Optional[Route] = None):
+        """Учесть и залогировать токены ответа, записать расход в журнал"""
+        usage = record_usage(response.usage)
+        logger.info(
+            f"Токены для {user_id}: input={usage['input']}, output={usage['output']}, "
+            f"cache_read={usage['cache_read']}, cache_creation={usage['cache_creation']}"
+            + (f", фаза {route.phase}, {response.model}, {latency:.2f} с" if route is not None else ""),
+            extra={"event": "tokens", "mode": mode, "model": response.model, "latency": round(latency, 3),
+                   "input_tokens": usage["input"], "output_tokens": usage["output"]},
+        )
+        if route is not None:
+            PhaseRouter.observe(route, response.model, latency, usage["output"])
+        if self.usage_ledger is not None:
+            self.usage_ledger.record(UsageRecord(
+                user_id, mode, response.model, usage["input"], usage["output"],
+                usage["cache_read"], usage["cache_creation"], latency,
+            ))
+    
+    async def get_claude_response(self, user_id: int, user_message: str, max_tokens: Optional[int] = None) -> str:
         """
         Получить ответ от Claude
         
         Args:
             user_id: ID пользователя Telegram
             user_message: Сообщение пользователя
+            max_tokens: Ограничение длины ответа (по умолчанию CLAUDE_MAX_TOKENS)
             
         Returns:
             Ответ Claude
         """
         try:
-            # Добавляем сообщение пользователя в историю
-            self.add_message_to_history(user_id, "user", user_message)
+            first_turn = await self.is_first_turn(user_id)
+            request, route = await self._build_claude_request(user_id, user_message, max_tokens)
             
-            # Получаем историю разговора
-            conversation_history = self.get_conversation_history(user_id)
+            # Отправляем запрос к Claude, не блокируя event loop
+            async with self.llm_scheduler.slot(user_id):
+                started = time.perf_counter()
+                response = await self.llm.create(request)
             
-            # Отправляем запрос к Claude
-            response = self.anthropic_client.messages.create(
-                model="claude-haiku-4-5-20251001",
-                max_tokens=4096,
-                system=SYSTEM_PROMPT,
-                messages=conversation_history
-            )
+            self._log_usage(user_id, response, "sync", time.perf_counter() - started, route)
             
             # Извлекаем ответ
             assistant_message = response.content[0].text
             
+            continuation = self._continuation(request, route, response)
+            if continuation is not None:
+                async with self.llm_scheduler.slot(user_id):
+                    started = time.perf_counter()
+                    response = await self.llm.create(continuation)
+                self._log_usage(user_id, response, "sync", time.perf_counter() - started, route)
+                assistant_message = continuation["messages"][-1]["content"] + response.content[0].text
+            
             # Очищаем от markdown форматирования для чистого текста в Telegram
             assistant_message = clean_markdown(assistant_message)
             
             # Добавляем ответ ассистента в историю
-            self.add_message_to_history(user_id, "assistant", assistant_message)
+            await self.add_message_to_history(user_id, "assistant", assistant_message)
+            if first_turn:
+                self.response_cache.put(user_message, assistant_message)
+            
+            return assistant_message
+            
+        except Exception as e:
+            ERRORS.labels(stage="claude", type=type(e).__name__).inc()
+            logger.error(f"Ошибка при получении ответа от Claude: {type(e).__name__}: {e}", exc_info=e)
+            return apology_for(e)
+    
+    async def stream_claude_response(self, user_id: int, user_message: str, reply_to: Message,
+                                     max_tokens: Optional[int] = None) -> str:
+        """
+        Получить ответ от Claude потоком, показывая его в Telegram по мере генерации
+        
+        Args:
+            user_id: ID пользователя Telegram
+            user_message: Сообщение пользователя
+            reply_to: Сообщение, на которое отправляется ответ
+            max_tokens: Ограничение длины ответа (по умолчанию CLAUDE_MAX_TOKENS)
+            
+        Returns:
+            Окончательный очищенный ответ
+        """
+        reply = StreamingReply(reply_to, self.outbox, min_interval=self.stream_edit_interval)
+        try:
+            first_turn = await self.is_first_turn(user_id)
+            request, route = await self._build_claude_request(user_id, user_message, max_tokens)
+            
+            async with self.llm_scheduler.slot(user_id):
+                started = time.perf_counter()
+                final_message = await self.llm.stream(request, reply.feed)
+            
+            self._log_usage(user_id, final_message, "stream", time.perf_counter() - started, route)
             
+            # Продолжение дописывается в то же сообщение после уже показанного текста
+            continuation = self._continuation(request, route, final_message)
+            if continuation is not None:
+                async with self.llm_scheduler.slot(user_id):
+                    started = time.perf_counter()
+                    final_message = await self.llm.stream(continuation, reply.feed)
+                self._log_usage(user_id, final_message, "stream", time.perf_counter() - started, route)
+            
+            assistant_message = await reply.finish()
+            RESPONSE_PARTS.labels(mode="stream").observe(len(reply.messages))
+            await self.add_message_to_history(user_id, "assistant", assistant_message)
+            if first_turn:
+                self.response_cache.put(user_message, assistant_message)
             return assistant_message
             
         except Exception as e:
-            logger.error(f"Ошибка при получении ответа от Claude: {e}")
-            logger.error(f"Тип ошибки: {type(e).__name__}")
-            logger.error(f"Детали: {str(e)}")
-            return "Извините, произошла ошибка при обработке вашего запроса. Попробуйте еще раз."
+            ERRORS.labels(stage="claude_stream", type=type(e).__name__).inc()
+            logger.error(f"Ошибка при потоковом получении ответа от Claude: {type(e).__name__}: {e}", exc_info=e)
+            apology = apology_for(e)
+            await self.outbox.reply_text(reply_to, apology, priority=PRIORITY_COMMAND)
+            return apology
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
@@ -333,7 +486,7 @@ class HRAssistantBot:
         user_id = user.id
         
         # Очищаем историю при старте
-        self.clear_conversation(user_id)
+        await self.clear_conversation(user_id)
         
         welcome_message = (
             f"👋 Здравствуйте, {user.first_name}!\n\n"
@@ -353,8 +506,8 @@ class HRAssistantBot:
             "Давайте начнем! Какая ситуация вас беспокоит?"
         )
         
-        await update.message.reply_text(welcome_message)
-        logger.info(f"Пользователь {user_id} ({user.username}) начал работу с ботом")
+        await self.outbox.reply_text(update.message, welcome_message, priority=PRIORITY_COMMAND)
+        logger.info(f"Пользователь {user_id} начал работу с ботом", extra={"username": user.username})
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /help"""
@@ -380,65 +533,193 @@ class HRAssistantBot:
             "Ситуационное лидерство Херси-Бланшара) для диагностики и рекомендаций."
         )
         
-        await update.message.reply_text(help_message)
+        await self.outbox.reply_text(update.message, help_message, priority=PRIORITY_COMMAND)
     
     async def new_conversation_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /new для начала нового разговора"""
         user_id = update.effective_user.id
-        self.clear_conversation(user_id)
+        await self.clear_conversation(user_id)
         
-        await update.message.reply_text(
+        await self.outbox.reply_text(
+            update.message,
             "✅ История разговора очищена. Начнем с начала!\n\n"
-            "Опишите новую ситуацию, с которой вам нужна помощь."
+            "Опишите новую ситуацию, с которой вам нужна помощь.",
+            priority=PRIORITY_COMMAND,
         )
         logger.info(f"Пользователь {user_id} начал новый разговор")
     
+    async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /stats (только для ADMIN_USER_IDS)"""
+        if update.effective_user.id not in self.admin_ids:
+            return
+        if self.usage_ledger is None:
+            text = "Учет расхода выключен (USAGE_LEDGER=1 включает его)."
+        else:
+            text = format_stats(await self.usage_ledger.stats(), self.usage_ledger.daily_tokens)
+        await self.outbox.reply_text(update.message, text, priority=PRIORITY_COMMAND)
+    
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик текстовых сообщений"""
         user = update.effective_user
         user_id = user.id
         user_message = update.message.text
         
-        logger.info(f"Сообщение от {user_id} ({user.username}): {user_message[:50]}...")
+        with log_context(trace_id=trace_id(update.update_id), update_id=update.update_id, user_id=user_id):
+            # Текст и имя попадают в лог замаскированными (LOG_REDACT=1)
+            logger.info(f"Сообщение от {user_id}", extra={
+                "event": "message", "text": user_message, "username": user.username,
+            })
+            
+            # Сообщения одного чата склеиваются и обрабатываются по очереди
+            await self.chat_queue.submit(user_id, user_message, update)
+    
+    async def process_turn(self, user_id: int, user_message: str, update: Update):
+        """
+        Обработать ход пользователя: одно или несколько склеенных сообщений
         
-        # Показываем индикатор печати
-        await update.message.chat.send_action("typing")
+        Args:
+            user_id: ID пользователя Telegram
+            user_message: Текст хода
+            update: Последнее обновление хода (на него отправляется ответ)
+        """
+        # Обработчик очереди чата живет дольше одного обновления, поэтому контекст задается заново
+        with log_context(trace_id=trace_id(update.update_id), update_id=update.update_id, user_id=user_id):
+            try:
+                await self._process_turn(user_id, user_message, update)
+            except asyncio.CancelledError:
+                logger.info(f"Ход пользователя {user_id} отменен")
+                raise
+            except Exception as e:
+                ERRORS.labels(stage="turn", type=type(e).__name__).inc()
+                logger.error(f"Ошибка при обработке хода {user_id}: {e}", exc_info=e)
+                await self.outbox.reply_text(
+                    update.message,
+                    "Извините, произошла ошибка. Попробуйте еще раз или используйте /new для начала нового разговора.",
+                    priority=PRIORITY_COMMAND,
+                )
+    
+    async def _process_turn(self, user_id: int, user_message: str, update: Update):
+        # Типовой первый вопрос отвечаем из кэша, не расходуя лимиты и запросы к Claude
+        started = time.perf_counter()
+        cached = await self.get_cached_response(user_id, user_message)
+        if cached is not None:
+            await self.send_response(update.message, cached, mode="cache")
+            HANDLE_MESSAGE_SECONDS.labels(mode="cache").observe(time.perf_counter() - started)
+            return
+        
+        admission = await self.admit_request(user_id, user_message)
+        if not admission.allowed:
+            logger.info(f"Запрос {user_id} отклонен ({admission.reason}), повтор через {admission.retry_after} с")
+            if admission.reason == "overload" or admission.reason.startswith("global"):
+                busy_message = "⏳ Сейчас много запросов. Пожалуйста, повторите через {} с."
+            else:
+                busy_message = "⏳ Слишком много сообщений подряд. Пожалуйста, повторите через {} с."
+            await self.outbox.reply_text(
+                update.message, busy_message.format(int(admission.retry_after)), priority=PRIORITY_COMMAND
+            )
+            return
         
-        # Получаем ответ от Claude
-        response = await self.get_claude_response(user_id, user_message)
+        # Дневной бюджет: ближе к концу ответы короче, после исчерпания — отказ до конца суток
+        max_tokens = None
+        if self.usage_ledger is not None:
+            budget = await self.usage_ledger.check(user_id, self.llm.max_tokens)
+            if not budget.allowed:
+                logger.info(f"Дневной бюджет {user_id} исчерпан ({budget.used} токенов)")
+                await self.outbox.reply_text(
+                    update.message,
+                    "📊 Дневной лимит консультаций исчерпан, он обновится в 00:00 UTC.\n\n"
+                    "Длинная история расходует лимит быстрее: начинайте новую тему командой /new.",
+                    priority=PRIORITY_COMMAND,
+                )
+                return
+            max_tokens = budget.max_tokens
         
-        # Telegram имеет ограничение на длину сообщения (4096 символов)
-        # Если ответ длиннее, разбиваем на части
-        if len(response) <= 4096:
-            await update.message.reply_text(response)
-        else:
-            # Разбиваем на части по 4000 символов
-            parts = [response[i:i+4000] for i in range(0, len(response), 4000)]
-            for part in parts:
-                await update.message.reply_text(part)
-                await update.message.chat.send_action("typing")
+        mode = "stream" if self.stream_responses else "sync"
+        with HANDLE_MESSAGE_SECONDS.labels(mode=mode).time():
+            # Показываем индикатор печати
+            await self.outbox.send_action(update.message, "typing")
+            
+            if self.stream_responses:
+                # Ответ появляется по мере генерации, разбивка на части — внутри StreamingReply
+                await self.stream_claude_response(user_id, user_message, update.message, max_tokens)
+                return
+            
+            # Получаем ответ от Claude
+            response = await self.get_claude_response(user_id, user_message, max_tokens)
+            await self.send_response(update.message, response, mode=mode)
+    
+    async def send_response(self, reply_to: Message, response: str, mode: str):
+        """Отправить готовый ответ, при необходимости разбив его на части"""
+        # Telegram ограничивает сообщение 4096 единицами UTF-16; режем по абзацам,
+        # строкам и предложениям, а части отправляем подряд без лишних send_action
+        parts = split_message(response) or [response]
+        RESPONSE_PARTS.labels(mode=mode).observe(len(parts))
+        await send_message_parts(self.outbox, reply_to, parts)
     
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик ошибок"""
-        logger.error(f"Произошла ошибка: {context.error}")
+        ERRORS.labels(stage="handler", type=type(context.error).__name__).inc()
+        logger.error(f"Произошла ошибка: {context.error}", exc_info=context.error)
         
         if update and update.effective_message:
-            await update.effective_message.reply_text(
-                "Извините, произошла ошибка. Попробуйте еще раз или используйте /new для начала нового разговора."
+            await self.outbox.reply_text(
+                update.effective_message,
+                "Извините, произошла ошибка. Попробуйте еще раз или используйте /new для начала нового разговора.",
+                priority=PRIORITY_COMMAND,
             )
     
-    def run(self):
-        """Запустить бота"""
-        # Запускаем health check сервер для облачных платформ (Render, Railway, etc.)
-        start_health_server()
+    async def post_init(self, application: Application):
+        """Бот готов принимать обновления: отчет о времени запуска и прогрев соединения с Claude"""
+        startup.TIMER.report()
+        self._warm_up_task = asyncio.create_task(self.llm.warm_up())
+    
+    async def post_stop(self, application: Application):
+        """Доотправить очередь исходящих сообщений, пока клиент Bot API еще открыт"""
+        await self.outbox.close()
+    
+    async def post_shutdown(self, application: Application):
+        """Сохранить накопленные изменения истории при остановке"""
+        await self.outbox.close()
+        await self.conversation_store.close()
+        await self.rate_limiter.close()
+        if self.usage_ledger is not None:
+            await self.usage_ledger.close()
+        await self.anthropic_client.close()
+    
+    def build_application(self, request: Optional[BaseRequest] = None) -> Application:
+        """
+        Создать приложение Telegram и зарегистрировать обработчики
         
-        # Создаем приложение
-        application = Application.builder().token(self.telegram_token).build()
+        Args:
+            request: Транспорт Bot API (по умолчанию — стандартный HTTPX);
+                нагрузочный тест подставляет сюда локальную заглушку
+        """
+        # Обновления обрабатываются параллельно, а нагрузку на Claude ограничивает llm_scheduler
+        builder = (
+            Application.builder()
+            .token(self.telegram_token)
+            .concurrent_updates(True)
+            .post_init(self.post_init)
+            .post_stop(self.post_stop)
+            .post_shutdown(self.post_shutdown)
+        )
+        if request is not None:
+            builder = builder.request(request).get_updates_request(request)
+        else:
+            builder = builder.request(self.http_pool.telegram_request(
+                int(os.getenv("TELEGRAM_POOL_SIZE", 32)), float(os.getenv("TELEGRAM_READ_TIMEOUT", 5.0)),
+            ))
+        api_url = os.getenv("TELEGRAM_API_URL")
+        if api_url:
+            # Локальный сервер Bot API (или заглушка нагрузочного теста)
+            builder = builder.base_url(f"{api_url.rstrip('/')}/bot").base_file_url(f"{api_url.rstrip('/')}/file/bot")
+        application = builder.build()
         
         # Регистрируем обработчики команд
         application.add_handler(CommandHandler("start", self.start_command))
         application.add_handler(CommandHandler("help", self.help_command))
         application.add_handler(CommandHandler("new", self.new_conversation_command))
+        application.add_handler(CommandHandler("stats", self.stats_command))
         
         # Регистрируем обработчик текстовых сообщений
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
@@ -446,11 +727,121 @@ class HRAssistantBot:
         # Регистрируем обработчик ошибок
         application.add_error_handler(self.error_handler)
         
+        return application
+    
+    async def run_webhook(self, application: Application, webhook_url: str):
+        """
+        Работа в режиме вебхука: обновления, health check и метрики
+        обслуживает один асинхронный HTTP сервер на порту PORT
+        
+        Args:
+            application: Приложение Telegram
+            webhook_url: Публичный адрес сервиса (например, https://hr-bot.onrender.com)
+        """
+        webhook_path = os.getenv("WEBHOOK_PATH", "telegram")
+        secret_token = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+        server = BotWebServer(
+            int(os.getenv('PORT', 8080)), application,
+            webhook_path=webhook_path, secret_token=secret_token,
+        )
+        
+        await server.start()
+        await application.initialize()
+        try:
+            await application.bot.set_webhook(
+                url=f"{webhook_url.rstrip('/')}/{webhook_path.strip('/')}",
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            await application.start()
+            await self.post_init(application)
+            logger.info("Бот запущен в режиме вебхука и готов к работе!")
+            
+            await wait_for_stop_signal()
+            
+            await application.stop()
+            await self.post_stop(application)
+        finally:
+            await server.stop()
+            await application.shutdown()
+            await self.post_shutdown(application)
+    
+    async def run_worker(self, transport: UpdateTransport, index: int):
+        """
+        Работа воркером за диспетчером: обновления приходят из очереди transport
+        
+        Args:
+            transport: Очереди от диспетчера
+            index: Номер воркера
+        """
+        application = self.build_application()
+        server = None
+        metrics_port = os.getenv("WORKER_METRICS_PORT")
+        if metrics_port:
+            # У каждого воркера свои метрики, порт сдвигается на номер воркера
+            server = BotWebServer(int(metrics_port) + index)
+            await server.start()
+        
+        await application.initialize()
+        await application.start()
+        await self.post_init(application)
+        logger.info(f"Воркер {index} запущен (PID {os.getpid()})")
+        stop = asyncio.ensure_future(wait_for_stop_signal())
+        try:
+            while not stop.done():
+                receive = asyncio.ensure_future(transport.get(index))
+                await asyncio.wait({receive, stop}, return_when=asyncio.FIRST_COMPLETED)
+                # При остановке запрос к очереди не отменяется: get в потоке (или BRPOP) мог уже
+                # забрать обновление. Дожидаемся его (не дольше таймаута get) и обрабатываем
+                # вместе с остальной очередью приложения — application.stop() ее дорабатывает
+                data = await receive
+                if data is not None:
+                    await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            stop.cancel()
+            await application.stop()
+            await self.post_stop(application)
+            await application.shutdown()
+            await self.post_shutdown(application)
+            await transport.close()
+            if server is not None:
+                await server.stop()
+    
+    def run(self):
+        """Запустить бота"""
+        application = self.build_application()
+        startup.TIMER.mark("application")
+        
+        webhook_url = os.getenv("WEBHOOK_URL")
+        if webhook_url:
+            asyncio.run(self.run_webhook(application, webhook_url))
+            return
+        
+        # Запускаем health check сервер для облачных платформ (Render, Railway, etc.)
+        start_health_server()
+        
         # Запускаем бота
         logger.info("Бот запущен и готов к работе!")
         application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
+def telegram_bot(telegram_token: str) -> Bot:
+    """Бот Telegram для диспетчера (учитывает TELEGRAM_API_URL)"""
+    api_url = os.getenv("TELEGRAM_API_URL")
+    if api_url:
+        return Bot(telegram_token, base_url=f"{api_url.rstrip('/')}/bot",
+                   base_file_url=f"{api_url.rstrip('/')}/file/bot")
+    return Bot(telegram_token)
+
+
+def run_worker_process(index: int, transport: UpdateTransport):
+    """Точка входа процесса-воркера (запускается диспетчером через multiprocessing)"""
+    # Номер воркера нужен настройкам, которые у каждого воркера свои (например, CONVERSATION_SNAPSHOT)
+    os.environ["WORKER_INDEX"] = str(index)
+    bot = HRAssistantBot(os.environ["TELEGRAM_BOT_TOKEN"], os.environ["ANTHROPIC_API_KEY"])
+    asyncio.run(bot.run_worker(transport, index))
+
+
 def main():
     """Главная функция"""
     # Получаем токены из переменных окружения
@@ -463,8 +854,23 @@ def main():
     if not anthropic_api_key:
         raise ValueError("Не установлена переменная окружения ANTHROPIC_API_KEY")
     
+    # BOT_ROLE: standalone — один процесс (по умолчанию), а при WORKERS > 1 — диспетчер
+    # с воркерами на этом хосте; dispatcher и worker — отдельные сервисы с очередью в Redis
+    role = os.getenv("BOT_ROLE", "standalone").lower()
+    workers = int(os.getenv("WORKERS", 1))
+    
+    if role == "dispatcher" or (role == "standalone" and workers > 1):
+        transport = transport_from_env(workers)
+        pool = WorkerPool(run_worker_process, transport, workers) if role == "standalone" else None
+        asyncio.run(run_dispatcher(telegram_bot(telegram_token), transport, workers, pool))
+        return
+    
     # Создаем и запускаем бота
     bot = HRAssistantBot(telegram_token, anthropic_api_key)
+    startup.TIMER.mark("clients")
+    if role == "worker":
+        asyncio.run(bot.run_worker(transport_from_env(workers), int(os.getenv("WORKER_INDEX", 0))))
+        return
     bot.run()
 
 
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Пулы HTTP-соединений для клиентов Anthropic и Telegram
+
+По умолчанию каждый клиент строит свой httpx с настройками по умолчанию:
+keep-alive всего 5 секунд, поэтому в спокойном чате почти каждое сообщение
+открывает новое TCP+TLS соединение. Здесь оба клиента получают пулы с
+общими настройками: размер по параллельности, длинный keep-alive, таймауты,
+HTTP/2 (если установлен пакет h2) и метрики переиспользования соединений.
+"""
+
+import functools
+import importlib.util
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+import httpx
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+HTTP_REQUESTS = Counter("hr_bot_http_requests_total", "HTTP-запросы клиентов API", ["client"])
+HTTP_CONNECTIONS = Counter(
+    "hr_bot_http_connections_total", "Новые соединения (остальные запросы идут по открытым)", ["client"]
+)
+HTTP_TLS_HANDSHAKES = Counter("hr_bot_http_tls_handshakes_total", "TLS-рукопожатия", ["client"])
+HTTP_CONNECT_SECONDS = Histogram(
+    "hr_bot_http_connect_seconds", "Время установки соединения по этапам", ["client", "stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+
+def _tracer(client: str):
+    """Обработчик событий httpcore для одного запроса: считает новые соединения и рукопожатия"""
+    started: Dict[str, float] = {}
+
+    async def trace(event: str, info: Dict):
+        if event == "connection.connect_tcp.started":
+            started["tcp"] = time.perf_counter()
+        elif event == "connection.connect_tcp.complete":
+            HTTP_CONNECTIONS.labels(client=client).inc()
+            HTTP_CONNECT_SECONDS.labels(client=client, stage="tcp").observe(time.perf_counter() - started["tcp"])
+        elif event == "connection.start_tls.started":
+            started["tls"] = time.perf_counter()
+        elif event == "connection.start_tls.complete":
+            HTTP_TLS_HANDSHAKES.labels(client=client).inc()
+            HTTP_CONNECT_SECONDS.labels(client=client, stage="tls").observe(time.perf_counter() - started["tls"])
+
+    return trace
+
+
+class HttpPool:
+    """Общие настройки пулов соединений и фабрики клиентов"""
+
+    def __init__(self, http2: bool = True, keepalive_expiry: float = 60.0, connect_timeout: float = 5.0,
+                 pool_timeout: float = 5.0):
+        """
+        Args:
+            http2: Использовать HTTP/2, если установлен пакет h2
+            keepalive_expiry: Сколько секунд держать простаивающее соединение открытым
+            connect_timeout: Таймаут установки соединения (секунды)
+            pool_timeout: Сколько ждать свободное соединение из пула (секунды)
+        """
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.info("HTTP/2 недоступен (нет пакета h2), используется HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self.keepalive_expiry = keepalive_expiry
+        self.connect_timeout = connect_timeout
+        self.pool_timeout = pool_timeout
+
+    @classmethod
+    def from_env(cls) -> "HttpPool":
+        """Создать настройки пулов из переменных окружения"""
+        return cls(
+            http2=os.getenv("HTTP2", "1") == "1",
+            keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60.0)),
+            connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", 5.0)),
+            pool_timeout=float(os.getenv("HTTP_POOL_TIMEOUT", 5.0)),
+        )
+
+    def limits(self, size: int) -> httpx.Limits:
+        """Лимиты пула: все соединения могут оставаться открытыми между запросами"""
+        return httpx.Limits(max_connections=size, max_keepalive_connections=size,
+                            keepalive_expiry=self.keepalive_expiry)
+
+    def timeout(self, read: Optional[float]) -> httpx.Timeout:
+        return httpx.Timeout(connect=self.connect_timeout, read=read, write=read, pool=self.pool_timeout)
+
+    def event_hooks(self, client: str) -> Dict:
+        """Хуки httpx: метрики запросов, подписка на события соединений и id запроса API в лог"""
+        async def on_request(request: httpx.Request):
+            HTTP_REQUESTS.labels(client=client).inc()
+            request.extensions["trace"] = _tracer(client)
+
+        async def on_response(response: httpx.Response):
+            # Anthropic возвращает request-id: по нему запрос находится в поддержке провайдера,
+            # а trace_id из контекста лога связывает его с обновлением Telegram
+            request_id = response.headers.get("request-id")
+            if request_id:
+                logger.info(
+                    f"{client}: {response.request.url.path} -> {response.status_code}",
+                    extra={"event": "api", "request_id": request_id, "status": response.status_code},
+                )
+
+        return {"request": [on_request], "response": [on_response]}
+
+    def client(self, name: str, size: int, read_timeout: Optional[float] = None) -> httpx.AsyncClient:
+        """
+        Клиент httpx для SDK (например, anthropic.AsyncAnthropic(http_client=...))
+
+        Args:
+            name: Имя клиента в метриках
+            size: Размер пула соединений
+            read_timeout: Таймаут чтения (None — без ограничения; SDK передает свой на каждый запрос)
+        """
+        return httpx.AsyncClient(
+            limits=self.limits(size),
+            timeout=self.timeout(read_timeout),
+            http2=self.http2,
+            event_hooks=self.event_hooks(name),
+        )
+
+    def telegram_request(self, size: int, read_timeout: float = 5.0):
+        """Транспорт Bot API для python-telegram-bot с настройками пула (telegram.request.HTTPXRequest)"""
+        return _pooled_httpx_request()(self, size, read_timeout)
+
+
+@functools.lru_cache(maxsize=None)
+def _pooled_httpx_request():
+    """
+    Класс HTTPXRequest с keep-alive и метриками.
+
+    Строится при первом обращении: модуль нужен и без python-telegram-bot
+    (batch_consult.py), а импорт telegram заметно удлиняет запуск.
+    """
+    from telegram.request import HTTPXRequest
+
+    class PooledHTTPXRequest(HTTPXRequest):
+        """
+        Свой AsyncClient строится в _build_client: так он переживает и
+        пересоздание клиента внутри python-telegram-bot (initialize после shutdown).
+        """
+
+        def __init__(self, pool: HttpPool, size: int, read_timeout: float):
+            self._pool = pool
+            self._size = size
+            super().__init__(
+                connection_pool_size=size,
+                read_timeout=read_timeout,
+                write_timeout=read_timeout,
+                connect_timeout=pool.connect_timeout,
+                pool_timeout=pool.pool_timeout,
+                http_version="2" if pool.http2 else "1.1",
+            )
+
+        def _build_client(self) -> httpx.AsyncClient:
+            kwargs = dict(self._client_kwargs, limits=self._pool.limits(self._size),
+                          event_hooks=self._pool.event_hooks("telegram"))
+            return httpx.AsyncClient(**kwargs)
+
+    return PooledHTTPXRequest
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Локальная база знаний: фреймворки, скрипты разговоров, политики
+
+Документы Markdown из каталога базы режутся на фрагменты по заголовкам и
+абзацам и индексируются BM25. В запрос к Claude попадают только несколько
+фрагментов, относящихся к ситуации, а не вся методичка в системном промпте.
+
+Инвертированный индекс хранится в плоских массивах (смещения, документы,
+частоты): с NumPy подсчет очков векторизован, а заранее собранный индекс
+открывается через memmap без чтения в память. Без NumPy работает тот же
+алгоритм на модуле array.
+
+Сборка индекса заранее:
+    python knowledge_base.py build knowledge knowledge.idx
+
+Индекс хранит отпечаток документов, по которым собран: если каталог базы
+с тех пор изменился, при запуске индекс собирается заново из документов.
+"""
+
+import argparse
+import array
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import sys
+import time
+from collections import Counter as TermCounter
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from metrics import Histogram
+
+try:
+    import numpy as np
+except ImportError:  # NumPy не обязателен
+    np = None
+
+logger = logging.getLogger(__name__)
+
+KNOWLEDGE_SEARCH_SECONDS = Histogram(
+    "hr_bot_knowledge_search_seconds", "Время поиска по базе знаний",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+)
+KNOWLEDGE_SNIPPETS = Histogram(
+    "hr_bot_knowledge_snippets", "Фрагменты базы знаний, добавленные в запрос", buckets=(0, 1, 2, 3, 5, 8),
+)
+
+INDEX_VERSION = 1
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge")
+
+_WORD = re.compile(r"\w+")
+_HEADING = re.compile(r"^(#{1,6})\s+(.*)$")
+# Грубый стемминг: русские словоформы чаще всего различаются окончанием
+_STEM_CHARS = 6
+_STOP_WORDS = frozenset("""
+а без более бы был была были было быть в вам вас весь во вот все всего всех вы где да даже для до его ее ей
+если есть еще же за здесь и из или им их к как какой когда кто ли либо мне может мы на над надо не него нее
+нет ни них но ну о об однако он она они оно от очень по под после при про с со так также такой там те тем
+то того тоже только том тот тут ты у уже чем что чтобы эта эти это этого этой этом этот я
+""".split())
+
+
+def terms(text: str) -> List[str]:
+    """Термы текста для индекса и запроса: нижний регистр, без стоп-слов, обрезка до основы"""
+    words = _WORD.findall(text.lower().replace("ё", "е"))
+    return [word[:_STEM_CHARS] for word in words if len(word) > 1 and word not in _STOP_WORDS]
+
+
+class Chunk(NamedTuple):
+    """Фрагмент документа"""
+    source: str  # файл относительно каталога базы
+    title: str  # заголовок документа и раздела
+    text: str
+
+
+def _clean_heading(text: str) -> str:
+    return text.strip().strip("*").strip()
+
+
+def chunk_markdown(source: str, text: str, max_chars: int = 800) -> List[Chunk]:
+    """
+    Разрезать Markdown на фрагменты по разделам
+
+    Раздел — текст под заголовком; длинный раздел делится по абзацам так,
+    чтобы фрагмент не превышал max_chars (абзац длиннее лимита не режется).
+    Каждый фрагмент знает заголовок документа и раздела: он участвует в
+    поиске и показывается Claude.
+    """
+    document = os.path.splitext(os.path.basename(source))[0]
+    sections: List[Tuple[str, List[str]]] = [("", [])]
+    for line in text.splitlines():
+        heading = _HEADING.match(line)
+        if heading:
+            # Заголовок первого уровня в начале файла — название документа
+            if len(heading.group(1)) == 1 and len(sections) == 1:
+                document = _clean_heading(heading.group(2))
+            sections.append((_clean_heading(heading.group(2)), []))
+        else:
+            sections[-1][1].append(line)
+
+    chunks: List[Chunk] = []
+    for heading, lines in sections:
+        title = document if heading in ("", document) else f"{document} — {heading}"
+        paragraphs = [paragraph.strip() for paragraph in "\n".join(lines).split("\n\n") if paragraph.strip()]
+        current: List[str] = []
+        for paragraph in paragraphs:
+            if current and sum(len(part) + 2 for part in current) + len(paragraph) > max_chars:
+                chunks.append(Chunk(source, title, "\n\n".join(current)))
+                current = []
+            current.append(paragraph)
+        if current:
+            chunks.append(Chunk(source, title, "\n\n".join(current)))
+    return chunks
+
+
+def _document_paths(directory: str) -> List[str]:
+    """Пути .md и .txt файлов каталога (рекурсивно, в стабильном порядке)"""
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        paths.extend(os.path.join(root, name) for name in sorted(files) if name.endswith((".md", ".txt")))
+    return paths
+
+
+def load_documents(directory: str, max_chars: int = 800) -> List[Chunk]:
+    """Фрагменты всех .md и .txt файлов каталога (рекурсивно, в стабильном порядке)"""
+    chunks: List[Chunk] = []
+    for path in _document_paths(directory):
+        with open(path, encoding="utf-8") as file:
+            chunks.extend(chunk_markdown(os.path.relpath(path, directory), file.read(), max_chars))
+    return chunks
+
+
+def documents_digest(directory: str, max_chars: int = 800) -> Optional[str]:
+    """Отпечаток документов каталога и размера фрагментов; None, если каталога нет"""
+    if not os.path.isdir(directory):
+        return None
+    digest = hashlib.blake2b(f"{max_chars}".encode("ascii"), digest_size=16)
+    for path in _document_paths(directory):
+        digest.update(os.path.relpath(path, directory).encode("utf-8") + b"\x00")
+        with open(path, "rb") as file:
+            digest.update(hashlib.blake2b(file.read(), digest_size=16).digest())
+    return digest.hexdigest()
+
+
+class BM25Index:
+    """
+    Инвертированный индекс BM25 в плоских массивах.
+
+    Постинги терма t — срез [offsets[t], offsets[t + 1]) массивов doc_ids и
+    tfs. Для каждого терма заранее посчитан idf, для каждого фрагмента —
+    знаменатель нормализации длины, поэтому поиск — это сумма по постингам
+    термов запроса без обращения к самим документам.
+    """
+
+    _FILE_META = "index.json"
+    _FILE_POSTINGS = "postings.bin"
+
+    def __init__(self, chunks: List[Chunk], vocabulary: Dict[str, int], offsets, doc_ids, tfs, idf, norm,
+                 k1: float = 1.2, b: float = 0.75, source_digest: Optional[str] = None):
+        self.chunks = chunks
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.idf = idf
+        self.norm = norm
+        self.k1 = k1
+        self.b = b
+        # Отпечаток документов, по которым собран индекс (documents_digest)
+        self.source_digest = source_digest
+
+    @classmethod
+    def build(cls, chunks: List[Chunk], k1: float = 1.2, b: float = 0.75) -> "BM25Index":
+        """Построить индекс по фрагментам"""
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        lengths = []
+        for doc_id, chunk in enumerate(chunks):
+            counts = TermCounter(terms(f"{chunk.title}\n{chunk.text}"))
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((doc_id, tf))
+
+        count = len(chunks)
+        average = (sum(lengths) / count) if count else 1.0
+        vocabulary: Dict[str, int] = {}
+        offsets, doc_ids, tfs, idf = array.array("q", [0]), array.array("i"), array.array("f"), array.array("f")
+        for term in sorted(postings):
+            vocabulary[term] = len(vocabulary)
+            for doc_id, tf in postings[term]:
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+            offsets.append(len(doc_ids))
+            frequency = len(postings[term])
+            idf.append(math.log(1 + (count - frequency + 0.5) / (frequency + 0.5)))
+        norm = array.array("f", (k1 * (1 - b + b * length / (average or 1.0)) for length in lengths))
+        return cls._with_arrays(chunks, vocabulary, offsets, doc_ids, tfs, idf, norm, k1, b)
+
+    @classmethod
+    def _with_arrays(cls, chunks, vocabulary, offsets, doc_ids, tfs, idf, norm, k1, b) -> "BM25Index":
+        """С NumPy массивы оборачиваются в ndarray без копирования"""
+        if np is not None:
+            offsets, doc_ids, tfs, idf, norm = (
+                np.frombuffer(values, dtype=values.typecode) if isinstance(values, array.array) else values
+                for values in (offsets, doc_ids, tfs, idf, norm)
+            )
+        return cls(chunks, vocabulary, offsets, doc_ids, tfs, idf, norm, k1, b)
+
+    @property
+    def version(self) -> str:
+        """Отпечаток содержимого: меняется вместе с любым фрагментом базы"""
+        digest = hashlib.blake2b(digest_size=8)
+        for chunk in self.chunks:
+            digest.update("\x00".join(chunk).encode("utf-8"))
+            digest.update(b"\x01")
+        return digest.hexdigest()
+
+    def search(self, query: str, top_k: int = 3) -> List[Tuple[float, Chunk]]:
+        """Лучшие фрагменты по запросу: (очки BM25, фрагмент) по убыванию очков"""
+        term_ids = sorted({self.vocabulary[term] for term in terms(query) if term in self.vocabulary})
+        if not term_ids or top_k <= 0:
+            return []
+        if np is not None:
+            ranked = self._search_numpy(term_ids, top_k)
+        else:
+            ranked = self._search_python(term_ids, top_k)
+        return [(score, self.chunks[doc_id]) for doc_id, score in ranked if score > 0]
+
+    def _search_numpy(self, term_ids: Sequence[int], top_k: int) -> List[Tuple[int, float]]:
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        k1 = self.k1 + 1
+        for term_id in term_ids:
+            start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+            docs = self.doc_ids[start:end]
+            tf = self.tfs[start:end]
+            # Документы в постингах одного терма не повторяются, поэтому += без np.add.at
+            scores[docs] += self.idf[term_id] * tf * k1 / (tf + self.norm[docs])
+        if top_k < len(scores):
+            candidates = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            candidates = np.arange(len(scores))
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(doc_id), float(scores[doc_id])) for doc_id in candidates]
+
+    def _search_python(self, term_ids: Sequence[int], top_k: int) -> List[Tuple[int, float]]:
+        scores: Dict[int, float] = {}
+        k1 = self.k1 + 1
+        for term_id in term_ids:
+            idf = self.idf[term_id]
+            for position in range(self.offsets[term_id], self.offsets[term_id + 1]):
+                doc_id, tf = self.doc_ids[position], self.tfs[position]
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * k1 / (tf + self.norm[doc_id])
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+
+    def save(self, path: str):
+        """Сохранить индекс в каталог: index.json (словарь, фрагменты) и postings.bin (массивы)"""
+        os.makedirs(path, exist_ok=True)
+        meta = {
+            "version": INDEX_VERSION,
+            "byteorder": sys.byteorder,
+            "k1": self.k1,
+            "b": self.b,
+            "source_digest": self.source_digest,
+            "terms": sorted(self.vocabulary, key=self.vocabulary.get),
+            "postings": len(self.doc_ids),
+            "chunks": [list(chunk) for chunk in self.chunks],
+        }
+        with open(os.path.join(path, self._FILE_POSTINGS), "wb") as file:
+            for values in (self.offsets, self.doc_ids, self.tfs, self.idf, self.norm):
+                file.write(values.tobytes())
+        with open(os.path.join(path, self._FILE_META), "w", encoding="utf-8") as file:
+            json.dump(meta, file, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """Открыть индекс, сохраненный save(); с NumPy массивы отображаются в память (memmap)"""
+        with open(os.path.join(path, cls._FILE_META), encoding="utf-8") as file:
+            meta = json.load(file)
+        if meta.get("version") != INDEX_VERSION or meta.get("byteorder") != sys.byteorder:
+            raise ValueError(f"Индекс {path} собран другой версией или на другой платформе, пересоберите его")
+
+        chunks = [Chunk(*chunk) for chunk in meta["chunks"]]
+        vocabulary = {term: term_id for term_id, term in enumerate(meta["terms"])}
+        layout = (("q", len(vocabulary) + 1), ("i", meta["postings"]), ("f", meta["postings"]),
+                  ("f", len(vocabulary)), ("f", len(chunks)))
+        postings = os.path.join(path, cls._FILE_POSTINGS)
+        arrays = []
+        if np is not None:
+            offset = 0
+            for typecode, length in layout:
+                arrays.append(np.memmap(postings, dtype=typecode, mode="r", offset=offset, shape=(length,))
+                              if length else np.zeros(0, dtype=typecode))
+                offset += length * array.array(typecode).itemsize
+        else:
+            with open(postings, "rb") as file:
+                for typecode, length in layout:
+                    values = array.array(typecode)
+                    values.fromfile(file, length)
+                    arrays.append(values)
+        return cls(chunks, vocabulary, *arrays, k1=meta["k1"], b=meta["b"], source_digest=meta.get("source_digest"))
+
+
+def open_index(index_path: Optional[str], directory: str, max_chars: int = 800) -> Tuple[BM25Index, str]:
+    """
+    Открыть заранее собранный индекс или построить его по документам
+
+    Собранный индекс используется, только если его отпечаток совпадает с
+    документами каталога (или каталога нет рядом — тогда верим индексу).
+    Устаревший индекс не молча отдает старые фрагменты, а собирается заново.
+
+    Returns:
+        Индекс и откуда он взят (путь индекса или каталог документов)
+    """
+    digest = documents_digest(directory, max_chars)
+    if index_path and os.path.exists(index_path):
+        index = BM25Index.load(index_path)
+        if digest is None or index.source_digest == digest:
+            return index, index_path
+        logger.warning(f"Индекс {index_path} не соответствует документам {directory}, индекс собирается заново; "
+                       f"обновите его: python knowledge_base.py build {directory} {index_path}")
+    index = BM25Index.build(load_documents(directory, max_chars))
+    index.source_digest = digest
+    return index, directory
+
+
+class KnowledgeBase:
+    """Подбор справочных материалов к запросу пользователя"""
+
+    def __init__(self, index: BM25Index, top_k: int = 3, max_chars: int = 3000, min_score_ratio: float = 0.35):
+        """
+        Args:
+            index: Индекс BM25 по фрагментам базы
+            top_k: Сколько фрагментов добавлять в запрос
+            max_chars: Бюджет символов на все фрагменты
+            min_score_ratio: Отбрасывать фрагменты, набравшие меньше этой доли очков лучшего
+        """
+        self.index = index
+        self.top_k = top_k
+        self.max_chars = max_chars
+        self.min_score_ratio = min_score_ratio
+
+    @classmethod
+    def from_env(cls) -> Optional["KnowledgeBase"]:
+        """Открыть или построить индекс по переменным окружения; None, если поиск по базе выключен"""
+        if os.getenv("KNOWLEDGE_RETRIEVAL", "0") != "1":
+            return None
+        started = time.perf_counter()
+        index, source = open_index(os.getenv("KNOWLEDGE_INDEX"), os.getenv("KNOWLEDGE_DIR", DEFAULT_DIR),
+                                   int(os.getenv("KNOWLEDGE_CHUNK_CHARS", 800)))
+        logger.info(
+            f"База знаний: {len(index.chunks)} фрагментов, {len(index.vocabulary)} термов из {source} "
+            f"за {(time.perf_counter() - started) * 1000:.0f} мс (NumPy: {'да' if np is not None else 'нет'})"
+        )
+        return cls(
+            index,
+            top_k=int(os.getenv("KNOWLEDGE_TOP_K", 3)),
+            max_chars=int(os.getenv("KNOWLEDGE_MAX_CHARS", 3000)),
+            min_score_ratio=float(os.getenv("KNOWLEDGE_MIN_SCORE_RATIO", 0.35)),
+        )
+
+    @property
+    def fingerprint(self) -> str:
+        """Версия базы и настроек подбора (для кэша ответов)"""
+        return f"{self.index.version}:{self.top_k}:{self.max_chars}:{self.min_score_ratio}"
+
+    def snippets(self, query: str) -> List[Chunk]:
+        """Фрагменты для запроса с учетом порога очков и бюджета символов"""
+        with KNOWLEDGE_SEARCH_SECONDS.time():
+            found = self.index.search(query, self.top_k)
+        selected: List[Chunk] = []
+        used = 0
+        for score, chunk in found:
+            if score < found[0][0] * self.min_score_ratio:
+                break
+            size = len(chunk.title) + len(chunk.text)
+            if used + size > self.max_chars:
+                continue
+            selected.append(chunk)
+            used += size
+        KNOWLEDGE_SNIPPETS.observe(len(selected))
+        return selected
+
+    def context(self, query: str) -> str:
+        """
+        Блок справочных материалов к запросу (пустая строка, если ничего не подошло)
+
+        Куда поставить блок, решает вызывающий код: бот добавляет его к текущему
+        сообщению пользователя, чтобы не сбивать кэш истории, а пакетный режим — в system.
+        """
+        selected = self.snippets(query)
+        if not selected:
+            return ""
+        parts = [f"{chunk.title}:\n{chunk.text}" for chunk in selected]
+        return "СПРАВОЧНЫЕ МАТЕРИАЛЫ (используйте, если относятся к ситуации):\n\n" + "\n\n".join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="База знаний HR-ассистента: сборка индекса и проверка поиска")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Собрать индекс заранее")
+    build.add_argument("directory", nargs="?", default=DEFAULT_DIR, help="Каталог с документами")
+    build.add_argument("output", nargs="?", default="knowledge.idx", help="Каталог индекса (KNOWLEDGE_INDEX)")
+    build.add_argument("--chunk-chars", type=int, default=int(os.getenv("KNOWLEDGE_CHUNK_CHARS", 800)))
+    search = commands.add_parser("search", help="Показать фрагменты, которые получит запрос")
+    search.add_argument("query")
+    search.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        started = time.perf_counter()
+        index = BM25Index.build(load_documents(args.directory, args.chunk_chars))
+        index.source_digest = documents_digest(args.directory, args.chunk_chars)
+        index.save(args.output)
+        print(f"{len(index.chunks)} фрагментов, {len(index.vocabulary)} термов, {len(index.doc_ids)} постингов "
+              f"за {(time.perf_counter() - started) * 1000:.0f} мс -> {args.output}")
+    else:
+        index, _ = open_index(os.getenv("KNOWLEDGE_INDEX"), os.getenv("KNOWLEDGE_DIR", DEFAULT_DIR),
+                              int(os.getenv("KNOWLEDGE_CHUNK_CHARS", 800)))
+        for score, chunk in index.search(args.query, args.top_k):
+            print(f"{score:6.2f}  {chunk.source}  {chunk.title}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Работа с Claude: планировщик запросов, устойчивый клиент и кэширование промпта
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Union
+
+import anthropic
+import httpx
+
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+LLM_QUEUE_DEPTH = Gauge("hr_bot_llm_queue_depth", "Запросы к Claude, ожидающие свободного слота")
+LLM_QUEUE_USERS = Gauge("hr_bot_llm_queue_users", "Пользователи с запросами в очереди к Claude")
+LLM_IN_FLIGHT = Gauge("hr_bot_llm_in_flight", "Запросы к Claude, выполняющиеся прямо сейчас")
+LLM_QUEUE_WAIT = Histogram("hr_bot_llm_queue_wait_seconds", "Время ожидания слота для запроса к Claude")
+LLM_LATENCY = Histogram(
+    "hr_bot_llm_latency_seconds",
+    "Задержка ответа Claude: до первого токена (ttft) и полная (total)",
+    ["stage", "model", "mode"],
+)
+LLM_TOKENS = Counter(
+    "hr_bot_llm_tokens_total",
+    "Токены запросов к Claude (input, output, cache_read, cache_creation)",
+    ["kind"],
+)
+
+LLM_RETRIES = Counter("hr_bot_llm_retries_total", "Повторные запросы к Claude по причинам", ["model", "reason"])
+LLM_HEDGES = Counter("hr_bot_llm_hedges_total", "Дублирующие (hedged) запросы к Claude", ["result"])
+LLM_FALLBACKS = Counter("hr_bot_llm_fallbacks_total", "Переключения на резервную модель", ["model"])
+LLM_CIRCUIT_STATE = Gauge(
+    "hr_bot_llm_circuit_state", "Состояние предохранителя модели: 0 — закрыт, 1 — полуоткрыт, 2 — открыт", ["model"]
+)
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Минимальная длина кэшируемого префикса по моделям (токенов). Более короткий префикс
+# с cache_control API принимает без ошибки, но кэш не создается (cache_creation = 0)
+MIN_CACHEABLE_TOKENS = (
+    ("claude-haiku-4-5", 4096),
+    ("claude-opus-4-5", 4096),
+    ("claude-3-5-haiku", 2048),
+    ("claude-3-haiku", 2048),
+)
+DEFAULT_MIN_CACHEABLE_TOKENS = 1024
+
+# Статусы, при которых запрос имеет смысл повторить (529 — перегрузка Anthropic)
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class ClaudeScheduler:
+    """
+    Ограничивает число одновременных запросов к Claude.
+
+    Ожидающие запросы группируются по пользователям, а освободившийся слот
+    отдается пользователям по кругу (round-robin), поэтому один активный чат
+    не может занять всю очередь.
+    """
+
+    def __init__(self, max_concurrency: int = 8, max_queue: int = 200):
+        """
+        Args:
+            max_concurrency: Максимальное число одновременных запросов к Claude
+            max_queue: Длина очереди, после которой новые запросы отклоняются (0 — без ограничения)
+        """
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency должен быть не меньше 1")
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        # Скользящее среднее времени удержания слота, для оценки ожидания
+        self._service_time = 5.0
+        self._active = 0
+        self._waiters: Dict[int, Deque[asyncio.Future]] = {}
+        self._order: Deque[int] = deque()
+
+        LLM_QUEUE_DEPTH.set_function(lambda: self.queue_depth)
+        LLM_QUEUE_USERS.set_function(lambda: len(self._waiters))
+        LLM_IN_FLIGHT.set_function(lambda: self._active)
+
+    @classmethod
+    def from_env(cls) -> "ClaudeScheduler":
+        """Создать планировщик с настройками из переменных окружения"""
+        return cls(
+            max_concurrency=int(os.getenv("CLAUDE_MAX_CONCURRENCY", 8)),
+            max_queue=int(os.getenv("CLAUDE_MAX_QUEUE", 200)),
+        )
+
+    @property
+    def queue_depth(self) -> int:
+        """Число запросов, ожидающих слот"""
+        return sum(len(queue) for queue in self._waiters.values())
+
+    @property
+    def in_flight(self) -> int:
+        """Число выполняющихся запросов"""
+        return self._active
+
+    @property
+    def overloaded(self) -> bool:
+        """Очередь достигла предела — новые запросы стоит отклонять сразу"""
+        return self.max_queue > 0 and self.queue_depth >= self.max_queue
+
+    def estimated_wait(self) -> float:
+        """Оценка ожидания слота для нового запроса (секунды)"""
+        return (self.queue_depth / self.max_concurrency + 1) * self._service_time
+
+    @asynccontextmanager
+    async def slot(self, user_id: int):
+        """Занять слот для запроса пользователя на время блока async with"""
+        started = time.monotonic()
+        await self._acquire(user_id)
+        acquired = time.monotonic()
+        LLM_QUEUE_WAIT.observe(acquired - started)
+        try:
+            yield
+        finally:
+            self._service_time += 0.1 * (time.monotonic() - acquired - self._service_time)
+            self._release()
+
+    async def _acquire(self, user_id: int):
+        if self._active < self.max_concurrency and not self._order:
+            self._active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._waiters.get(user_id)
+        if queue is None:
+            queue = self._waiters[user_id] = deque()
+            self._order.append(user_id)
+        queue.append(future)
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но запрос отменили — отдаем слот следующему
+                self._release()
+            else:
+                self._forget(user_id, future)
+            raise
+
+    def _forget(self, user_id: int, future: asyncio.Future):
+        """Убрать отмененный запрос из очереди"""
+        queue = self._waiters.get(user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+        except ValueError:
+            pass
+        if not queue:
+            del self._waiters[user_id]
+            try:
+                self._order.remove(user_id)
+            except ValueError:
+                pass
+
+    def _release(self):
+        self._active -= 1
+        while self._order and self._active < self.max_concurrency:
+            user_id = self._order.popleft()
+            queue = self._waiters[user_id]
+            future = queue.popleft()
+            if queue:
+                # Пользователь уходит в конец круга
+                self._order.append(user_id)
+            else:
+                del self._waiters[user_id]
+            if future.done():
+                continue
+            self._active += 1
+            future.set_result(None)
+
+
+class LLMUnavailable(Exception):
+    """Ни одна модель сейчас не может ответить: предохранители открыты или истек срок запроса"""
+
+
+def _is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (anthropic.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    return isinstance(error, anthropic.APIStatusError) and error.status_code in RETRYABLE_STATUSES
+
+
+def _error_reason(error: BaseException) -> str:
+    if isinstance(error, anthropic.APIStatusError):
+        return str(error.status_code)
+    if isinstance(error, (anthropic.APITimeoutError, asyncio.TimeoutError)):
+        return "timeout"
+    return "connection"
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    """Пауза, которую просит сервер в заголовках retry-after-ms / retry-after"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Предохранитель модели.
+
+    Если среди последних window запросов доля неудачных (после всех повторов)
+    достигает failure_rate, запросы к модели не отправляются reset_timeout
+    секунд. Затем пропускаются пробные запросы: успех закрывает
+    предохранитель, ошибка снова открывает.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, model: str, failure_rate: float = 0.5, window: int = 100, min_calls: int = 20,
+                 reset_timeout: float = 30.0):
+        self.model = model
+        self.failure_rate = failure_rate
+        self.min_calls = min(min_calls, window)
+        self.reset_timeout = reset_timeout
+        self._results: Deque[bool] = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._state = self.CLOSED
+        LLM_CIRCUIT_STATE.labels(model=model).set_function(lambda: self.state)
+
+    @property
+    def state(self) -> int:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self._state
+
+    def allow(self) -> bool:
+        """Можно ли сейчас отправить запрос к модели"""
+        return self.state != self.OPEN
+
+    def record_success(self):
+        if self._state == self.OPEN:
+            logger.info(f"Предохранитель модели {self.model} закрыт")
+            self._results.clear()
+        self._state = self.CLOSED
+        self._results.append(True)
+
+    def record_failure(self):
+        self._results.append(False)
+        state = self.state
+        if state == self.OPEN:
+            return
+        failures = self._results.count(False)
+        if state == self.HALF_OPEN or (
+            len(self._results) >= self.min_calls and failures >= self.failure_rate * len(self._results)
+        ):
+            logger.warning(
+                f"Предохранитель модели {self.model} открыт: {failures} ошибок из {len(self._results)} запросов"
+            )
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+
+
+class ResilientClaude:
+    """
+    Обертка над AsyncAnthropic для запросов бота.
+
+    - повторы временных ошибок (429, 5xx, 529, сеть) с экспоненциальной
+      паузой со случайным разбросом, с учетом retry-after;
+    - общий срок (deadline) на запрос вместе со всеми повторами;
+    - дублирующий запрос, если ответа нет дольше заданного перцентиля
+      задержки (только для обычных запросов, не для потока);
+    - переход на резервную модель, когда основная не отвечает;
+    - предохранитель на каждую модель.
+
+    Встроенные повторы SDK стоит отключить (max_retries=0), чтобы они не
+    складывались с повторами обертки.
+    """
+
+    def __init__(self, client, model: str, max_tokens: int = 4096, fallback_model: Optional[str] = None,
+                 max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 20.0,
+                 deadline: float = 90.0, hedge_percentile: float = 0.0, hedge_min_samples: int = 20,
+                 failure_rate: float = 0.5, reset_timeout: float = 30.0):
+        """
+        Args:
+            client: Клиент anthropic.AsyncAnthropic
+            model: Основная модель
+            max_tokens: Максимальная длина ответа
+            fallback_model: Резервная модель (None — без резерва)
+            max_attempts: Попыток на модель, включая первую
+            base_delay: Базовая пауза между попытками (секунды)
+            max_delay: Максимальная пауза между попытками (секунды)
+            deadline: Общий срок запроса со всеми повторами (секунды)
+            hedge_percentile: Перцентиль задержки, после которого отправляется дубль (0 — выключено)
+            hedge_min_samples: Сколько замеров нужно накопить, прежде чем дублировать
+            failure_rate: Доля ошибок среди последних запросов, при которой открывается предохранитель
+            reset_timeout: Через сколько секунд пропустить пробный запрос
+        """
+        self.client = client
+        self.model = model
+        self.max_tokens = max_tokens
+        self.fallback_model = fallback_model if fallback_model and fallback_model != model else None
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._latencies: Deque[float] = deque(maxlen=200)
+        self.failure_rate = failure_rate
+        self.reset_timeout = reset_timeout
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        for name in filter(None, (self.model, self.fallback_model)):
+            self._breaker(name)
+
+    @classmethod
+    def from_env(cls, client) -> "ResilientClaude":
+        """Создать обертку с настройками из переменных окружения"""
+        return cls(
+            client,
+            model=os.getenv("CLAUDE_MODEL", "claude-haiku-4-5-20251001"),
+            max_tokens=int(os.getenv("CLAUDE_MAX_TOKENS", 4096)),
+            fallback_model=os.getenv("CLAUDE_FALLBACK_MODEL") or None,
+            max_attempts=int(os.getenv("CLAUDE_MAX_ATTEMPTS", 3)),
+            base_delay=float(os.getenv("CLAUDE_RETRY_BASE_DELAY", 0.5)),
+            max_delay=float(os.getenv("CLAUDE_RETRY_MAX_DELAY", 20.0)),
+            deadline=float(os.getenv("CLAUDE_DEADLINE_SECONDS", 90.0)),
+            hedge_percentile=float(os.getenv("CLAUDE_HEDGE_PERCENTILE", 0)),
+            failure_rate=float(os.getenv("CLAUDE_BREAKER_FAILURE_RATE", 0.5)),
+            reset_timeout=float(os.getenv("CLAUDE_BREAKER_RESET_SECONDS", 30.0)),
+        )
+
+    async def warm_up(self):
+        """
+        Заранее открыть соединение с API (TCP и TLS), чтобы первый запрос
+        после холодного старта не платил за установку соединения.
+
+        Ответ не важен (обычно 401/404) — соединение остается в пуле клиента.
+        """
+        started = time.perf_counter()
+        try:
+            await self.client.get("/v1/models", cast_to=httpx.Response, options={"timeout": 10.0})
+        except anthropic.APIStatusError:
+            pass
+        except Exception as e:
+            logger.debug(f"Не удалось заранее открыть соединение с API: {e}")
+            return
+        logger.debug(f"Соединение с API открыто за {time.perf_counter() - started:.3f} с")
+
+    async def create(self, request: Dict, mode: str = "sync"):
+        """Аналог messages.create с повторами, дублированием и резервной моделью"""
+        async def attempt(model_request: Dict, timeout: float):
+            return await self._create_hedged(model_request, timeout, mode)
+
+        return await self._call(request, attempt, lambda: False)
+
+    async def stream(self, request: Dict, on_text: Callable[[str], Awaitable[Any]]):
+        """
+        Потоковый запрос: каждый фрагмент текста передается в on_text.
+
+        Повтор и переход на резервную модель возможны только до первого
+        фрагмента — показанный пользователю текст уже не заменить.
+
+        Returns:
+            Итоговое сообщение (как stream.get_final_message())
+        """
+        emitted = False
+
+        async def emit(text: str):
+            nonlocal emitted
+            emitted = True
+            await on_text(text)
+
+        async def attempt(model_request: Dict, timeout: float):
+            return await self._stream_once(model_request, timeout, emit)
+
+        return await self._call(request, attempt, lambda: emitted)
+
+    async def _call(self, request: Dict, attempt: Callable[[Dict, float], Awaitable[Any]],
+                    committed: Callable[[], bool]):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        models = [request["model"]]
+        if self.fallback_model and self.fallback_model not in models:
+            models.append(self.fallback_model)
+
+        last_error: Optional[BaseException] = None
+        for model in models:
+            breaker = self._breaker(model)
+            if not breaker.allow():
+                continue
+            if model != request["model"]:
+                LLM_FALLBACKS.labels(model=model).inc()
+                if last_error is not None:
+                    logger.warning(f"Переход на резервную модель {model}: {last_error}")
+
+            model_request = dict(request, model=model)
+            for number in range(1, self.max_attempts + 1):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    result = await attempt(model_request, remaining)
+                except Exception as e:
+                    if not _is_retryable(e) or committed():
+                        raise
+                    last_error = e
+                    delay = self._backoff(number, e)
+                    if number == self.max_attempts or loop.time() + delay >= deadline:
+                        break
+                    LLM_RETRIES.labels(model=model, reason=_error_reason(e)).inc()
+                    logger.warning(
+                        f"Ошибка Claude ({model}, попытка {number}): {type(e).__name__}, повтор через {delay:.1f} с"
+                    )
+                    await asyncio.sleep(delay)
+                else:
+                    breaker.record_success()
+                    return result
+            # Модель не ответила на запрос за все попытки
+            breaker.record_failure()
+
+        if last_error is not None:
+            raise last_error
+        raise LLMUnavailable("Claude временно недоступен: предохранители моделей открыты или истек срок запроса")
+
+    def _breaker(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(
+                model, failure_rate=self.failure_rate, reset_timeout=self.reset_timeout
+            )
+        return breaker
+
+    def _backoff(self, number: int, error: BaseException) -> float:
+        """Пауза перед следующей попыткой: retry-after сервера или full jitter"""
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(self.max_delay, retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (number - 1)))
+
+    def _hedge_delay(self) -> Optional[float]:
+        if self.hedge_percentile <= 0 or len(self._latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile))]
+
+    async def _create_once(self, request: Dict, timeout: float, mode: str):
+        started = time.perf_counter()
+        with LLM_LATENCY.labels(stage="total", model=request["model"], mode=mode).time():
+            response = await asyncio.wait_for(self.client.messages.create(**request, timeout=timeout), timeout)
+        self._latencies.append(time.perf_counter() - started)
+        return response
+
+    async def _create_hedged(self, request: Dict, timeout: float, mode: str):
+        hedge_after = self._hedge_delay()
+        if hedge_after is None or hedge_after >= timeout:
+            return await self._create_once(request, timeout, mode)
+
+        primary = asyncio.ensure_future(self._create_once(request, timeout, mode))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                LLM_HEDGES.labels(result="sent").inc()
+                tasks.add(asyncio.ensure_future(self._create_once(request, timeout - hedge_after, mode)))
+
+            error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            LLM_HEDGES.labels(result="won").inc()
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _stream_once(self, request: Dict, timeout: float, on_text: Callable[[str], Awaitable[Any]]):
+        model = request["model"]
+        started = time.perf_counter()
+        first_token = None
+        async with self.client.messages.stream(**request, timeout=timeout) as stream:
+            async for text in stream.text_stream:
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+                    LLM_LATENCY.labels(stage="ttft", model=model, mode="stream").observe(first_token)
+                await on_text(text)
+            final_message = await stream.get_final_message()
+        LLM_LATENCY.labels(stage="total", model=model, mode="stream").observe(time.perf_counter() - started)
+        return final_message
+
+
+def min_cacheable_tokens(model: str) -> int:
+    """Минимальная длина префикса, который модель кэширует"""
+    for prefix, tokens in MIN_CACHEABLE_TOKENS:
+        if model.startswith(prefix):
+            return tokens
+    return DEFAULT_MIN_CACHEABLE_TOKENS
+
+
+def cacheable_system(system_prompt: str) -> List[Dict]:
+    """Системный промпт в виде блока, помеченного для кэширования на стороне Anthropic"""
+    return [{"type": "text", "text": system_prompt, "cache_control": CACHE_CONTROL}]
+
+
+def with_cache_breakpoint(messages: List[Dict], index: int = -1) -> List[Dict]:
+    """
+    Копия истории, где сообщение index (по умолчанию последнее) помечено как граница кэша.
+
+    На следующем ходе весь префикс разговора до этой границы читается из
+    кэша, а оплачиваются полностью только более новые сообщения.
+    """
+    if not messages:
+        return messages
+    index %= len(messages)
+    marked = messages[index]
+    content: Union[str, List[Dict]] = marked["content"]
+    if isinstance(content, str):
+        blocks = [{"type": "text", "text": content, "cache_control": CACHE_CONTROL}]
+    else:
+        blocks = [dict(block) for block in content]
+        blocks[-1]["cache_control"] = CACHE_CONTROL
+    return messages[:index] + [{"role": marked["role"], "content": blocks}] + messages[index + 1:]
+
+
+def record_usage(usage) -> Dict[str, int]:
+    """Учесть токены из response.usage в метриках и вернуть их в виде словаря"""
+    counts = {
+        "input": getattr(usage, "input_tokens", 0) or 0,
+        "output": getattr(usage, "output_tokens", 0) or 0,
+        "cache_read": getattr(usage, "cache_read_input_tokens", 0) or 0,
+        "cache_creation": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+    }
+    for kind, value in counts.items():
+        if value:
+            LLM_TOKENS.labels(kind=kind).inc(value)
+    return counts
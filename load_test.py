@@ -0,0 +1,717 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Нагрузочный тест HR Assistant Bot без сети
+
+Бот запускается целиком (обработчики, планировщик, хранилище истории),
+но Anthropic API заменен локальным сервером-заглушкой с настраиваемой
+задержкой и скоростью генерации токенов, а Telegram Bot API — транспортом,
+который записывает вызовы. Синтетические пользователи отправляют сообщения
+параллельно; в конце печатается пропускная способность, перцентили задержки,
+задержка event loop и потребление памяти.
+
+Пример:
+    python load_test.py --users 50 --messages 3 --json bench_output.json
+    python load_test.py --users 50 --baseline bench_baseline.json
+    python load_test.py --users 50 --workers 4
+    python load_test.py --memory-users 10000
+    python load_test.py --batch-records 5000 --batch-mode batches
+
+С --workers сообщения проходят через диспетчер к нескольким процессам-воркерам,
+а Bot API заменяет HTTP-заглушка (воркеры работают в отдельных процессах).
+
+С --memory-users вместо нагрузки замеряется память горячего кэша истории:
+байты на активного пользователя при хранении списков словарей и в
+компактном виде ConversationStore.
+
+С --batch-records через заглушку прогоняется пакетный режим batch_consult
+(параллельные запросы или Message Batches API): записи в секунду и пик
+памяти, который не должен расти с числом записей.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+# Ответ заглушки: немного markdown, чтобы нагрузить clean_markdown
+RESPONSE_WORDS = (
+    "**Диагностика:** сотрудник, судя по описанию, — P (Producer) на уровне D2. "
+    "## Что делать\n1. Проведите разговор один на один.\n"
+    "2. Договоритесь о `конкретных` сроках и формате отчета.\n"
+    "- Используйте модель SBI для обратной связи.\n"
+).split(" ")
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Перцентиль по отсортированной выборке (ближайший ранг)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def current_rss_mb() -> float:
+    """Текущий RSS процесса в МБ"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # macOS отдает байты, Linux — килобайты; здесь это максимум, а не текущее значение
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+
+class FakeAnthropicServer:
+    """
+    Локальная заглушка Messages API с настраиваемой задержкой и скоростью потока
+
+    Для имитации сбоев провайдера часть запросов может получать 529
+    (перегрузка) или отвечать в slow_factor раз медленнее.
+    """
+
+    def __init__(self, ttft: float, tokens_per_second: float, output_tokens: int,
+                 error_rate: float = 0.0, slow_rate: float = 0.0, slow_factor: float = 10.0):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.requests = 0
+        self.errors = 0
+        # Пакеты Message Batches API: id -> (время создания, custom_id запросов)
+        self.batches: Dict[str, Tuple[float, List[str]]] = {}
+        # Оценка входных токенов каждого запроса (~4 байта UTF-8 на токен)
+        self.input_tokens: List[int] = []
+        self.output_tokens_sent: List[int] = []
+        self._random = random.Random(42)
+        self.port: Optional[int] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> str:
+        # Тело пакета Message Batches API — сотни запросов с системным промптом
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_post("/v1/messages", self.handle_messages)
+        app.router.add_post("/v1/messages/batches", self.handle_batch_create)
+        app.router.add_get("/v1/messages/batches/{batch_id}", self.handle_batch_retrieve)
+        app.router.add_get("/v1/messages/batches/{batch_id}/results", self.handle_batch_results)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{self.port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _tokens(self, count: Optional[int] = None) -> List[str]:
+        count = self.output_tokens if count is None else count
+        return [RESPONSE_WORDS[i % len(RESPONSE_WORDS)] + " " for i in range(count)]
+
+    async def handle_messages(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        prompt = json.dumps([body.get("system"), body.get("messages")], ensure_ascii=False)
+        self.input_tokens.append(len(prompt.encode("utf-8")) // 4)
+        # Как и настоящий API, ответ обрезается по max_tokens запроса
+        output_tokens = min(self.output_tokens, body.get("max_tokens", self.output_tokens))
+        stop_reason = "max_tokens" if output_tokens < self.output_tokens else "end_turn"
+        self.output_tokens_sent.append(output_tokens)
+        usage = {"input_tokens": 100, "output_tokens": output_tokens}
+        if self._random.random() < self.error_rate:
+            self.errors += 1
+            await asyncio.sleep(self.ttft / 3)
+            return web.json_response(
+                {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}}, status=529
+            )
+        slowdown = self.slow_factor if self._random.random() < self.slow_rate else 1.0
+        await asyncio.sleep(self.ttft * slowdown)
+
+        if not body.get("stream"):
+            await asyncio.sleep(output_tokens / self.tokens_per_second * slowdown)
+            return web.json_response({
+                "id": f"msg_{self.requests}", "type": "message", "role": "assistant",
+                "model": body["model"], "stop_reason": stop_reason, "stop_sequence": None,
+                "content": [{"type": "text", "text": "".join(self._tokens(output_tokens))}], "usage": usage,
+            }, headers={"request-id": f"req_{self.requests}"})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "request-id": f"req_{self.requests}"})
+        await response.prepare(request)
+
+        async def send(event: str, data: Dict):
+            await response.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode())
+
+        await send("message_start", {"type": "message_start", "message": {
+            "id": f"msg_{self.requests}", "type": "message", "role": "assistant", "model": body["model"],
+            "content": [], "stop_reason": None, "stop_sequence": None,
+            "usage": {"input_tokens": 100, "output_tokens": 1},
+        }})
+        await send("content_block_start", {"type": "content_block_start", "index": 0,
+                                           "content_block": {"type": "text", "text": ""}})
+        # Отдаем токены пачками примерно раз в 20 мс
+        batch = max(1, int(self.tokens_per_second * 0.02))
+        tokens = self._tokens(output_tokens)
+        for start in range(0, len(tokens), batch):
+            chunk = "".join(tokens[start:start + batch])
+            await send("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                               "delta": {"type": "text_delta", "text": chunk}})
+            await asyncio.sleep(batch / self.tokens_per_second * slowdown)
+        await send("content_block_stop", {"type": "content_block_stop", "index": 0})
+        await send("message_delta", {"type": "message_delta",
+                                     "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                                     "usage": {"output_tokens": output_tokens}})
+        await send("message_stop", {"type": "message_stop"})
+        await response.write_eof()
+        return response
+
+
+    async def handle_batch_create(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        batch_id = f"msgbatch_{len(self.batches) + 1}"
+        self.batches[batch_id] = (time.monotonic(), [item["custom_id"] for item in body["requests"]])
+        return web.json_response({"id": batch_id, "type": "message_batch", "processing_status": "in_progress"})
+
+    async def handle_batch_retrieve(self, request: web.Request) -> web.Response:
+        batch_id = request.match_info["batch_id"]
+        created, custom_ids = self.batches[batch_id]
+        # Пакет "обрабатывается" столько же, сколько один обычный запрос
+        ended = time.monotonic() - created >= self.ttft + self.output_tokens / self.tokens_per_second
+        return web.json_response({
+            "id": batch_id, "type": "message_batch", "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {"processing": 0 if ended else len(custom_ids), "succeeded": len(custom_ids) if ended else 0},
+            "results_url": f"http://127.0.0.1:{self.port}/v1/messages/batches/{batch_id}/results" if ended else None,
+        })
+
+    async def handle_batch_results(self, request: web.Request) -> web.Response:
+        _, custom_ids = self.batches[request.match_info["batch_id"]]
+        text = "".join(self._tokens())
+        lines = []
+        # Результаты пакета приходят не в порядке запросов
+        for custom_id in sorted(custom_ids, key=lambda _: self._random.random()):
+            self.requests += 1
+            lines.append(json.dumps({"custom_id": custom_id, "result": {"type": "succeeded", "message": {
+                "id": f"msg_{self.requests}", "type": "message", "role": "assistant", "model": "bench",
+                "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "stop_sequence": None,
+                "usage": {"input_tokens": 100, "output_tokens": self.output_tokens},
+            }}}, ensure_ascii=False))
+        return web.Response(text="\n".join(lines) + "\n", content_type="application/x-jsonl")
+
+
+class RecordingTelegramRequest(BaseRequest):
+    """Транспорт Bot API, который отвечает локально и записывает все вызовы"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: List[Tuple[float, str, Optional[int]]] = []
+        self.first_send: Dict[int, float] = {}
+        self.failed_replies = 0
+        self._message_id = 0
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+        chat_id = params.get("chat_id")
+        now = time.perf_counter()
+        self.calls.append((now, api_method, chat_id))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method in ("sendMessage", "editMessageText"):
+            if api_method == "sendMessage":
+                self._message_id += 1
+                if params.get("text", "").startswith(("Извините", "⏳")):
+                    self.failed_replies += 1
+                self.first_send.setdefault(chat_id, now)
+            result = {
+                "message_id": params.get("message_id", self._message_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class LoopLagMonitor:
+    """Замеряет, насколько позже запланированного просыпается event loop"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+
+
+class FakeTelegramServer:
+    """HTTP-заглушка Bot API для воркеров в отдельных процессах"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self.failed_replies = 0
+        self._replies: Dict[int, asyncio.Queue] = {}
+        self._message_id = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        return f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def replies(self, chat_id: int) -> asyncio.Queue:
+        """Очередь моментов отправки сообщений в чат"""
+        return self._replies.setdefault(chat_id, asyncio.Queue())
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            if method == "sendMessage":
+                self._message_id += 1
+                if params.get("text", "").startswith(("Извините", "⏳")):
+                    self.failed_replies += 1
+                self.replies(chat_id).put_nowait(time.perf_counter())
+            result = {
+                "message_id": int(params.get("message_id", self._message_id)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+def update_json(update_id: int, user_id: int, text: str) -> Dict:
+    """JSON синтетического обновления с текстовым сообщением от пользователя"""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User", "username": f"user{user_id}"},
+            "text": text,
+        },
+    }
+
+
+def make_update(update_id: int, user_id: int, text: str, bot) -> Update:
+    """Синтетическое обновление с текстовым сообщением от пользователя"""
+    return Update.de_json(update_json(update_id, user_id, text), bot)
+
+
+async def run_benchmark(args) -> Dict:
+    """Прогнать нагрузку и вернуть результаты"""
+    import anthropic
+    from hr_assistant_bot import HRAssistantBot
+    from http_pool import HTTP_CONNECTIONS
+
+    # Бот настраивает логирование при импорте; в тесте оставляем только предупреждения
+    logging.getLogger().setLevel(args.log_level)
+
+    fake_anthropic = FakeAnthropicServer(args.ttft, args.tokens_per_second, args.output_tokens,
+                                         error_rate=args.error_rate, slow_rate=args.slow_rate)
+    base_url = await fake_anthropic.start()
+
+    telegram = RecordingTelegramRequest(latency=args.telegram_latency)
+    bot = HRAssistantBot("123456:BENCHMARK", "bench")
+    bot.anthropic_client = anthropic.AsyncAnthropic(
+        api_key="bench", base_url=base_url, max_retries=0,
+        http_client=bot.http_pool.client("anthropic", 2 * bot.llm_scheduler.max_concurrency),
+    )
+    bot.llm.client = bot.anthropic_client
+    application = bot.build_application(request=telegram)
+    await application.initialize()
+
+    rss_before = current_rss_mb()
+    monitor = LoopLagMonitor()
+    monitor.start()
+
+    latencies: List[float] = []
+    first_text: List[float] = []
+    counter = iter(range(1, 10 ** 9))
+
+    async def simulate_user(user_id: int):
+        for index in range(args.messages):
+            update = make_update(next(counter), user_id, f"Сотрудник {user_id} срывает сроки, вопрос {index}",
+                                 application.bot)
+            telegram.first_send.pop(user_id, None)
+            started = time.perf_counter()
+            await application.process_update(update)
+            finished = time.perf_counter()
+            latencies.append(finished - started)
+            if user_id in telegram.first_send:
+                first_text.append(telegram.first_send[user_id] - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate_user(1000 + user) for user in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    await monitor.stop()
+    rss_after = current_rss_mb()
+    await application.shutdown()
+    await bot.post_shutdown(application)
+    await fake_anthropic.stop()
+
+    total = args.users * args.messages
+    methods: Dict[str, int] = {}
+    for _, method, _ in telegram.calls:
+        methods[method] = methods.get(method, 0) + 1
+
+    return {
+        "users": args.users,
+        "messages": total,
+        "stream": args.stream,
+        "elapsed_seconds": round(elapsed, 3),
+        "msgs_per_sec": round(total / elapsed, 2),
+        "latency_p50": round(percentile(latencies, 50), 4),
+        "latency_p95": round(percentile(latencies, 95), 4),
+        "latency_p99": round(percentile(latencies, 99), 4),
+        "first_text_p50": round(percentile(first_text, 50), 4),
+        "first_text_p95": round(percentile(first_text, 95), 4),
+        "loop_lag_p99": round(percentile(monitor.samples, 99), 4),
+        "loop_lag_max": round(max(monitor.samples, default=0.0), 4),
+        "rss_mb_before": round(rss_before, 1),
+        "rss_mb_after": round(rss_after, 1),
+        "anthropic_requests": fake_anthropic.requests,
+        "anthropic_errors": fake_anthropic.errors,
+        "input_tokens_avg": round(statistics.mean(fake_anthropic.input_tokens or [0])),
+        "output_tokens_avg": round(statistics.mean(fake_anthropic.output_tokens_sent or [0])),
+        "anthropic_connections": int(HTTP_CONNECTIONS.labels(client="anthropic").get()),
+        "failed_replies": telegram.failed_replies,
+        "telegram_calls": methods,
+    }
+
+
+async def run_workers_benchmark(args) -> Dict:
+    """Прогнать нагрузку через диспетчер и несколько процессов-воркеров"""
+    from dispatcher import Dispatcher, ProcessTransport, WorkerPool
+    from hr_assistant_bot import run_worker_process
+
+    logging.getLogger().setLevel(args.log_level)
+
+    fake_anthropic = FakeAnthropicServer(args.ttft, args.tokens_per_second, args.output_tokens,
+                                         error_rate=args.error_rate, slow_rate=args.slow_rate)
+    fake_telegram = FakeTelegramServer(latency=args.telegram_latency)
+    # Воркеры наследуют окружение и ходят в заглушки по HTTP
+    os.environ.update({
+        "ANTHROPIC_BASE_URL": await fake_anthropic.start(),
+        "ANTHROPIC_API_KEY": "bench",
+        "TELEGRAM_API_URL": await fake_telegram.start(),
+        "TELEGRAM_BOT_TOKEN": "123456:BENCHMARK",
+        "LOG_LEVEL": args.log_level,
+    })
+
+    transport = ProcessTransport(args.workers)
+    pool = WorkerPool(run_worker_process, transport, args.workers)
+    pool.start()
+    dispatcher = Dispatcher(transport, args.workers)
+
+    # Каждый воркер при запуске вызывает getMe
+    ready_deadline = time.monotonic() + 60
+    while fake_telegram.calls.get("getMe", 0) < args.workers:
+        if time.monotonic() > ready_deadline:
+            raise RuntimeError("Воркеры не запустились за 60 с")
+        await asyncio.sleep(0.1)
+
+    latencies: List[float] = []
+    counter = iter(range(1, 10 ** 9))
+
+    async def simulate_user(user_id: int):
+        replies = fake_telegram.replies(user_id)
+        for index in range(args.messages):
+            started = time.perf_counter()
+            await dispatcher.route(update_json(next(counter), user_id, f"Сотрудник {user_id} срывает сроки, вопрос {index}"))
+            latencies.append(await replies.get() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate_user(1000 + user) for user in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    await pool.stop()
+    await fake_telegram.stop()
+    await fake_anthropic.stop()
+
+    total = args.users * args.messages
+    return {
+        "users": args.users,
+        "messages": total,
+        "workers": args.workers,
+        "elapsed_seconds": round(elapsed, 3),
+        "msgs_per_sec": round(total / elapsed, 2),
+        "latency_p50": round(percentile(latencies, 50), 4),
+        "latency_p95": round(percentile(latencies, 95), 4),
+        "latency_p99": round(percentile(latencies, 99), 4),
+        "anthropic_requests": fake_anthropic.requests,
+        "anthropic_errors": fake_anthropic.errors,
+        "failed_replies": fake_telegram.failed_replies,
+        "telegram_calls": fake_telegram.calls,
+    }
+
+
+def synthetic_history(user_id: int, turns: int, reply_words: int) -> List[Dict]:
+    """История консультации: короткие вопросы и длинные ответы на русском"""
+    from context_window import estimate_tokens
+
+    rng = random.Random(user_id)
+    messages = []
+    for index in range(turns):
+        if index % 2 == 0:
+            content = f"Сотрудник {user_id} снова срывает сроки по проекту, вопрос {index}: как с ним поговорить?"
+        else:
+            content = " ".join(rng.choice(RESPONSE_WORDS) for _ in range(reply_words))
+        messages.append({"role": "user" if index % 2 == 0 else "assistant", "content": content,
+                         "tokens": estimate_tokens(content)})
+    return messages
+
+
+async def run_memory_benchmark(args) -> Dict:
+    """Байты на активного пользователя: списки словарей против компактной истории"""
+    from conversation_store import ConversationStore
+
+    users = range(args.memory_users)
+    tracemalloc.start()
+
+    # Было: история в кэше — список словарей со строками
+    start = tracemalloc.get_traced_memory()[0]
+    plain = {user: synthetic_history(user, args.memory_turns, args.output_tokens) for user in users}
+    plain_bytes = tracemalloc.get_traced_memory()[0] - start
+    del plain
+
+    # Стало: компактные ходы в ConversationStore
+    store = ConversationStore(max_bytes=1 << 40)
+    start = tracemalloc.get_traced_memory()[0]
+    for user in users:
+        await store.put(user, synthetic_history(user, args.memory_turns, args.output_tokens))
+    await store.flush()
+    compact_bytes = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for user in users:
+        await store.get(user)
+    get_seconds = time.perf_counter() - started
+    await store.close()
+
+    return {
+        "users": args.memory_users,
+        "turns_per_user": args.memory_turns,
+        "plain_bytes_per_user": plain_bytes // args.memory_users,
+        "compact_bytes_per_user": compact_bytes // args.memory_users,
+        "store_estimate_per_user": store._hot_bytes // args.memory_users,
+        "reduction": round(plain_bytes / compact_bytes, 2),
+        "get_microseconds": round(get_seconds / args.memory_users * 1e6, 1),
+    }
+
+
+async def run_batch_benchmark(args) -> Dict:
+    """Прогон batch_consult через заглушку: скорость и пик памяти на входе из N записей"""
+    import anthropic
+    from batch_consult import BatchJob, Consultant
+    from knowledge_base import KnowledgeBase
+    from llm_client import ResilientClaude
+
+    logging.getLogger().setLevel(args.log_level)
+    fake_anthropic = FakeAnthropicServer(args.ttft, args.tokens_per_second, args.output_tokens,
+                                         error_rate=args.error_rate, slow_rate=args.slow_rate)
+    base_url = await fake_anthropic.start()
+    client = anthropic.AsyncAnthropic(api_key="bench", base_url=base_url, max_retries=0)
+    consultant = Consultant(ResilientClaude(client, model="bench"), KnowledgeBase.from_env())
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_path = os.path.join(directory, "input.jsonl")
+        output_path = os.path.join(directory, "output.jsonl")
+        with open(input_path, "w", encoding="utf-8") as input_file:
+            for index in range(args.batch_records):
+                record = {"id": f"r{index}", "text": f"Сотрудник {index} срывает сроки по проекту: как с ним поговорить?"}
+                input_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        job = BatchJob(consultant, input_path, output_path, concurrency=args.batch_concurrency,
+                       batch_size=args.batch_size, poll_interval=0.05, save_every=500)
+        tracemalloc.start()
+        summary = await job.run(args.batch_mode)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        with open(output_path, encoding="utf-8") as output_file:
+            results = [json.loads(line) for line in output_file]
+    await client.close()
+    await fake_anthropic.stop()
+
+    return {
+        "records": args.batch_records,
+        "mode": args.batch_mode,
+        "elapsed_seconds": summary["seconds"],
+        "records_per_sec": round(args.batch_records / max(summary["seconds"], 0.001), 1),
+        "peak_traced_mb": round(peak / (1024 * 1024), 2),
+        "output_records": len(results),
+        "output_in_order": [result["id"] for result in results] == [f"r{index}" for index in range(args.batch_records)],
+        "errors": sum(1 for result in results if "error" in result),
+        "anthropic_requests": fake_anthropic.requests,
+    }
+
+
+def compare_with_baseline(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Найти регрессии относительно сохраненного прогона"""
+    regressions = []
+    if result["msgs_per_sec"] < baseline["msgs_per_sec"] * (1 - tolerance):
+        regressions.append(f"msgs/sec: {result['msgs_per_sec']} < {baseline['msgs_per_sec']}")
+    for key in ("latency_p95", "latency_p99"):
+        if result[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key}: {result[key]} > {baseline[key]}")
+    return regressions
+
+
+def main():
+    """Главная функция"""
+    parser = argparse.ArgumentParser(description="Нагрузочный тест HR Assistant Bot без сети")
+    parser.add_argument("--users", type=int, default=20, help="Число одновременных пользователей")
+    parser.add_argument("--messages", type=int, default=3, help="Сообщений от каждого пользователя")
+    parser.add_argument("--ttft", type=float, default=0.3, help="Задержка заглушки до первого токена (с)")
+    parser.add_argument("--tokens-per-second", type=float, default=400, help="Скорость генерации заглушки")
+    parser.add_argument("--output-tokens", type=int, default=200, help="Длина ответа заглушки в токенах")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля запросов, на которые заглушка отвечает 529")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Доля запросов, которые заглушка отвечает в 10 раз медленнее")
+    parser.add_argument("--telegram-latency", type=float, default=0.01, help="Задержка вызова Bot API (с)")
+    parser.add_argument("--stream", action="store_true", help="Включить потоковый вывод (STREAM_RESPONSES=1)")
+    parser.add_argument("--knowledge", action="store_true",
+                        help="Краткий промпт и поиск по базе знаний (KNOWLEDGE_RETRIEVAL=1)")
+    parser.add_argument("--phase-routing", action="store_true",
+                        help="Модель и max_tokens по фазе разговора (PHASE_ROUTING=1)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Прогнать через диспетчер и столько процессов-воркеров (0 — один процесс)")
+    parser.add_argument("--memory-users", type=int, default=0,
+                        help="Вместо нагрузки замерить память истории для стольких пользователей")
+    parser.add_argument("--memory-turns", type=int, default=12, help="Ходов в истории для замера памяти")
+    parser.add_argument("--batch-records", type=int, default=0,
+                        help="Вместо нагрузки на бота прогнать batch_consult на N записях")
+    parser.add_argument("--batch-mode", choices=("concurrent", "batches"), default="concurrent",
+                        help="Режим batch_consult для --batch-records")
+    parser.add_argument("--batch-concurrency", type=int, default=32, help="Параллельных запросов для --batch-records")
+    parser.add_argument("--batch-size", type=int, default=500, help="Записей в пакете для --batch-mode batches")
+    parser.add_argument("--json", help="Сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="Сравнить с результатами предыдущего прогона")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Допустимое ухудшение относительно базы")
+    parser.add_argument("--log-level", default="WARNING", help="Уровень логирования бота")
+    args = parser.parse_args()
+    if args.workers and args.stream:
+        parser.error("--workers пока поддерживает только ответы без потока")
+    if args.memory_users and (args.workers or args.baseline):
+        parser.error("--memory-users не сочетается с --workers и --baseline")
+    if args.batch_records and (args.workers or args.memory_users or args.baseline):
+        parser.error("--batch-records не сочетается с --workers, --memory-users и --baseline")
+
+    os.environ["STREAM_RESPONSES"] = "1" if args.stream else "0"
+    os.environ["KNOWLEDGE_RETRIEVAL"] = "1" if args.knowledge else "0"
+    os.environ["PHASE_ROUTING"] = "1" if args.phase_routing else "0"
+    os.environ.setdefault("STREAM_EDIT_INTERVAL", "0.2")
+    # Лимиты частоты исказили бы замер пропускной способности
+    os.environ.setdefault("RATE_LIMIT_USER_RPM", "0")
+    os.environ.setdefault("RATE_LIMIT_USER_TPM", "0")
+
+    if args.memory_users:
+        benchmark = run_memory_benchmark(args)
+    elif args.batch_records:
+        benchmark = run_batch_benchmark(args)
+    elif args.workers:
+        benchmark = run_workers_benchmark(args)
+    else:
+        benchmark = run_benchmark(args)
+    result = asyncio.run(benchmark)
+
+    print("=" * 60)
+    print("HR ASSISTANT BOT - Нагрузочный тест".center(60))
+    print("=" * 60)
+    for key, value in result.items():
+        print(f"{key:>22}: {value}")
+    print("=" * 60)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump(result, output, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            regressions = compare_with_baseline(result, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print("❌ Регрессии относительно базового прогона:")
+            for regression in regressions:
+                print(f"   {regression}")
+            sys.exit(1)
+        print("✅ Регрессий относительно базового прогона нет")
+
+
+if __name__ == "__main__":
+    main()
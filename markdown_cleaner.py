@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Очистка markdown-разметки ответов Claude для отображения в Telegram
+
+Весь текст обрабатывается за один проход одним заранее скомпилированным
+регулярным выражением: каждая конструкция (блок кода, инлайн-код, заголовок,
+жирный, курсив, зачеркивание) распознается на своем месте и сразу
+заменяется. Содержимое кода и адреса ссылок не изменяются, а одиночные "_"
+и "*" внутри слов (snake_case, 2*3) сохраняются.
+"""
+
+import logging
+import re
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+CLEAN_MARKDOWN_SECONDS = Histogram(
+    "hr_bot_clean_markdown_seconds", "Время очистки markdown",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05),
+)
+
+FENCE = "```"
+
+# Шаблон начинается с класса символов, поэтому движок re быстро пропускает
+# обычный текст и пробует ветки только на `, *, _, ~, : и переводах строк.
+# Просмотр назад (?<=...) выбирает ветку по уже прочитанному символу.
+_MARKDOWN = re.compile(
+    r"""
+    [`*_~:\n]
+    (?:
+      (?<=`)(?: ``[^`\n]*\n?(?P<fence>(?s:.*?))(?:\n?```|\Z)          # блок кода (незакрытый — до конца)
+              | (?P<code>[^`\n]+)` )                                   # инлайн-код
+    | (?<=\n)(?: (?P<header>[ \t]{0,3}\#{1,6}[ \t]+)                  # заголовок
+               | (?P<bullet>[ \t]*)\*[ \t]+ )                         # пункт списка "* "
+    | (?<=\*)(?: \*(?P<bold>[^\n]+?)\*\*                               # **жирный**
+               | (?<![\w*]\*)(?P<italic>[^*\s](?:[^*\n]*?[^*\s])?)\*(?![\w*])  # *курсив*
+               | (?<!\S\*)\** | \**(?!\S) )                           # непарные звездочки у границ слов
+    | (?<=_)(?: _(?<!\w__)(?P<bold_underscore>[^\n]+?)__(?!\w)        # __жирный__
+              | (?<!\w_)(?P<italic_underscore>[^_\s](?:[^_\n]*?[^_\s])?)_(?!\w) )  # _курсив_
+    | (?<=~)~                                                         # зачеркивание
+    | (?<=:)(?P<url>//[^\s<>()\[\]]*[^\s<>()\[\].,;:!?*_~'"])          # адрес ссылки после схемы
+    )
+    """,
+    re.VERBOSE,
+)
+
+_EMPHASIS = ("bold", "bold_underscore", "italic", "italic_underscore")
+
+
+def _replace(match: "re.Match") -> str:
+    group = match.lastgroup
+    if group is None:
+        return ""
+    if group == "header":
+        return "\n"
+    if group == "bullet":
+        return "\n" + match.group("bullet") + "- "
+    if group == "url":
+        return ":" + match.group("url")
+    if group in _EMPHASIS:
+        # Внутри выделения может быть вложенная разметка
+        return _MARKDOWN.sub(_replace, match.group(group))
+    return match.group(group)
+
+
+def translate(text: str) -> str:
+    """Очистить разметку без обрезки пробелов по краям"""
+    # Ведущий перевод строки позволяет распознать заголовок или пункт в первой строке
+    return _MARKDOWN.sub(_replace, "\n" + text)[1:]
+
+
+def clean_markdown(text: str) -> str:
+    """Удаляет markdown форматирование из текста для чистого отображения в Telegram"""
+    with CLEAN_MARKDOWN_SECONDS.time():
+        try:
+            return translate(text).strip()
+        except Exception as e:
+            # Если что-то пошло не так, вернем оригинальный текст
+            logger.warning(f"Error in clean_markdown: {e}")
+            return text
+
+
+class MarkdownCleaner:
+    """
+    Инкрементальная очистка потока фрагментов.
+
+    Очищаются только устойчивые части — завершенные строки вне открытого
+    блока кода. Ни одна конструкция, кроме блока кода, не переходит через
+    перевод строки, поэтому склейка очищенных частей совпадает с результатом
+    clean_markdown для всего текста, а каждый символ очищается один раз
+    (повторно просматривается только хвост с открытым блоком кода).
+    """
+
+    def __init__(self):
+        self._tail = ""
+        self._cleaned = []
+
+    @property
+    def text(self) -> str:
+        """Очищенный текст устойчивой части"""
+        return "".join(self._cleaned)
+
+    def feed(self, chunk: str) -> str:
+        """Добавить фрагмент; возвращает очищенную новую устойчивую часть"""
+        self._tail += chunk
+        boundary = self._tail.rfind("\n")
+        if boundary < 0:
+            return ""
+        if FENCE in self._tail:
+            boundary = self._fence_boundary(boundary)
+            if boundary < 0:
+                return ""
+        stable = self._tail[:boundary + 1]
+        self._tail = self._tail[boundary + 1:]
+        with CLEAN_MARKDOWN_SECONDS.time():
+            cleaned = translate(stable)
+        self._cleaned.append(cleaned)
+        return cleaned
+
+    def _fence_boundary(self, boundary: int) -> int:
+        """
+        Последний перевод строки хвоста не дальше boundary, не попавший внутрь блока кода
+
+        Блоки ищутся тем же выражением, что и при очистке: незакрытый блок
+        тянется до конца хвоста, а обратные кавычки внутри инлайн-кода или
+        адреса ссылки блок не открывают.
+        """
+        text = "\n" + self._tail
+        fences = [match.span() for match in _MARKDOWN.finditer(text) if match.lastgroup == "fence"]
+        position = boundary + 1
+        for start, end in reversed(fences):
+            if start <= position < end:
+                position = text.rfind("\n", 0, start)
+        return position - 1
+
+    def preview(self) -> str:
+        """Предварительная очистка неустойчивого хвоста (для показа, без сохранения)"""
+        return translate(self._tail)
+
+    def finish(self) -> str:
+        """Очистить остаток и вернуть весь текст"""
+        if self._tail:
+            with CLEAN_MARKDOWN_SECONDS.time():
+                self._cleaned.append(translate(self._tail))
+            self._tail = ""
+        return self.text.strip()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Выбор модели и max_tokens по фазе консультации
+
+Алгоритм в системном промпте состоит из двух фаз: сначала короткие
+уточняющие вопросы по одному (Шаг 1), затем развернутые рекомендации
+(Шаг 2). Уточняющему ходу не нужны ни 4096 токенов, ни сильная модель,
+поэтому фаза определяется по истории локальными правилами без запроса к
+модели, а решения пишутся в лог и метрики, чтобы видеть экономию.
+
+Если уточняющий ответ все же уперся в лимит (модель сразу перешла к
+рекомендациям), бот дописывает его продолжением — см. Route.extra_tokens.
+"""
+
+import logging
+import os
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+PHASE_CLARIFY = "clarify"
+PHASE_FINAL = "final"
+
+PHASE_ROUTES = Counter("hr_bot_phase_routes_total", "Решения маршрутизатора по фазам разговора", ["phase", "reason"])
+PHASE_RESPONSE_SECONDS = Histogram(
+    "hr_bot_phase_response_seconds", "Время ответа Claude по фазам разговора", ["phase", "model"],
+    buckets=(0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0),
+)
+PHASE_OUTPUT_TOKENS = Histogram(
+    "hr_bot_phase_output_tokens", "Выходные токены ответа по фазам разговора", ["phase"],
+    buckets=(50, 100, 200, 400, 800, 1600, 3200, 6400),
+)
+PHASE_CONTINUATIONS = Counter(
+    "hr_bot_phase_continuations_total", "Ответы, дописанные после лимита уточняющей фазы", ["model"]
+)
+
+# Пользователь, уже ответивший на вопросы, прямо просит рекомендации — уточнять дальше незачем
+# (в первом сообщении «что делать?» обычно, и промпт все равно требует сначала уточнить)
+_ADVICE_REQUEST = re.compile(
+    r"что (?:мне )?(?:делать|предпринять|сказать)|как (?:мне )?(?:быть|поступить|сказать|реагировать)"
+    r"|посоветуй|рекоменд|скрипт|формулировк|план действий",
+    re.IGNORECASE,
+)
+# Разделы итогового ответа из Шага 2 промпта
+_FINAL_MARKERS = re.compile(r"диагностика|план действий|что сказать|чего избегать", re.IGNORECASE)
+
+
+class Route(NamedTuple):
+    """Решение маршрутизатора для одного запроса"""
+    phase: str
+    model: str
+    max_tokens: int
+    reason: str
+    # Сколько токенов можно дописать, если ответ уперся в max_tokens (0 — не дописывать)
+    extra_tokens: int = 0
+
+
+def _is_question(text: str) -> bool:
+    """Ход ассистента заканчивается вопросом (хвост — на случай подписи или эмодзи после вопроса)"""
+    return "?" in text.rstrip()[-40:]
+
+
+class PhaseRouter:
+    """Классификация фазы разговора по истории и параметры запроса для нее"""
+
+    def __init__(self, model: str, max_tokens: int, clarify_model: Optional[str] = None,
+                 clarify_max_tokens: int = 1024, final_model: Optional[str] = None,
+                 max_questions: int = 4, context_chars: int = 1500, final_answer_chars: int = 1500):
+        """
+        Args:
+            model: Модель по умолчанию (CLAUDE_MODEL)
+            max_tokens: Лимит ответа итоговой фазы (CLAUDE_MAX_TOKENS)
+            clarify_model: Модель уточняющих ходов (None — модель по умолчанию)
+            clarify_max_tokens: Лимит ответа уточняющих ходов
+            final_model: Модель итоговых рекомендаций (None — модель по умолчанию)
+            max_questions: После скольких уточняющих вопросов переходить к рекомендациям
+            context_chars: Сколько символов описания от пользователя достаточно для рекомендаций
+            final_answer_chars: Ход ассистента такой длины считается итоговым ответом
+        """
+        self.model = model
+        self.max_tokens = max_tokens
+        self.clarify_model = clarify_model or model
+        self.clarify_max_tokens = min(clarify_max_tokens, max_tokens)
+        self.final_model = final_model or model
+        self.max_questions = max_questions
+        self.context_chars = context_chars
+        self.final_answer_chars = final_answer_chars
+
+    @classmethod
+    def from_env(cls, model: str, max_tokens: int) -> Optional["PhaseRouter"]:
+        """Создать маршрутизатор из переменных окружения или None, если он выключен"""
+        if os.getenv("PHASE_ROUTING", "0") != "1":
+            return None
+        router = cls(
+            model, max_tokens,
+            clarify_model=os.getenv("PHASE_CLARIFY_MODEL") or None,
+            clarify_max_tokens=int(os.getenv("PHASE_CLARIFY_MAX_TOKENS", 1024)),
+            final_model=os.getenv("PHASE_FINAL_MODEL") or None,
+            max_questions=int(os.getenv("PHASE_MAX_QUESTIONS", 4)),
+            context_chars=int(os.getenv("PHASE_CONTEXT_CHARS", 1500)),
+        )
+        logger.info(
+            f"Маршрутизация по фазам включена: уточнение — {router.clarify_model}, "
+            f"max_tokens={router.clarify_max_tokens}; рекомендации — {router.final_model}, "
+            f"max_tokens={router.max_tokens}"
+        )
+        return router
+
+    @property
+    def fingerprint(self) -> str:
+        """Параметры, от которых зависит ответ (для ключа кэша ответов)"""
+        return f"{self.clarify_model}:{self.clarify_max_tokens}:{self.final_model}:{self.max_tokens}"
+
+    def classify(self, history: List[Dict]) -> Tuple[str, str]:
+        """
+        Фаза и причина решения по истории, последним в которой идет сообщение пользователя
+
+        Returns:
+            (фаза, причина)
+        """
+        turns = [message for message in history if isinstance(message.get("content"), str)]
+        if any(message["role"] == "summary" for message in turns):
+            return PHASE_FINAL, "summarized"
+        user_turns = [message["content"] for message in turns if message["role"] == "user"]
+        assistant_turns = [message["content"] for message in turns if message["role"] == "assistant"]
+
+        if assistant_turns and _ADVICE_REQUEST.search(user_turns[-1]):
+            return PHASE_FINAL, "asked"
+        if any(len(text) >= self.final_answer_chars or len(_FINAL_MARKERS.findall(text)) >= 2
+               for text in assistant_turns):
+            return PHASE_FINAL, "follow_up"
+        if assistant_turns and not _is_question(assistant_turns[-1]):
+            return PHASE_FINAL, "no_question"
+        if sum(map(_is_question, assistant_turns)) >= self.max_questions:
+            return PHASE_FINAL, "questions"
+        if sum(map(len, user_turns)) >= self.context_chars:
+            return PHASE_FINAL, "context"
+        return PHASE_CLARIFY, "first" if not assistant_turns else "answered"
+
+    def route(self, history: List[Dict], limit: Optional[int] = None) -> Route:
+        """
+        Параметры запроса для текущего хода
+
+        Args:
+            history: История разговора с текущим сообщением пользователя
+            limit: Внешнее ограничение max_tokens (дневной бюджет), None — нет
+        """
+        phase, reason = self.classify(history)
+        limit = self.max_tokens if limit is None else min(limit, self.max_tokens)
+        if phase == PHASE_CLARIFY:
+            max_tokens = min(self.clarify_max_tokens, limit)
+            route = Route(phase, self.clarify_model, max_tokens, reason, limit - max_tokens)
+        else:
+            route = Route(phase, self.final_model, limit, reason)
+        PHASE_ROUTES.labels(phase=phase, reason=reason).inc()
+        return route
+
+    @staticmethod
+    def observe(route: Route, model: str, latency: float, output_tokens: int):
+        """Учесть время и длину ответа по фазе"""
+        PHASE_RESPONSE_SECONDS.labels(phase=route.phase, model=model).observe(latency)
+        PHASE_OUTPUT_TOKENS.labels(phase=route.phase).observe(output_tokens)
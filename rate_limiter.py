@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Ограничение частоты запросов: token bucket на пользователя и на весь бот
+"""
+
+import asyncio
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITED = Counter("hr_bot_rate_limited_total", "Отклоненные запросы по причинам", ["reason"])
+
+
+class Limit(NamedTuple):
+    """Лимит в единицах в минуту; емкость ведра равна минутной норме"""
+
+    name: str
+    per_minute: float
+
+    @property
+    def rate(self) -> float:
+        return self.per_minute / 60.0
+
+
+def _refill(tokens: float, updated: float, now: float, limit: Limit, cost: float) -> Tuple[float, float]:
+    """Пополнить ведро и попытаться списать cost; возвращает (остаток, ожидание в секундах)"""
+    tokens = min(limit.per_minute, tokens + max(0.0, now - updated) * limit.rate)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / limit.rate
+
+
+class BucketBackend:
+    """Хранилище состояния ведер"""
+
+    async def take(self, key: str, limit: Limit, cost: float) -> float:
+        """
+        Списать cost из ведра key.
+
+        Отрицательный cost возвращает единицы в ведро.
+
+        Returns:
+            0, если списание прошло, иначе сколько секунд ждать
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        """Освободить ресурсы"""
+
+
+class MemoryBucketBackend(BucketBackend):
+    """
+    Ведра в памяти процесса.
+
+    Полное ведро не отличается от отсутствующего, поэтому раз в sweep_every
+    списаний удаляются ведра, которые с последнего обращения успели
+    пополниться до конца: память не растет с числом когда-либо писавших пользователей.
+    """
+
+    def __init__(self, sweep_every: int = 1000):
+        """
+        Args:
+            sweep_every: Через сколько списаний удалять полностью пополнившиеся ведра
+        """
+        self.sweep_every = sweep_every
+        # key -> (остаток, время обновления, когда ведро пополнится до конца)
+        self._buckets: Dict[str, Tuple[float, float, float]] = {}
+        self._calls = 0
+
+    async def take(self, key: str, limit: Limit, cost: float) -> float:
+        now = time.monotonic()
+        tokens, updated, _ = self._buckets.get(key, (limit.per_minute, now, now))
+        tokens, wait = _refill(tokens, updated, now, limit, cost)
+        self._buckets[key] = (tokens, now, now + (limit.per_minute - tokens) / limit.rate)
+        self._calls += 1
+        if self._calls >= self.sweep_every:
+            self._calls = 0
+            self._sweep(now)
+        return wait
+
+    def _sweep(self, now: float):
+        """Удалить ведра, пополнившиеся до конца"""
+        for key in [key for key, (_, _, full_at) in self._buckets.items() if full_at <= now]:
+            del self._buckets[key]
+
+
+class SQLiteBucketBackend(BucketBackend):
+    """Ведра в SQLite: лимиты общие для всех процессов на одном хосте"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def _take(self, key: str, limit: Limit, cost: float) -> float:
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE сразу берет блокировку записи — чтение и запись атомарны между процессами
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (key,)
+                ).fetchone()
+                tokens, updated = row if row else (limit.per_minute, now)
+                tokens, wait = _refill(tokens, updated, now, limit, cost)
+                self._conn.execute(
+                    "INSERT INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                    (key, tokens, now),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    async def take(self, key: str, limit: Limit, cost: float) -> float:
+        return await asyncio.to_thread(self._take, key, limit, cost)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Атомарное списание из ведра на стороне Redis
+_REDIS_TAKE = """
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local capacity = tonumber(ARGV[2])
+local rate = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local tokens = tonumber(data[1]) or capacity
+local updated = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local cost = tonumber(ARGV[1])
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+
+class RedisBucketBackend(BucketBackend):
+    """
+    Ведра в Redis-совместимом сервере: лимиты общие для всех реплик.
+
+    Нужен асинхронный клиент с методом eval (например, redis.asyncio.Redis).
+    """
+
+    def __init__(self, client, key_prefix: str = "hr_bot:rate:"):
+        self.client = client
+        self.key_prefix = key_prefix
+
+    async def take(self, key: str, limit: Limit, cost: float) -> float:
+        wait = await self.client.eval(
+            _REDIS_TAKE, 1, self.key_prefix + key, cost, limit.per_minute, limit.rate, time.time()
+        )
+        if isinstance(wait, bytes):
+            wait = wait.decode()
+        return float(wait)
+
+    async def close(self):
+        close = getattr(self.client, "aclose", None) or getattr(self.client, "close", None)
+        if close is not None:
+            result = close()
+            if asyncio.iscoroutine(result):
+                await result
+
+
+class Admission(NamedTuple):
+    """Результат проверки лимитов"""
+
+    allowed: bool
+    retry_after: float = 0.0
+    reason: str = ""
+
+
+class RateLimiter:
+    """
+    Допуск запросов к Claude по лимитам на пользователя и на весь бот.
+
+    Каждый запрос списывает единицу из ведра запросов и оценку токенов из
+    ведра токенов. Если какое-то ведро пусто, уже списанное возвращается,
+    а пользователь получает время, через которое можно повторить.
+    Нулевой лимит означает, что он не применяется.
+    """
+
+    def __init__(self, backend: Optional[BucketBackend] = None, user_requests: float = 20,
+                 user_tokens: float = 100_000, global_requests: float = 0, global_tokens: float = 0):
+        """
+        Args:
+            backend: Хранилище ведер (по умолчанию — память процесса)
+            user_requests: Запросов в минуту на пользователя
+            user_tokens: Токенов в минуту на пользователя
+            global_requests: Запросов в минуту на весь бот
+            global_tokens: Токенов в минуту на весь бот
+        """
+        self.backend = backend or MemoryBucketBackend()
+        self.user_limits = [Limit("user_requests", user_requests), Limit("user_tokens", user_tokens)]
+        self.global_limits = [Limit("global_requests", global_requests), Limit("global_tokens", global_tokens)]
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        """Создать ограничитель с настройками из переменных окружения"""
+        kind = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+        if kind == "sqlite":
+            backend = SQLiteBucketBackend(os.getenv("RATE_LIMIT_DB_PATH", "rate_limits.db"))
+        elif kind == "redis":
+            import redis.asyncio as aioredis
+
+            backend = RedisBucketBackend(aioredis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0")))
+        elif kind == "memory":
+            backend = MemoryBucketBackend()
+        else:
+            raise ValueError(f"Неизвестный тип хранилища RATE_LIMIT_BACKEND: {kind}")
+
+        return cls(
+            backend,
+            user_requests=float(os.getenv("RATE_LIMIT_USER_RPM", 20)),
+            user_tokens=float(os.getenv("RATE_LIMIT_USER_TPM", 100_000)),
+            global_requests=float(os.getenv("RATE_LIMIT_GLOBAL_RPM", 0)),
+            global_tokens=float(os.getenv("RATE_LIMIT_GLOBAL_TPM", 0)),
+        )
+
+    async def admit(self, user_id: int, estimated_tokens: int) -> Admission:
+        """Проверить лимиты и списать стоимость запроса"""
+        checks = [
+            (f"user:{user_id}:{limit.name}", limit) for limit in self.user_limits
+        ] + [
+            (f"global:{limit.name}", limit) for limit in self.global_limits
+        ]
+        taken: List[Tuple[str, Limit, float]] = []
+        for key, limit in checks:
+            if limit.per_minute <= 0:
+                continue
+            # Запрос дороже емкости ведра иначе не прошел бы никогда
+            cost = min(1.0 if limit.name.endswith("requests") else float(estimated_tokens), limit.per_minute)
+            wait = await self.backend.take(key, limit, cost)
+            if wait > 0:
+                for taken_key, taken_limit, taken_cost in taken:
+                    await self.backend.take(taken_key, taken_limit, -taken_cost)
+                RATE_LIMITED.labels(reason=limit.name).inc()
+                return Admission(False, math.ceil(wait), limit.name)
+            taken.append((key, limit, cost))
+        return Admission(True)
+
+    async def close(self):
+        await self.backend.close()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Кэш ответов на первые сообщения разговора (типовые вопросы)
+
+Пока история пустая, ответ зависит только от системного промпта, модели и
+текста вопроса, поэтому одинаковые вопросы можно отвечать из памяти.
+Ключ — нормализованный текст плюс отпечаток промпта. Опционально похожие
+формулировки находятся через MinHash по символьным шинглам.
+"""
+
+import hashlib
+import logging
+import os
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_LOOKUPS = Counter(
+    "hr_bot_response_cache_lookups_total", "Обращения к кэшу ответов на первые сообщения", ["result"]
+)
+RESPONSE_CACHE_ENTRIES = Gauge("hr_bot_response_cache_entries", "Ответы в кэше первых сообщений")
+RESPONSE_CACHE_BYTES = Gauge("hr_bot_response_cache_bytes", "Оценка памяти, занятой кэшем ответов")
+
+_WORD = re.compile(r"\w+")
+
+# Параметры MinHash: 16 полос по 4 строки дают кандидата почти наверняка при сходстве от 0.8
+_NUM_PERM = 64
+_BANDS = 16
+_ROWS = _NUM_PERM // _BANDS
+_SHINGLE = 5
+_PRIME = (1 << 61) - 1
+_rng = random.Random(0x5EED)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(_NUM_PERM)]
+
+# Служебные поля записи, словарь и индекс — приблизительно
+_ENTRY_OVERHEAD = 512
+
+
+def normalize(text: str) -> str:
+    """Привести вопрос к канонической форме: регистр, ё, пунктуация и пробелы не важны"""
+    return " ".join(_WORD.findall(text.lower().replace("ё", "е")))
+
+
+def fingerprint(*parts: str) -> str:
+    """Отпечаток всего, от чего зависит ответ, кроме вопроса (промпт, модель и т.п.)"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def minhash(normalized: str) -> Tuple[int, ...]:
+    """Сигнатура MinHash по символьным шинглам (устойчива к окончаниям слов)"""
+    padded = f" {normalized} "
+    shingles = {padded[i:i + _SHINGLE] for i in range(max(1, len(padded) - _SHINGLE + 1))}
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+        for shingle in shingles
+    ]
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def _similarity(left: Tuple[int, ...], right: Tuple[int, ...]) -> float:
+    """Оценка коэффициента Жаккара по двум сигнатурам"""
+    return sum(1 for a, b in zip(left, right) if a == b) / _NUM_PERM
+
+
+def _bands(signature: Tuple[int, ...]) -> List[Tuple[int, Tuple[int, ...]]]:
+    return [(band, signature[band * _ROWS:(band + 1) * _ROWS]) for band in range(_BANDS)]
+
+
+class _Entry(NamedTuple):
+    response: str
+    expires: float
+    size: int
+    signature: Optional[Tuple[int, ...]]
+
+
+class ResponseCache:
+    """
+    LRU+TTL кэш ответов с бюджетом памяти.
+
+    Точное совпадение ищется по нормализованному тексту. Если задан порог
+    similarity, для промахов дополнительно ищутся похожие вопросы через
+    LSH-индекс по сигнатурам MinHash.
+    """
+
+    def __init__(self, namespace: str, max_bytes: int = 16 * 1024 * 1024, ttl: float = 24 * 3600,
+                 similarity: float = 0.0, min_fuzzy_chars: int = 20):
+        """
+        Args:
+            namespace: Отпечаток промпта и модели (см. fingerprint)
+            max_bytes: Бюджет памяти кэша
+            ttl: Время жизни ответа (секунды)
+            similarity: Порог сходства для нечеткого поиска (0 — только точные совпадения)
+            min_fuzzy_chars: Минимальная длина вопроса для нечеткого поиска
+        """
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.similarity = similarity
+        self.min_fuzzy_chars = min_fuzzy_chars
+
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._index: Dict[Tuple[int, Tuple[int, ...]], Set[str]] = {}
+
+        RESPONSE_CACHE_ENTRIES.set_function(lambda: len(self._entries))
+        RESPONSE_CACHE_BYTES.set_function(lambda: self._bytes)
+
+    @classmethod
+    def from_env(cls, *prompt_parts: str) -> Optional["ResponseCache"]:
+        """Создать кэш с настройками из переменных окружения или None, если он выключен"""
+        if os.getenv("RESPONSE_CACHE", "0") != "1":
+            return None
+        cache = cls(
+            fingerprint(*prompt_parts),
+            max_bytes=int(os.getenv("RESPONSE_CACHE_MB", 16)) * 1024 * 1024,
+            ttl=float(os.getenv("RESPONSE_CACHE_TTL", 24 * 3600)),
+            similarity=float(os.getenv("RESPONSE_CACHE_SIMILARITY", 0)),
+        )
+        logger.info(f"Кэш ответов на первые сообщения включен (промпт {cache.namespace})")
+        return cache
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _key(self, normalized: str) -> str:
+        return f"{self.namespace}:{normalized}"
+
+    def _fuzzy(self, normalized: str) -> bool:
+        return self.similarity > 0 and len(normalized) >= self.min_fuzzy_chars
+
+    def get(self, text: str) -> Optional[str]:
+        """Найти ответ на вопрос или None"""
+        normalized = normalize(text)
+        if not normalized:
+            return None
+        now = time.monotonic()
+
+        key = self._key(normalized)
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires > now:
+            self._entries.move_to_end(key)
+            RESPONSE_CACHE_LOOKUPS.labels(result="exact").inc()
+            return entry.response
+        if entry is not None:
+            self._remove(key)
+
+        if self._fuzzy(normalized):
+            signature = minhash(normalized)
+            candidates = set()
+            for band in _bands(signature):
+                candidates.update(self._index.get(band, ()))
+            best_key, best_score = None, self.similarity
+            for candidate in candidates:
+                score = _similarity(signature, self._entries[candidate].signature)
+                if score >= best_score:
+                    best_key, best_score = candidate, score
+            if best_key is not None:
+                entry = self._entries[best_key]
+                if entry.expires > now:
+                    self._entries.move_to_end(best_key)
+                    RESPONSE_CACHE_LOOKUPS.labels(result="similar").inc()
+                    return entry.response
+                self._remove(best_key)
+
+        RESPONSE_CACHE_LOOKUPS.labels(result="miss").inc()
+        return None
+
+    def put(self, text: str, response: str):
+        """Запомнить ответ на вопрос"""
+        normalized = normalize(text)
+        if not normalized or not response:
+            return
+        key = self._key(normalized)
+        size = len(key.encode("utf-8")) + len(response.encode("utf-8")) + _ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+
+        signature = minhash(normalized) if self._fuzzy(normalized) else None
+        self._entries[key] = _Entry(response, time.monotonic() + self.ttl, size, signature)
+        self._bytes += size
+        if signature is not None:
+            for band in _bands(signature):
+                self._index.setdefault(band, set()).add(key)
+
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        """Очистить кэш (например, после смены промпта)"""
+        self._entries.clear()
+        self._index.clear()
+        self._bytes = 0
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        if entry.signature is not None:
+            for band in _bands(entry.signature):
+                keys = self._index.get(band)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._index[band]
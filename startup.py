@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Быстрый старт для платформ с холодным запуском
+
+Бесплатный Render усыпляет сервис после 15 минут простоя, и время запуска
+видит пользователь, чье сообщение разбудило бота. Поэтому порт health
+check/вебхука открывается до импорта тяжелых зависимостей (anthropic,
+telegram, aiohttp): пока они грузятся, health check уже отвечает, а
+обновление Telegram ждет готовности бота на открытом соединении вместо
+ошибки и повторной доставки. Затем слушающий сокет передается BotWebServer.
+
+Модуль использует только стандартную библиотеку и metrics.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional, Tuple
+
+from metrics import CONTENT_TYPE, REGISTRY, Gauge
+
+logger = logging.getLogger(__name__)
+
+STARTUP_SECONDS = Gauge("hr_bot_startup_seconds", "Длительность этапов запуска процесса", ["phase"])
+
+# Обработчик вебхука из потока раннего сервера: (заголовок секрета, тело) -> HTTP статус
+WebhookForwarder = Callable[[str, bytes], int]
+
+
+def _process_age() -> float:
+    """Сколько секунд назад запущен процесс (время до первой строки Python); 0 — если неизвестно"""
+    try:
+        with open("/proc/self/stat") as stat, open("/proc/uptime") as uptime:
+            # Поля после имени процесса; starttime — 22-е поле, в тиках с загрузки системы
+            fields = stat.read().rsplit(")", 1)[1].split()
+            started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+            return max(0.0, float(uptime.read().split()[0]) - started)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class StartupTimer:
+    """
+    Разбивка запуска на последовательные этапы.
+
+    Каждая отметка mark(name) закрывает этап, начатый предыдущей отметкой,
+    поэтому сумма этапов равна полному времени запуска — как у
+    python -X importtime, но крупными блоками.
+    """
+
+    def __init__(self):
+        self.phases: List[Tuple[str, float]] = []
+        self._last = time.perf_counter()
+        self._started = self._last - _process_age()
+        self._reported = False
+        if self._last > self._started:
+            self.phases.append(("interpreter", self._last - self._started))
+
+    def mark(self, phase: str):
+        """Закончить текущий этап"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def elapsed(self) -> float:
+        """Секунд с запуска процесса"""
+        return time.perf_counter() - self._started
+
+    def report(self, phase: str = "ready"):
+        """Закрыть последний этап, записать разбивку в лог и метрики (один раз)"""
+        if self._reported:
+            return
+        self._reported = True
+        self.mark(phase)
+        for name, seconds in self.phases:
+            STARTUP_SECONDS.labels(phase=name).set(seconds)
+        total = sum(seconds for _, seconds in self.phases)
+        STARTUP_SECONDS.labels(phase="total").set(total)
+        breakdown = ", ".join(f"{name} {seconds * 1000:.0f}" for name, seconds in self.phases)
+        logger.info(f"Запуск за {total * 1000:.0f} мс ({breakdown})")
+
+
+TIMER = StartupTimer()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Health check, метрики и ожидание готовности для вебхука"""
+
+    server: "_EarlyHTTPServer"
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._reply(200, REGISTRY.render().encode("utf-8"), CONTENT_TYPE)
+        elif self.path in ("/", "/healthz"):
+            text = "HR Assistant Bot is running" if self.server.early.ready.is_set() else "HR Assistant Bot is starting"
+            self._reply(200, text.encode("utf-8"))
+        else:
+            self._reply(404, b"")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        early = self.server.early
+        # Обновление, разбудившее сервис, ждет готовности бота вместо повторной доставки
+        if not early.ready.wait(early.webhook_wait) or early.forward is None:
+            self._reply(503, b"")
+            return
+        try:
+            status = early.forward(self.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), body)
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления, принятого до запуска сервера: {e}")
+            status = 500
+        self._reply(status, b"")
+
+    def _reply(self, status: int, body: bytes, content_type: str = "text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Отключаем логирование health check запросов"""
+        pass
+
+
+class _EarlyHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    early: "EarlyServer"
+
+
+class EarlyServer:
+    """
+    HTTP сервер на stdlib в отдельном потоке, открывающий порт в первые миллисекунды.
+
+    До готовности GET / и /healthz отвечают 200, а POST ждут set_ready().
+    В режиме поллинга сервер так и остается health check'ом; в режиме
+    вебхука BotWebServer забирает слушающий сокет через detach().
+    """
+
+    def __init__(self, port: int, webhook_wait: float = 60.0):
+        """
+        Args:
+            port: Порт для прослушивания
+            webhook_wait: Сколько секунд POST ждет готовности бота
+        """
+        self.port = port
+        self.webhook_wait = webhook_wait
+        self.ready = threading.Event()
+        self.forward: Optional[WebhookForwarder] = None
+        self._httpd = _EarlyHTTPServer(("0.0.0.0", port), _Handler)
+        self._httpd.early = self
+        # Короткий интервал опроса: detach() ждет завершения цикла приема
+        self._thread = threading.Thread(target=self._httpd.serve_forever, args=(0.05,), name="early-http",
+                                        daemon=True)
+        self._thread.start()
+
+    def set_ready(self, forward: Optional[WebhookForwarder] = None):
+        """Бот готов: отпустить ожидающие POST в forward"""
+        self.forward = forward
+        self.ready.set()
+
+    def detach(self) -> socket.socket:
+        """Перестать принимать соединения и отдать слушающий сокет"""
+        self._httpd.shutdown()
+        return self._httpd.socket
+
+
+_early: Optional[EarlyServer] = None
+
+
+def fast_start_enabled() -> bool:
+    """Открывать порт заранее: FAST_START=1 (по умолчанию) и процесс слушает PORT (не воркер)"""
+    return os.getenv("FAST_START", "1") == "1" and os.getenv("BOT_ROLE", "standalone").lower() != "worker"
+
+
+def open_port_early(port: int) -> Optional[EarlyServer]:
+    """Открыть порт до тяжелых импортов; при ошибке бот откроет его позже обычным способом"""
+    global _early
+    try:
+        _early = EarlyServer(port)
+    except OSError as e:
+        logger.warning(f"Не удалось заранее открыть порт {port}: {e}")
+        return None
+    return _early
+
+
+def take_early_server(port: int) -> Optional[EarlyServer]:
+    """Забрать ранний сервер на этом порту (если он был открыт)"""
+    global _early
+    early = _early
+    if early is None or early.port != port:
+        return None
+    _early = None
+    return early
+
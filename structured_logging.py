@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Структурированные логи: JSON, контекст обновления, выборка и маскирование
+
+logging.basicConfig пишет в stderr прямо из event loop: при большом потоке
+сообщений каждая строка — синхронная запись. Здесь обработчик корня только
+кладет запись в очередь (QueueHandler), а форматирует и пишет ее отдельный
+поток (QueueListener).
+
+Каждая запись получает поля контекста (log_context): trace_id и update_id
+обновления Telegram и user_id, поэтому строки одного хода — от входящего
+сообщения до запроса к Claude — находятся по одному trace_id. Дополнительные
+поля передаются через extra, например:
+
+    logger.info(f"Сообщение от {user_id}", extra={"event": "message", "text": text})
+
+Частые INFO-события можно прореживать (LOG_SAMPLE), выборка одна на trace_id:
+ход либо виден целиком, либо не виден. WARNING и выше не прореживаются.
+Текст пользователей и имена маскируются (LOG_REDACT), как и токен бота в URL.
+"""
+
+import atexit
+import contextvars
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Dict
+
+from metrics import Counter
+
+LOG_SAMPLED_OUT = Counter("hr_bot_log_sampled_out_total", "Записи лога, отброшенные выборкой", ["event"])
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Поля с текстом пользователей и персональными данными
+REDACTED_FIELDS = frozenset({"text", "username", "first_name", "last_name"})
+_BOT_TOKEN = re.compile(r"\d{5,}:[\w-]{30,}")
+
+# Атрибуты стандартной записи: все остальное пришло через extra или из контекста
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_CONTEXT: contextvars.ContextVar[Dict] = contextvars.ContextVar("log_context", default={})
+
+
+def trace_id(update_id: int) -> str:
+    """
+    Идентификатор трассировки обновления Telegram
+
+    Выводится из update_id, а не генерируется: так он совпадает у диспетчера
+    и воркера, через которых прошло одно обновление.
+    """
+    return f"{update_id:x}"
+
+
+@contextmanager
+def log_context(**fields):
+    """Добавить поля ко всем записям лога внутри блока (и в задачах, созданных в нем)"""
+    token = _CONTEXT.set({**_CONTEXT.get(), **fields})
+    try:
+        yield
+    finally:
+        _CONTEXT.reset(token)
+
+
+def _redact_value(value) -> str:
+    """Длина и короткий хэш вместо текста: одинаковые сообщения все еще видно"""
+    text = str(value)
+    return f"<{len(text)} chars {hashlib.sha256(text.encode('utf-8')).hexdigest()[:8]}>"
+
+
+def record_fields(record: logging.LogRecord, redact: bool) -> Dict:
+    """Поля контекста и extra записи"""
+    fields = {}
+    for name, value in vars(record).items():
+        if name in _RECORD_ATTRIBUTES or name.startswith("_"):
+            continue
+        if redact and name in REDACTED_FIELDS and value is not None:
+            value = _redact_value(value)
+        fields[name] = value
+    return fields
+
+
+class ContextFilter(logging.Filter):
+    """Переносит поля log_context в запись (в потоке, где запись создана)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for name, value in _CONTEXT.get().items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Прореживание записей ниже WARNING по событию (extra event) или имени логгера.
+
+    Решение детерминировано по trace_id, поэтому у одного хода сохраняются
+    либо все прореживаемые записи, либо ни одной.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    @classmethod
+    def parse(cls, spec: str) -> "SamplingFilter":
+        """Разобрать настройку вида "message=0.1,httpx=0" """
+        rates = {}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            name, _, rate = item.partition("=")
+            rates[name.strip()] = float(rate)
+        return cls(rates)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        event = getattr(record, "event", None)
+        key = event if event in self.rates else record.name
+        rate = self.rates.get(key)
+        if rate is None or rate >= 1:
+            return True
+        trace = getattr(record, "trace_id", None)
+        point = zlib.crc32(trace.encode()) / 2 ** 32 if trace else random.random()
+        if point < rate:
+            return True
+        LOG_SAMPLED_OUT.labels(event=key).inc()
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+
+    def __init__(self, redact: bool = True):
+        super().__init__()
+        self.redact = redact
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": self._mask(record.getMessage()),
+        }
+        entry.update(record_fields(record, self.redact))
+        if record.exc_info:
+            entry["exc_type"] = record.exc_info[0].__name__
+            entry["exc"] = self._mask(self.formatException(record.exc_info))
+        elif record.exc_text:
+            entry["exc"] = self._mask(record.exc_text)
+        if record.stack_info:
+            entry["stack"] = self._mask(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+    def _mask(self, text: str) -> str:
+        """Токен бота в тексте (например, в URL Bot API из сообщения исключения)"""
+        return _BOT_TOKEN.sub("<token>", text) if self.redact else text
+
+
+class TextFormatter(logging.Formatter):
+    """Прежний текстовый формат с полями контекста в конце строки (для локального запуска)"""
+
+    def __init__(self, redact: bool = True):
+        super().__init__(TEXT_FORMAT)
+        self.redact = redact
+
+    def format(self, record: logging.LogRecord) -> str:
+        # Строка уже содержит трассировку исключения и стек, маскируется целиком
+        line = super().format(record)
+        if self.redact:
+            line = _BOT_TOKEN.sub("<token>", line)
+        fields = record_fields(record, self.redact)
+        if fields:
+            line += " [" + " ".join(f"{name}={value}" for name, value in fields.items()) + "]"
+        return line
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler без форматирования в вызывающем потоке.
+
+    Стандартный prepare() форматирует запись до постановки в очередь, то есть
+    в event loop; здесь в очередь уходит сама запись (с уже подставленными
+    аргументами сообщения), а JSON и трассировку исключения строит поток записи.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class _Listener(logging.handlers.QueueListener):
+    """QueueListener, который сам помнит, запущен ли поток записи: stop() можно вызывать повторно"""
+
+    running = False
+
+    def start(self):
+        super().start()
+        self.running = True
+
+    def stop(self):
+        """Остановить поток записи, дописав очередь (повторный вызов ничего не делает)"""
+        if self.running:
+            self.running = False
+            super().stop()
+
+
+def setup_logging(level: str = "INFO", fmt: str = "json", redact: bool = True,
+                  sample: str = "") -> logging.handlers.QueueListener:
+    """
+    Настроить корневой логгер: очередь в вызывающих потоках, запись в stderr из фонового потока
+
+    Args:
+        level: Уровень логирования
+        fmt: json или text
+        redact: Маскировать текст пользователей, имена и токен бота
+        sample: Доли сохраняемых записей по событиям или логгерам ("message=0.1,httpx=0")
+
+    Returns:
+        Запущенный QueueListener (останавливается при выходе из процесса)
+    """
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        if isinstance(handler, _DeferredQueueHandler):
+            handler.listener.stop()
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter(redact) if fmt == "json" else TextFormatter(redact))
+
+    handler = _DeferredQueueHandler(queue.SimpleQueue())
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter.parse(sample))
+    listener = _Listener(handler.queue, output, respect_handler_level=True)
+    handler.listener = listener
+    root.addHandler(handler)
+    listener.start()
+    # Дописать очередь до завершения процесса (atexit вызывается раньше logging.shutdown)
+    atexit.register(listener.stop)
+    return listener
+
+
+def setup_from_env() -> logging.handlers.QueueListener:
+    """Настроить логирование из переменных окружения"""
+    return setup_logging(
+        level=os.getenv("LOG_LEVEL", "INFO"),
+        fmt=os.getenv("LOG_FORMAT", "json").lower(),
+        redact=os.getenv("LOG_REDACT", "1") == "1",
+        sample=os.getenv("LOG_SAMPLE", ""),
+    )
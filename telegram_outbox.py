@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Единая очередь исходящих вызовов Telegram Bot API с учетом флуд-контроля
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set
+
+from telegram import Message
+from telegram.error import RetryAfter
+
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_SEND_SECONDS = Histogram(
+    "hr_bot_telegram_send_seconds", "Длительность вызовов Telegram Bot API", ["method"]
+)
+OUTBOX_DEPTH = Gauge("hr_bot_telegram_outbox_depth", "Вызовы Bot API, ожидающие отправки")
+OUTBOX_CHATS = Gauge("hr_bot_telegram_outbox_chats", "Чаты с вызовами в очереди на отправку")
+OUTBOX_WAIT = Histogram(
+    "hr_bot_telegram_outbox_wait_seconds", "Ожидание в очереди на отправку по приоритетам", ["priority"]
+)
+FLOOD_WAITS = Counter("hr_bot_telegram_flood_waits_total", "Ответы 429 (RetryAfter) от Telegram", ["method"])
+
+# Приоритеты: чем меньше, тем раньше
+PRIORITY_COMMAND = 0  # ответы на команды, служебные сообщения
+PRIORITY_REPLY = 1  # ответы Claude
+PRIORITY_STREAM = 2  # промежуточные правки потокового ответа
+
+_PRIORITY_NAMES = {PRIORITY_COMMAND: "command", PRIORITY_REPLY: "reply", PRIORITY_STREAM: "stream"}
+
+
+def retry_seconds(error: RetryAfter) -> float:
+    """retry_after может быть числом секунд или timedelta"""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+class _Request:
+    __slots__ = ("call", "method", "priority", "retries", "seq", "enqueued", "future")
+
+    def __init__(self, call: Callable[[], Awaitable[Any]], method: str, priority: int, retries: int,
+                 seq: int, future: asyncio.Future):
+        self.call = call
+        self.method = method
+        self.priority = priority
+        self.retries = retries
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.future = future
+
+
+class _Chat:
+    __slots__ = ("queue", "tokens", "updated", "paused_until", "busy")
+
+    def __init__(self, burst: float):
+        self.queue: Deque[_Request] = deque()
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.busy = False
+
+
+class TelegramOutbox:
+    """
+    Планировщик исходящих вызовов Bot API.
+
+    Telegram допускает около 30 сообщений в секунду на бота и около одного
+    в секунду на чат, а при превышении отвечает 429 с retry_after. Все
+    отправки бота проходят через эту очередь:
+    - общий token bucket и token bucket на каждый чат;
+    - внутри чата вызовы выполняются строго по очереди;
+    - между чатами первым уходит вызов с меньшим приоритетом
+      (ответ на команду раньше длинного ответа Claude);
+    - после 429 чат ставится на паузу retry_after, а вызов повторяется.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 max_retries: int = 3):
+        """
+        Args:
+            global_rate: Вызовов в секунду на весь бот (0 — без ограничения)
+            chat_rate: Вызовов в секунду на чат (0 — без ограничения)
+            chat_burst: Сколько вызовов в чат можно сделать подряд без паузы
+            max_retries: Повторов вызова после 429
+        """
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = max(1.0, chat_burst)
+        self.max_retries = max_retries
+
+        self._chats: Dict[int, _Chat] = {}
+        self._global_tokens = max(1.0, global_rate)
+        self._global_updated = time.monotonic()
+        self._seq = 0
+        self._depth = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # Вызовы, уже взятые из очереди: ссылки держат задачи от сборщика мусора, close() их дожидается
+        self._sending: Set[asyncio.Task] = set()
+
+        OUTBOX_DEPTH.set_function(lambda: self._depth)
+        OUTBOX_CHATS.set_function(lambda: sum(1 for chat in self._chats.values() if chat.queue or chat.busy))
+
+    @classmethod
+    def from_env(cls) -> "TelegramOutbox":
+        """Создать очередь с настройками из переменных окружения"""
+        return cls(
+            global_rate=float(os.getenv("TELEGRAM_GLOBAL_RATE", 30)),
+            chat_rate=float(os.getenv("TELEGRAM_CHAT_RATE", 1)),
+            chat_burst=float(os.getenv("TELEGRAM_CHAT_BURST", 3)),
+        )
+
+    async def submit(self, chat_id: int, call: Callable[[], Awaitable[Any]], method: str,
+                     priority: int = PRIORITY_REPLY, retries: Optional[int] = None) -> Any:
+        """
+        Поставить вызов в очередь чата и дождаться его результата
+
+        Args:
+            chat_id: Чат, в который идет вызов
+            call: Корутина-функция, выполняющая вызов Bot API
+            method: Имя метода для метрик
+            priority: Приоритет (PRIORITY_*)
+            retries: Повторов после 429 (по умолчанию max_retries; 0 — сразу вернуть RetryAfter)
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+        self._seq += 1
+        request = _Request(call, method, priority, self.max_retries if retries is None else retries,
+                           self._seq, loop.create_future())
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(self.chat_burst)
+        chat.queue.append(request)
+        self._depth += 1
+        self._wakeup.set()
+        return await request.future
+
+    async def reply_text(self, message: Message, text: str, priority: int = PRIORITY_REPLY) -> Message:
+        """Ответить на сообщение пользователя"""
+        return await self.submit(message.chat_id, lambda: message.reply_text(text), "sendMessage", priority)
+
+    async def edit_text(self, message: Message, text: str, priority: int = PRIORITY_STREAM,
+                        retries: Optional[int] = None):
+        """Отредактировать отправленное сообщение"""
+        return await self.submit(message.chat_id, lambda: message.edit_text(text), "editMessageText",
+                                 priority, retries)
+
+    async def send_action(self, message: Message, action: str = "typing"):
+        """Показать действие (например, «печатает»); при флуд-контроле не повторяется"""
+        return await self.submit(message.chat_id, lambda: message.chat.send_action(action), "sendChatAction",
+                                 PRIORITY_REPLY, retries=0)
+
+    async def close(self, timeout: float = 10.0):
+        """Дождаться отправки очереди и уже начатых вызовов (не дольше timeout) и остановить планировщик"""
+        deadline = time.monotonic() + timeout
+        while (self._depth or self._sending) and time.monotonic() < deadline:
+            if self._depth:
+                await asyncio.sleep(0.05)
+            else:
+                # Очередь пуста, но последние вызовы еще идут (после 429 вызов может вернуться в очередь)
+                await asyncio.wait(set(self._sending), timeout=deadline - time.monotonic())
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _chat_delay(self, chat: _Chat, now: float) -> float:
+        """Через сколько секунд чат сможет отправить следующий вызов"""
+        delay = chat.paused_until - now
+        if self.chat_rate > 0:
+            chat.tokens = min(self.chat_burst, chat.tokens + (now - chat.updated) * self.chat_rate)
+            chat.updated = now
+            if chat.tokens < 1:
+                delay = max(delay, (1 - chat.tokens) / self.chat_rate)
+        return max(0.0, delay)
+
+    def _global_delay(self, now: float) -> float:
+        if self.global_rate <= 0:
+            return 0.0
+        self._global_tokens = min(self.global_rate, self._global_tokens + (now - self._global_updated) * self.global_rate)
+        self._global_updated = now
+        return 0.0 if self._global_tokens >= 1 else (1 - self._global_tokens) / self.global_rate
+
+    def _pick(self, now: float):
+        """Готовый к отправке вызов с наименьшим (приоритет, номер) и время до следующего готового"""
+        best_id, best_key, wait = None, None, None
+        for chat_id, chat in list(self._chats.items()):
+            while chat.queue and chat.queue[0].future.done():
+                # Отправитель больше не ждет (например, ход отменен командой /new)
+                chat.queue.popleft()
+                self._depth -= 1
+            if chat.busy:
+                continue
+            delay = self._chat_delay(chat, now)
+            if not chat.queue:
+                # Чат забываем, только когда его ведро полное и пауза после 429 закончилась
+                if delay == 0 and chat.tokens >= self.chat_burst:
+                    del self._chats[chat_id]
+                continue
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            head = chat.queue[0]
+            key = (head.priority, head.seq)
+            if best_key is None or key < best_key:
+                best_id, best_key = chat_id, key
+        return best_id, wait
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            chat_id, wait = self._pick(now)
+            if chat_id is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            delay = self._global_delay(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            chat = self._chats[chat_id]
+            request = chat.queue.popleft()
+            self._depth -= 1
+            self._global_tokens -= 1
+            if self.chat_rate > 0:
+                chat.tokens -= 1
+            chat.busy = True
+            OUTBOX_WAIT.labels(priority=_PRIORITY_NAMES.get(request.priority, str(request.priority))).observe(
+                now - request.enqueued
+            )
+            task = loop.create_task(self._execute(chat, request))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _execute(self, chat: _Chat, request: _Request):
+        try:
+            with TELEGRAM_SEND_SECONDS.labels(method=request.method).time():
+                result = await request.call()
+        except RetryAfter as e:
+            FLOOD_WAITS.labels(method=request.method).inc()
+            pause = retry_seconds(e)
+            chat.paused_until = time.monotonic() + pause
+            logger.warning(f"Telegram просит подождать {pause} с ({request.method})")
+            if request.retries > 0 and not request.future.done():
+                request.retries -= 1
+                chat.queue.appendleft(request)
+                self._depth += 1
+            elif not request.future.done():
+                request.future.set_exception(e)
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            if not request.future.done():
+                request.future.set_result(result)
+        finally:
+            chat.busy = False
+            self._wakeup.set()
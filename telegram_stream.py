@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Вывод ответа Claude в Telegram: разбивка на сообщения и потоковый вывод через редактирование
+"""
+
+import asyncio
+import logging
+import re
+import time
+from typing import List, Optional
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter
+
+from markdown_cleaner import MarkdownCleaner
+from telegram_outbox import PRIORITY_REPLY, PRIORITY_STREAM, TelegramOutbox
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Конец предложения: знак препинания (и, возможно, закрывающая кавычка или скобка) перед пробелом
+_SENTENCE_END = re.compile(r"[.!?…][»\")]?(?=\s)")
+
+
+def utf16_len(text: str) -> int:
+    """Длина в кодовых единицах UTF-16 — так Telegram считает лимит сообщения"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _fit(text: str, limit: int) -> int:
+    """Максимальная длина префикса в символах, который помещается в limit единиц UTF-16"""
+    end = min(len(text), limit)
+    while True:
+        excess = utf16_len(text[:end]) - limit
+        if excess <= 0:
+            return end
+        # Каждый символ занимает 1 или 2 единицы, поэтому сдвиг на excess не перескакивает ответ
+        end -= max(1, excess // 2)
+
+
+def split_point(text: str, limit: int) -> int:
+    """
+    Позиция разреза текста, не превышающего limit единиц UTF-16 до разреза
+
+    Предпочтения: граница абзаца, строки (в том числе пункта списка),
+    предложения, слова. Граница ищется во второй половине окна, чтобы
+    части не получались слишком короткими; если ее нет, текст режется по limit.
+    """
+    end = _fit(text, limit)
+    if end >= len(text):
+        return len(text)
+    window = text[:end + 1]
+    floor = end // 2
+    for separator in ("\n\n", "\n"):
+        index = window.rfind(separator, floor)
+        if index > 0:
+            return index
+    sentence = None
+    for match in _SENTENCE_END.finditer(window, floor):
+        sentence = match.end()
+    if sentence is not None and sentence <= end:
+        return sentence
+    index = window.rfind(" ", floor)
+    if index > 0:
+        return index
+    return end
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Разбить текст на сообщения Telegram по смысловым границам"""
+    parts = []
+    text = text.strip()
+    while text:
+        cut = split_point(text, limit)
+        part = text[:cut].rstrip()
+        if part:
+            parts.append(part)
+        text = text[cut:].lstrip()
+    return parts
+
+
+async def send_message_parts(outbox: TelegramOutbox, reply_to: Message, parts: List[str]) -> List[Message]:
+    """
+    Отправить части подряд, без промежуточных send_action
+
+    Все части сразу ставятся в очередь чата; очередь отправляет их по порядку
+    с учетом лимитов Telegram и повторяет после 429.
+    """
+    return list(await asyncio.gather(*(outbox.reply_text(reply_to, part) for part in parts)))
+
+
+class StreamingReply:
+    """
+    Показывает ответ по мере генерации.
+
+    Первый фрагмент отправляется сразу новым сообщением, дальше сообщение
+    редактируется не чаще, чем раз в min_interval секунд. Markdown очищается
+    инкрементально (MarkdownCleaner), поэтому каждый кусок текста
+    обрабатывается ровно один раз. Когда текст
+    перестает помещаться в лимит Telegram, текущее сообщение фиксируется
+    и вывод продолжается в новом.
+    """
+
+    def __init__(self, reply_to: Message, outbox: TelegramOutbox, min_interval: float = 1.0,
+                 limit: int = TELEGRAM_MESSAGE_LIMIT):
+        """
+        Args:
+            reply_to: Сообщение пользователя, на которое отвечаем
+            outbox: Очередь исходящих вызовов Bot API
+            min_interval: Минимальный интервал между редактированиями (секунды)
+            limit: Максимальная длина одного сообщения Telegram
+        """
+        self.reply_to = reply_to
+        self.outbox = outbox
+        self.min_interval = min_interval
+        self.limit = limit
+
+        self._cleaner = MarkdownCleaner()
+        self._final: Optional[str] = None
+        self._sent: List[Message] = []
+        self._current: Optional[Message] = None
+        self._current_offset = 0
+        self._shown = ""
+        self._last_edit = 0.0
+
+    @property
+    def text(self) -> str:
+        """Полный очищенный текст (после finish — окончательный)"""
+        if self._final is not None:
+            return self._final
+        return self._cleaner.text.strip()
+
+    @property
+    def messages(self) -> List[Message]:
+        """Все отправленные сообщения"""
+        return self._sent
+
+    async def feed(self, chunk: str):
+        """Добавить очередной фрагмент ответа"""
+        self._cleaner.feed(chunk)
+
+        if time.monotonic() - self._last_edit >= self.min_interval or self._current is None:
+            # Текст выравнивается так же, как окончательный, чтобы смещения частей совпадали
+            await self._render((self._cleaner.text + self._cleaner.preview()).lstrip())
+
+    async def finish(self) -> str:
+        """Очистить остаток, показать окончательный текст и вернуть его"""
+        self._final = self._cleaner.finish()
+        await self._render(self._final, final=True)
+        return self._final
+
+    async def _render(self, text: str, final: bool = False):
+        """Показать текст, при необходимости переходя к новому сообщению"""
+        visible = text[self._current_offset:].strip()
+        while utf16_len(visible) > self.limit:
+            cut = split_point(visible, self.limit)
+            await self._show(visible[:cut].rstrip(), required=True)
+            # Текущее сообщение заполнено — следующий текст пойдет в новое
+            self._current = None
+            self._shown = ""
+            start = len(text) - len(text[self._current_offset:].lstrip())
+            self._current_offset = start + cut
+            visible = text[self._current_offset:].strip()
+        if visible:
+            await self._show(visible, required=final)
+
+    async def _show(self, text: str, required: bool = False):
+        """
+        Отправить или отредактировать текущее сообщение.
+
+        Промежуточные обновления при флуд-контроле пропускаются,
+        а обязательные (окончательный текст) повторяются после паузы.
+        """
+        while text and text != self._shown:
+            try:
+                if self._current is None:
+                    self._current = await self.outbox.reply_text(self.reply_to, text)
+                    self._sent.append(self._current)
+                elif required:
+                    await self.outbox.edit_text(self._current, text, priority=PRIORITY_REPLY)
+                else:
+                    await self.outbox.edit_text(self._current, text, priority=PRIORITY_STREAM, retries=0)
+                self._shown = text
+            except RetryAfter:
+                # Очередь уже поставила чат на паузу retry_after
+                if not required:
+                    break
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+                self._shown = text
+        self._last_edit = time.monotonic()
+
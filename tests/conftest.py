@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""Общие настройки тестов: модули бота лежат в корне репозитория"""
+
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeClaude:
+    """
+    Заглушка ResilientClaude: отвечает заданными текстами и запоминает запросы
+
+    Ответ похож на anthropic.types.Message настолько, насколько это нужно боту.
+    """
+
+    def __init__(self, replies=("Ответ консультанта",), model: str = "claude-test", max_tokens: int = 4096):
+        self.replies = list(replies)
+        self.model = model
+        self.max_tokens = max_tokens
+        self.requests = []
+
+    async def create(self, request, mode: str = "sync"):
+        self.requests.append(request)
+        text = self.replies[min(len(self.requests), len(self.replies)) - 1]
+        return types.SimpleNamespace(
+            content=[types.SimpleNamespace(type="text", text=text)],
+            model=request["model"],
+            stop_reason="end_turn",
+            usage=types.SimpleNamespace(input_tokens=100, output_tokens=len(text.split()),
+                                        cache_read_input_tokens=0, cache_creation_input_tokens=0),
+        )
+
+
+@pytest.fixture
+def make_bot(monkeypatch):
+    """
+    Фабрика HRAssistantBot без сети: переменные окружения задаются аргументами,
+    Claude заменяется FakeClaude (доступен как bot.llm)
+    """
+    def make(replies=("Ответ консультанта",), **env):
+        for name in ("RESPONSE_CACHE", "KNOWLEDGE_RETRIEVAL", "PHASE_ROUTING", "USAGE_LEDGER", "CONVERSATION_SNAPSHOT",
+                     "KNOWLEDGE_INDEX", "CLAUDE_MODEL", "PROMPT_CACHING", "PROMPT_CACHE_HISTORY"):
+            monkeypatch.delenv(name, raising=False)
+        monkeypatch.setenv("CONVERSATION_STORE", "memory")
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        from hr_assistant_bot import HRAssistantBot
+
+        bot = HRAssistantBot("123456:TEST", "test")
+        bot.llm = FakeClaude(replies, model=bot.llm.model, max_tokens=bot.llm.max_tokens)
+        return bot
+
+    return make
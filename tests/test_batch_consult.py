@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""Пакетные консультации: порядок выхода, продолжение с контрольной точки и режим Message Batches"""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import types
+
+import pytest
+
+from batch_consult import NO_TEXT, BatchJob, Consultant
+from prompts import SYSTEM_PROMPT
+
+
+class Crash(BaseException):
+    """Остановка прогона посреди записей (как при убитом процессе)"""
+
+
+class EchoClaude:
+    """Заглушка ResilientClaude: отвечает текстом записи, записи с «медленно» отвечают дольше"""
+
+    model = "claude-haiku-4-5"
+    max_tokens = 1024
+
+    def __init__(self, crash_on: str = None):
+        self.crash_on = crash_on
+        self.requests = []
+        self.client = None
+
+    async def create(self, request, mode: str = "sync"):
+        self.requests.append(request)
+        text = request["messages"][0]["content"]
+        if text == self.crash_on:
+            raise Crash()
+        if text == "ошибка":
+            raise RuntimeError("сбой API")
+        await asyncio.sleep(0.05 if "медленно" in text else 0.001)
+        return types.SimpleNamespace(
+            content=[types.SimpleNamespace(type="text", text=f"**Ответ:** {text}")],
+            usage=types.SimpleNamespace(input_tokens=10, output_tokens=5,
+                                        cache_read_input_tokens=0, cache_creation_input_tokens=0),
+        )
+
+
+def write_input(path, lines):
+    path.write_text("\n".join(json.dumps(line, ensure_ascii=False) if isinstance(line, dict) else line
+                              for line in lines) + "\n", encoding="utf-8")
+
+
+def read_output(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_import_has_no_bot_side_effects():
+    code = ("import logging, sys, batch_consult; "
+            "print('hr_assistant_bot' in sys.modules, 'telegram' in sys.modules, len(logging.getLogger().handlers))")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert result.stdout.split() == ["False", "False", "0"]
+
+
+def test_prompt_cached_only_above_model_minimum():
+    consultant = Consultant(EchoClaude())
+    params = consultant.params("Сотрудник опаздывает")
+    # SYSTEM_PROMPT короче минимума claude-haiku-4-5 (4096 токенов): разметка кэша бесполезна
+    assert params["system"] == [{"type": "text", "text": SYSTEM_PROMPT}]
+    assert params["messages"] == [{"role": "user", "content": "Сотрудник опаздывает"}]
+
+    llm = EchoClaude()
+    llm.model = "claude-sonnet-4-5"
+    assert "cache_control" in Consultant(llm).params("текст")["system"][-1]
+    assert Consultant(llm, instruction="Выдели причины").params("текст")["messages"][0]["content"] == \
+        "Выдели причины\n\nтекст"
+
+
+def test_concurrent_output_follows_input_order(tmp_path):
+    source, output = tmp_path / "input.jsonl", tmp_path / "output.jsonl"
+    write_input(source, [{"id": "a", "text": "медленно"}, {"id": "b", "text": "быстро"}, "не json", "",
+                         {"text": "без id"}, {"id": "e", "text": "ошибка"}, {"id": "f"}])
+
+    job = BatchJob(Consultant(EchoClaude()), str(source), str(output), concurrency=4)
+    summary = asyncio.run(job.run())
+
+    results = read_output(output)
+    assert [result["id"] for result in results] == ["a", "b", 3, 5, "e", "f"]
+    assert results[0]["response"] == "Ответ: медленно" and results[0]["usage"]["input"] == 10
+    assert results[2]["error"] == NO_TEXT and results[5]["error"] == NO_TEXT
+    assert results[4]["error"] == "RuntimeError: сбой API"
+    assert summary["records"] == 6 and summary["input_tokens"] == 30
+
+
+def test_resume_after_crash_writes_each_record_once(tmp_path):
+    source, output = tmp_path / "input.jsonl", tmp_path / "output.jsonl"
+    write_input(source, [{"id": index, "text": f"запись {index}"} for index in range(20)])
+
+    crashing = EchoClaude(crash_on="запись 12")
+    with pytest.raises(Crash):
+        asyncio.run(BatchJob(Consultant(crashing), str(source), str(output), concurrency=2, save_every=5).run())
+    written = read_output(output)
+    assert 0 < len(written) < 20
+
+    llm = EchoClaude()
+    asyncio.run(BatchJob(Consultant(llm), str(source), str(output), concurrency=2).run())
+    assert [result["id"] for result in read_output(output)] == list(range(20))
+    # Записи до контрольной точки повторно не запрашиваются
+    assert len(llm.requests) == 20 - len(written)
+
+
+class FakeBatchesClient:
+    """Низкоуровневые post/get клиента Anthropic для Message Batches API"""
+
+    def __init__(self):
+        self.created = []
+
+    async def post(self, path, cast_to, body):
+        self.created.append(body["requests"])
+        batch_id = f"batch-{len(self.created)}"
+        return types.SimpleNamespace(json=lambda: {"id": batch_id})
+
+    async def get(self, path, cast_to):
+        if not path.endswith("/results"):
+            return types.SimpleNamespace(json=lambda: {"processing_status": "ended", "results_url": path + "/results"})
+        requests = self.created[int(path.split("/")[-2].split("-")[1]) - 1]
+        lines = []
+        for request in requests:
+            text = request["params"]["messages"][0]["content"]
+            if text == "отклонено":
+                result = {"type": "errored", "error": {"error": {"message": "invalid_request"}}}
+            else:
+                result = {"type": "succeeded", "message": {
+                    "content": [{"type": "text", "text": f"__{text}__"}],
+                    "usage": {"input_tokens": 7, "output_tokens": 3}}}
+            lines.append(json.dumps({"custom_id": request["custom_id"], "result": result}, ensure_ascii=False))
+        return types.SimpleNamespace(text="\n".join(lines))
+
+
+def test_batches_mode(tmp_path):
+    source, output = tmp_path / "input.jsonl", tmp_path / "output.jsonl"
+    write_input(source, [{"id": 1, "text": "первый"}, {"id": 2}, {"id": 3, "text": "отклонено"},
+                         {"id": 4, "text": "четвертый"}, {"id": 5, "text": "пятый"}])
+    llm = EchoClaude()
+    llm.client = FakeBatchesClient()
+
+    job = BatchJob(Consultant(llm), str(source), str(output), batch_size=2, max_batches=2, poll_interval=0)
+    asyncio.run(job.run("batches"))
+
+    assert [len(requests) for requests in llm.client.created] == [1, 2, 1]
+    assert read_output(output) == [
+        {"id": 1, "response": "первый", "usage": {"input": 7, "output": 3, "cache_read": 0, "cache_creation": 0}},
+        {"id": 2, "error": NO_TEXT},
+        {"id": 3, "error": "invalid_request"},
+        {"id": 4, "response": "четвертый", "usage": {"input": 7, "output": 3, "cache_read": 0, "cache_creation": 0}},
+        {"id": 5, "response": "пятый", "usage": {"input": 7, "output": 3, "cache_read": 0, "cache_creation": 0}},
+    ]
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""Очередь ходов по чатам: без задержки первого хода, склейка во время ответа и порядок"""
+
+import asyncio
+
+from chat_queue import ChatTurnQueue
+
+
+class Recorder:
+    """Обработчик хода, который запоминает ходы и держит каждый turn_seconds"""
+
+    def __init__(self, turn_seconds: float = 0.05):
+        self.turn_seconds = turn_seconds
+        self.turns = []
+        self.started = []
+
+    async def __call__(self, chat_id: int, text: str, update):
+        self.started.append(asyncio.get_running_loop().time())
+        await asyncio.sleep(self.turn_seconds)
+        self.turns.append((chat_id, text, update))
+
+
+def test_default_sends_first_turn_without_delay(monkeypatch):
+    monkeypatch.delenv("CHAT_DEBOUNCE_SECONDS", raising=False)
+
+    async def run():
+        recorder = Recorder(turn_seconds=0)
+        queue = ChatTurnQueue.from_env(recorder)
+        submitted = asyncio.get_running_loop().time()
+        await queue.submit(1, "Привет", "u1")
+        return recorder.started[0] - submitted, recorder.turns
+
+    delay, turns = asyncio.run(run())
+    assert delay < 0.02
+    assert turns == [(1, "Привет", "u1")]
+
+
+def test_messages_during_turn_merged_in_order():
+    async def run():
+        recorder = Recorder()
+        queue = ChatTurnQueue(recorder)
+        first = asyncio.create_task(queue.submit(1, "первое", "u1"))
+        await asyncio.sleep(0.01)
+        # Пока обрабатывается первый ход, приходят еще два сообщения
+        rest = [asyncio.create_task(queue.submit(1, text, update))
+                for text, update in (("второе", "u2"), ("третье", "u3"))]
+        await asyncio.gather(first, *rest)
+        return recorder.turns, len(queue)
+
+    turns, active = asyncio.run(run())
+    assert turns == [(1, "первое", "u1"), (1, "второе\n\nтретье", "u3")]
+    assert active == 0
+
+
+def test_chats_processed_concurrently_but_each_in_order():
+    async def run():
+        recorder = Recorder(turn_seconds=0.02)
+        queue = ChatTurnQueue(recorder)
+        tasks = []
+        for index in range(3):
+            for chat_id in (1, 2):
+                tasks.append(asyncio.create_task(queue.submit(chat_id, f"{chat_id}:{index}", index)))
+            await asyncio.sleep(0.03)
+        await asyncio.gather(*tasks)
+        return recorder.turns
+
+    turns = asyncio.run(run())
+    for chat_id in (1, 2):
+        assert [text for chat, text, _ in turns if chat == chat_id] == [f"{chat_id}:{index}" for index in range(3)]
+
+
+def test_debounce_merges_messages_sent_in_a_row():
+    async def run():
+        recorder = Recorder(turn_seconds=0)
+        queue = ChatTurnQueue(recorder, debounce=0.05)
+        await asyncio.gather(queue.submit(1, "раз", "u1"), queue.submit(1, "два", "u2"))
+        return recorder.turns
+
+    assert asyncio.run(run()) == [(1, "раз\n\nдва", "u2")]
+
+
+def test_cancel_resolves_waiters():
+    async def run():
+        recorder = Recorder(turn_seconds=1.0)
+        queue = ChatTurnQueue(recorder)
+        task = asyncio.create_task(queue.submit(1, "долгий ход", "u1"))
+        await asyncio.sleep(0.01)
+        queue.cancel(1)
+        await asyncio.wait_for(task, timeout=0.5)
+        return recorder.turns
+
+    assert asyncio.run(run()) == []
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""Окно контекста: обрезка по бюджету токенов и фоновое краткое содержание"""
+
+import asyncio
+
+from context_window import SUMMARY_ROLE, ContextWindow, estimate_tokens, message_tokens
+
+
+def turn(role: str, tokens: int) -> dict:
+    return {"role": role, "content": f"{role} {tokens}", "tokens": tokens}
+
+
+def dialog(*tokens: int) -> list:
+    return [turn("user" if index % 2 == 0 else "assistant", count) for index, count in enumerate(tokens)]
+
+
+def test_estimate_is_cached_in_message():
+    message = {"role": "user", "content": "Привет"}
+    assert message_tokens(message) == estimate_tokens("Привет") == len("Привет".encode("utf-8")) // 4 + 4
+    message["content"] = "другой текст гораздо длиннее прежнего"
+    assert message_tokens(message) == estimate_tokens("Привет")
+
+
+def test_history_within_budget_is_kept():
+    history = dialog(100, 200, 100)
+    assert ContextWindow(budget_tokens=400).trim(history) == (history, [])
+
+
+def test_oldest_turns_dropped_and_window_starts_with_user():
+    history = dialog(100, 200, 100, 200, 100)
+    kept, dropped = ContextWindow(budget_tokens=350).trim(history)
+    # В бюджет влезают два последних сообщения, но окно не может начинаться с ответа консультанта
+    assert kept == history[4:]
+    assert dropped == history[:4]
+
+
+def test_last_message_kept_even_over_budget():
+    history = dialog(100, 200, 5000)
+    kept, dropped = ContextWindow(budget_tokens=1000).trim(history)
+    assert kept == history[2:] and dropped == history[:2]
+
+
+def test_summary_counts_against_budget_and_stays_first():
+    summary = {"role": SUMMARY_ROLE, "content": "Краткое содержание", "tokens": 300}
+    history = [summary] + dialog(100, 100, 100)
+    kept, dropped = ContextWindow(budget_tokens=450).trim(history)
+    assert kept == [summary, history[3]]
+    assert dropped == history[1:3]
+
+    text, messages = ContextWindow().request_parts(kept)
+    assert text == "Краткое содержание"
+    assert messages == [{"role": "user", "content": "user 100"}]
+
+
+def test_dropped_turns_summarized_in_background():
+    store = {1: []}
+    calls = []
+    release = asyncio.Event()
+
+    async def summarizer(user_id, previous, dropped):
+        calls.append((previous, [message["content"] for message in dropped]))
+        await release.wait()
+        return f"содержание {len(calls)}"
+
+    async def load(user_id):
+        return list(store[user_id])
+
+    async def save(user_id, history):
+        store[user_id] = history
+
+    async def scenario():
+        window = ContextWindow(budget_tokens=250, summarizer=summarizer)
+        history = []
+        for message in dialog(100, 100, 100, 100, 100, 100):
+            history, dropped = window.trim(history + [message])
+            store[1] = history
+            window.schedule_summary(1, dropped, load, save)
+            await asyncio.sleep(0)
+        # Пока идет первое сворачивание, новые вытесненные ходы копятся и сворачиваются следующим вызовом
+        release.set()
+        await asyncio.sleep(0.01)
+        return store[1]
+
+    result = asyncio.run(scenario())
+
+    assert calls[0] == ("", ["user 100", "assistant 100"])
+    assert calls[1][0] == "содержание 1"
+    assert result[0]["role"] == SUMMARY_ROLE and result[0]["content"] == f"содержание {len(calls)}"
+    assert [message["role"] for message in result[1:]] == ["user", "assistant"]
+
+
+def test_failed_summary_keeps_history_and_cancel_stops_task():
+    async def failing(user_id, previous, dropped):
+        raise RuntimeError("API недоступен")
+
+    async def scenario():
+        store = {1: dialog(100)}
+
+        async def load(user_id):
+            return store[user_id]
+
+        async def save(user_id, history):
+            store[user_id] = history
+
+        window = ContextWindow(summarizer=failing)
+        window.schedule_summary(1, dialog(100, 100), load, save)
+        await asyncio.sleep(0.01)
+        assert store[1] == dialog(100)
+
+        slow = ContextWindow(summarizer=lambda *args: asyncio.sleep(3600))
+        slow.schedule_summary(2, dialog(100), load, save)
+        task = slow._tasks[2]
+        slow.cancel(2)
+        await asyncio.sleep(0)
+        assert task.cancelled() and not slow._tasks
+
+    asyncio.run(scenario())
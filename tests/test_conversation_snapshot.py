@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""Снимок разговоров: запись при закрытии хранилища и восстановление при первом обращении"""
+
+import asyncio
+
+import pytest
+
+from context_window import SUMMARY_ROLE
+from conversation_snapshot import SnapshotReader, SnapshotWriter, open_snapshot
+from conversation_store import ConversationStore, MemoryBackend, SnapshotBackend
+
+
+def conversation(user_id: int, turns: int = 8) -> list:
+    """Разговор с длинными ходами (попадают под сжатие) и оценками токенов"""
+    messages = []
+    for index in range(turns):
+        role = "user" if index % 2 == 0 else "assistant"
+        messages.append({"role": role, "content": f"Ход {index} пользователя {user_id}. " * 20, "tokens": 100 + index})
+    return messages
+
+
+def summarized(user_id: int) -> list:
+    """Разговор, превысивший бюджет истории: первым идет краткое содержание"""
+    return [{"role": SUMMARY_ROLE, "content": f"Краткое содержание разговора {user_id}. " * 30}] + conversation(user_id, 4)
+
+
+async def export_and_restore(path: str, compression, histories: dict) -> dict:
+    store = ConversationStore(compression=compression, snapshot_path=path)
+    for user_id, messages in histories.items():
+        await store.put(user_id, messages)
+    await store.close()
+
+    restored = ConversationStore(SnapshotBackend(MemoryBackend(), open_snapshot(path)), compression=compression)
+    result = {user_id: await restored.get(user_id) for user_id in histories}
+    await restored.close()
+    return result
+
+
+@pytest.mark.parametrize("compression", ["zlib", None])
+def test_round_trip_with_summary(tmp_path, compression):
+    path = str(tmp_path / "conversations.snap")
+    histories = {1: conversation(1), 2: summarized(2), 3: [{"role": "user", "content": "Коротко"}]}
+
+    restored = asyncio.run(export_and_restore(path, compression, histories))
+
+    assert restored == histories
+
+
+def test_restored_only_once(tmp_path):
+    path = str(tmp_path / "conversations.snap")
+    with SnapshotWriter(path) as writer:
+        writer.add(7, summarized(7))
+
+    reader = SnapshotReader(path)
+    assert reader.take(7) == summarized(7)
+    assert reader.take(7) is None
+    assert reader.get(8) is None
+    reader.close()
+
+
+def test_untouched_records_carried_into_next_snapshot(tmp_path):
+    path = str(tmp_path / "conversations.snap")
+    asyncio.run(export_and_restore(path, "zlib", {1: conversation(1), 2: summarized(2)}))
+
+    async def touch_one():
+        store = ConversationStore(SnapshotBackend(MemoryBackend(), open_snapshot(path)), snapshot_path=path)
+        messages = await store.get(1)
+        await store.put(1, messages + [{"role": "user", "content": "Новый ход"}])
+        await store.close()
+
+    asyncio.run(touch_one())
+
+    reader = SnapshotReader(path)
+    assert dict(reader.items()) == {1: conversation(1) + [{"role": "user", "content": "Новый ход"}], 2: summarized(2)}
+    reader.close()
+
+
+def test_unknown_role_skips_only_that_conversation(tmp_path):
+    path = str(tmp_path / "conversations.snap")
+    histories = {1: conversation(1), 2: [{"role": "system", "content": "?"}]}
+
+    async def run():
+        store = ConversationStore(snapshot_path=path)
+        for user_id, messages in histories.items():
+            await store.put(user_id, messages)
+        await store.close()
+
+    asyncio.run(run())
+
+    reader = SnapshotReader(path)
+    assert dict(reader.items()) == {1: conversation(1)}
+    reader.close()
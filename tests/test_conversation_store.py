@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+"""Хранилище разговоров: бэкенды Redis и SQLite, TTL и отложенная запись"""
+
+import asyncio
+import json
+
+import pytest
+
+from conversation_store import ConversationStore, RedisBackend, SQLiteBackend
+
+
+class SimpleRedis:
+    """Заглушка асинхронного клиента Redis без конвейера: строки и срок жизни ключей по ручным часам"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.data = {}
+        self.expires = {}
+        self.commands = []
+        self.closed = False
+
+    def _alive(self, key: str) -> bool:
+        if key in self.expires and self.expires[key] <= self.now:
+            del self.data[key], self.expires[key]
+        return key in self.data
+
+    async def get(self, key: str):
+        self.commands.append(("get", key))
+        return self.data[key].encode("utf-8") if self._alive(key) else None
+
+    def _set(self, key: str, value: str, ex=None):
+        self.data[key] = value
+        if ex is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = self.now + ex
+
+    async def set(self, key: str, value: str, ex=None):
+        self.commands.append(("set", key))
+        self._set(key, value, ex)
+
+    async def delete(self, *keys: str):
+        self.commands.append(("delete",) + keys)
+        for key in keys:
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+
+    def ttl(self, key: str) -> float:
+        return self.expires[key] - self.now if self._alive(key) and key in self.expires else -1
+
+    async def aclose(self):
+        self.closed = True
+
+
+class FakeRedis(SimpleRedis):
+    """Заглушка клиента с конвейером, как у redis.asyncio.Redis"""
+
+    def pipeline(self, transaction: bool = True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis: SimpleRedis):
+        self.redis = redis
+        self.queued = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def set(self, key: str, value: str, ex=None):
+        self.queued.append((key, value, ex))
+
+    async def execute(self):
+        self.redis.commands.append(("pipeline", len(self.queued)))
+        for key, value, ex in self.queued:
+            self.redis._set(key, value, ex)
+        self.queued = []
+
+
+def history(user_id: int, turns: int = 3) -> list:
+    return [{"role": "user" if index % 2 == 0 else "assistant", "content": f"Ход {index} от {user_id}"}
+            for index in range(turns)]
+
+
+def test_redis_put_get_and_ttl():
+    async def scenario():
+        redis = FakeRedis()
+        backend = RedisBackend(redis, ttl=60)
+        await backend.save_many({1: history(1), 2: history(2)})
+
+        assert redis.commands == [("pipeline", 2)]
+        assert json.loads(redis.data["hr_bot:conv:1"]) == history(1)
+        assert redis.ttl("hr_bot:conv:1") == 60
+        assert await backend.load(1) == history(1)
+        assert await backend.load(3) is None
+
+        redis.now = 59
+        assert await backend.load(2) == history(2)
+        # Запись продлевает срок жизни ключа
+        await backend.save_many({2: history(2, 5)})
+        redis.now = 61
+        assert await backend.load(1) is None
+        assert await backend.load(2) == history(2, 5)
+
+        await backend.delete_many([2])
+        assert await backend.load(2) is None
+        await backend.close()
+        assert redis.closed
+
+    asyncio.run(scenario())
+
+
+def test_redis_without_pipeline_and_ttl():
+    async def scenario():
+        redis = SimpleRedis()
+        backend = RedisBackend(redis, key_prefix="test:")
+        await backend.save_many({1: history(1), 2: history(2)})
+
+        assert redis.commands == [("set", "test:1"), ("set", "test:2")]
+        assert redis.ttl("test:1") == -1
+        assert await backend.load(2) == history(2)
+        await backend.delete_many([])
+        assert redis.commands[-1] == ("get", "test:2")
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_put_get_delete_and_reopen(tmp_path):
+    path = str(tmp_path / "conversations.db")
+
+    async def scenario():
+        backend = SQLiteBackend(path)
+        await backend.save_many({1: history(1), 2: history(2)})
+        await backend.save_many({2: history(2, 5)})
+        assert await backend.load(1) == history(1)
+        assert await backend.load(2) == history(2, 5)
+        assert await backend.load(3) is None
+        await backend.delete_many([1])
+        await backend.close()
+
+        reopened = SQLiteBackend(path)
+        assert await reopened.load(1) is None
+        assert await reopened.load(2) == history(2, 5)
+        await reopened.close()
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture(params=["redis", "sqlite"])
+def make_backend(request, tmp_path):
+    """Фабрика бэкенда; повторный вызов открывает то же хранилище заново"""
+    redis = FakeRedis()
+
+    def make():
+        if request.param == "redis":
+            return RedisBackend(redis, ttl=3600)
+        return SQLiteBackend(str(tmp_path / "conversations.db"))
+
+    return make
+
+
+def test_write_behind_flushes_after_interval(make_backend):
+    async def scenario():
+        backend = make_backend()
+        store = ConversationStore(backend, flush_interval=0.05, batch_size=100)
+        await store.put(1, history(1))
+        await store.put(2, history(2))
+
+        # Запись отложена: в бэкенде еще пусто, чтение идет из памяти
+        assert await backend.load(1) is None
+        assert await store.get(1) == history(1)
+
+        await asyncio.sleep(0.2)
+        assert await backend.load(1) == history(1)
+        assert await backend.load(2) == history(2)
+
+        await store.clear(2)
+        await store.put(1, history(1, 5))
+        await store.close()
+
+        reopened = make_backend()
+        assert await reopened.load(1) == history(1, 5)
+        assert await reopened.load(2) is None
+        await reopened.close()
+
+    asyncio.run(scenario())
+
+
+def test_write_behind_flushes_early_on_batch_size(make_backend):
+    async def scenario():
+        backend = make_backend()
+        store = ConversationStore(backend, flush_interval=60, batch_size=3)
+        for user_id in range(3):
+            await store.put(user_id, history(user_id))
+        await asyncio.sleep(0.05)
+
+        assert [await backend.load(user_id) for user_id in range(3)] == [history(user_id) for user_id in range(3)]
+        await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_evicted_conversation_reloads_from_backend(make_backend):
+    async def scenario():
+        backend = make_backend()
+        store = ConversationStore(backend, idle_ttl=0, flush_interval=60)
+        await store.put(1, history(1))
+        # Следующая вставка вытесняет простаивающий разговор, несохраненная версия ждет записи
+        await store.put(2, history(2))
+        assert 1 not in store._hot
+        assert await store.get(1) == history(1)
+
+        await store.flush()
+        await store.put(3, history(3))
+        assert 1 not in store._hot
+        assert await store.get(1) == history(1)
+        await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_failed_flush_keeps_changes():
+    class FailingRedis(FakeRedis):
+        fail = True
+
+        def pipeline(self, transaction: bool = True):
+            if self.fail:
+                raise ConnectionError("redis недоступен")
+            return super().pipeline(transaction)
+
+    async def scenario():
+        redis = FailingRedis()
+        store = ConversationStore(RedisBackend(redis), flush_interval=60)
+        await store.put(1, history(1))
+        with pytest.raises(ConnectionError):
+            await store.flush()
+        # Более свежая версия не затирается старой из неудачной пачки
+        await store.put(1, history(1, 5))
+
+        redis.fail = False
+        await store.close()
+        assert json.loads(redis.data["hr_bot:conv:1"]) == history(1, 5)
+
+    asyncio.run(scenario())
+
+
+def long_history(turns: int) -> list:
+    return [{"role": "user" if index % 2 == 0 else "assistant",
+             "content": f"Ход {index}: " + "подробный ответ про адаптацию сотрудника " * 20}
+            for index in range(turns)]
+
+
+def test_pack_reuses_cold_turns_without_decompressing():
+    async def scenario():
+        store = ConversationStore(hot_turns=2)
+        await store.put(1, long_history(6))
+        cold = [turn for turn in store._hot[1].turns if turn.packed]
+        assert len(cold) == 4
+
+        def forbidden(data):
+            raise AssertionError("прежняя версия истории распакована")
+
+        store._decompress = forbidden
+        # Новый ход в конце и обрезка начала: сжатые ходы переиспользуются как есть
+        await store.put(1, long_history(7)[1:])
+        reused = store._hot[1].turns
+        assert reused[:3] == tuple(cold[1:])
+        # Текст той же длины с другой концовкой не совпадает по контрольной сумме
+        changed = long_history(7)[1:]
+        changed[0]["content"] = changed[0]["content"][:-1] + "!"
+        repacked = store._pack(changed, store._hot[1])
+        assert repacked[0] is not reused[0] and repacked[1:3] == reused[1:3]
+        await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_repeated_gets_decode_once():
+    async def scenario():
+        store = ConversationStore(hot_turns=1, decoded_users=1)
+        await store.put(1, long_history(4))
+        await store.put(2, long_history(4))
+        decoded = []
+        decompress = store._decompress
+        store._decompress = lambda data: decoded.append(data) or decompress(data)
+
+        # Второй пользователь только что записан, первый вытеснен из разобранных
+        for _ in range(4):
+            messages = await store.get(2)
+        assert messages == long_history(4) and decoded == []
+        for _ in range(4):
+            messages = await store.get(1)
+        assert messages == long_history(4) and len(decoded) == 3
+
+        # Изменения вызывающего кода не попадают в кэш
+        messages[0]["content"] = "изменено"
+        messages[0]["tokens"] = 1
+        messages.append({"role": "user", "content": "новое"})
+        assert await store.get(1) == long_history(4)
+        await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_memory_eviction_loses_history_with_warning(caplog):
+    async def scenario():
+        store = ConversationStore(idle_ttl=0)
+        await store.put(1, history(1))
+        await store.flush()
+        await store.put(2, history(2))
+        return await store.get(1)
+
+    with caplog.at_level("WARNING", logger="conversation_store"):
+        assert asyncio.run(scenario()) == []
+    assert "история потеряна" in caplog.text
+
+
+def test_get_returns_copy_of_pending_and_loaded_history(make_backend):
+    async def scenario():
+        backend = make_backend()
+        await backend.save_many({2: history(2)})
+        store = ConversationStore(backend, idle_ttl=0, flush_interval=60)
+        await store.put(1, history(1))
+        # Вытеснение оставляет несохраненную версию только в _dirty
+        await store.put(3, history(3))
+        assert 1 not in store._hot
+
+        for user_id in (1, 2):
+            messages = await store.get(user_id)
+            messages.append({"role": "user", "content": "не сохранено"})
+            messages[0]["content"] = "изменено"
+        assert store._dirty[1] == history(1)
+        assert await store.get(2) == history(2)
+        await store.close()
+
+    asyncio.run(scenario())
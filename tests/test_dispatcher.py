@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""Диспетчер воркеров: повтор передачи обновлений и health check при остановке поллера"""
+
+import asyncio
+import json
+
+from dispatcher import Dispatcher, UpdateTransport
+from web_server import BotWebServer
+
+
+class FlakyTransport(UpdateTransport):
+    """Очереди в памяти, первые failures вызовов put падают (как при недоступном Redis)"""
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.items = []
+
+    async def put(self, worker: int, data):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("Redis недоступен")
+        self.items.append((worker, data))
+
+
+class FakeUpdate:
+    def __init__(self, update_id: int, chat_id: int):
+        self.update_id = update_id
+        self.chat_id = chat_id
+
+    def to_dict(self):
+        return {"update_id": self.update_id, "message": {"chat": {"id": self.chat_id}, "text": str(self.update_id)}}
+
+
+class FakeBot:
+    """getUpdates отдает заранее заданные пачки, затем ждет бесконечно"""
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.offsets = []
+
+    async def delete_webhook(self):
+        pass
+
+    async def get_updates(self, offset, **kwargs):
+        self.offsets.append(offset)
+        if self.batches:
+            return self.batches.pop(0)
+        await asyncio.Event().wait()
+
+
+def test_poll_retries_failed_route_without_losing_updates():
+    async def run():
+        transport = FlakyTransport(failures=3)
+        dispatcher = Dispatcher(transport, workers=2)
+        bot = FakeBot([[FakeUpdate(1, 10), FakeUpdate(2, 11)], [FakeUpdate(3, 10)]])
+        task = asyncio.create_task(dispatcher.poll(bot, retry_delay=0.001))
+        while len(transport.items) < 3:
+            await asyncio.sleep(0.01)
+        assert dispatcher.healthy
+        task.cancel()
+        return transport.items, bot.offsets
+
+    items, offsets = asyncio.run(run())
+    assert [data["update_id"] for _, data in items] == [1, 2, 3]
+    # Следующий getUpdates подтверждает только переданные обновления
+    assert offsets[:2] == [0, 3]
+
+
+def test_health_fails_when_poller_dies():
+    class BrokenBot(FakeBot):
+        async def get_updates(self, offset, **kwargs):
+            raise RuntimeError("неожиданная ошибка")
+
+    async def run():
+        dispatcher = Dispatcher(FlakyTransport(), workers=1)
+        server = BotWebServer(0, health_check=lambda: dispatcher.healthy)
+        assert (await server.handle_health(None)).status == 200
+        task = dispatcher.start_polling(BrokenBot([]))
+        await asyncio.gather(task, return_exceptions=True)
+        return (await server.handle_health(None)).status
+
+    assert asyncio.run(run()) == 503
+
+
+def test_webhook_route_failure_returns_500_for_redelivery():
+    async def run():
+        dispatcher = Dispatcher(FlakyTransport(failures=1), workers=1)
+        server = BotWebServer(0, on_update=dispatcher.route)
+        body = json.dumps(FakeUpdate(5, 10).to_dict()).encode()
+        return await server.process_update("", body), await server.process_update("", body)
+
+    assert asyncio.run(run()) == (500, 200)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""Пулы HTTP-соединений: переиспользование соединений, метрики и настройки транспорта Telegram"""
+
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from http_pool import HTTP_CONNECTIONS, HTTP_REQUESTS, HttpPool
+
+
+def count(counter, client: str) -> float:
+    return counter.labels(client=client).get()
+
+
+async def api_server() -> TestServer:
+    async def messages(request: web.Request) -> web.Response:
+        return web.json_response({"ok": True}, headers={"request-id": "req_test"})
+
+    app = web.Application()
+    app.router.add_post("/v1/messages", messages)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+def test_client_reuses_connections_and_counts_them(caplog):
+    async def scenario():
+        server = await api_server()
+        pool = HttpPool(http2=False, keepalive_expiry=30)
+        client = pool.client("pool-test", size=4)
+        requests, connections = count(HTTP_REQUESTS, "pool-test"), count(HTTP_CONNECTIONS, "pool-test")
+        try:
+            for _ in range(3):
+                response = await client.post(str(server.make_url("/v1/messages")), json={})
+                assert response.status_code == 200
+        finally:
+            await client.aclose()
+            await server.close()
+        return count(HTTP_REQUESTS, "pool-test") - requests, count(HTTP_CONNECTIONS, "pool-test") - connections
+
+    with caplog.at_level("INFO", logger="http_pool"):
+        requests, connections = asyncio.run(scenario())
+    # Последовательные запросы идут по одному открытому соединению
+    assert (requests, connections) == (3, 1)
+    assert [record.request_id for record in caplog.records] == ["req_test"] * 3
+
+
+def test_limits_and_timeouts():
+    pool = HttpPool(http2=False, keepalive_expiry=90, connect_timeout=2, pool_timeout=3)
+    limits = pool.limits(8)
+    assert (limits.max_connections, limits.max_keepalive_connections, limits.keepalive_expiry) == (8, 8, 90)
+    timeout = pool.timeout(None)
+    assert (timeout.connect, timeout.pool, timeout.read) == (2, 3, None)
+
+
+def test_http2_falls_back_without_h2(monkeypatch):
+    monkeypatch.setattr("http_pool.importlib.util.find_spec", lambda name: None)
+    assert HttpPool(http2=True).http2 is False
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setenv("HTTP2", "0")
+    monkeypatch.setenv("HTTP_KEEPALIVE_EXPIRY", "120")
+    monkeypatch.setenv("HTTP_CONNECT_TIMEOUT", "1.5")
+    pool = HttpPool.from_env()
+    assert (pool.http2, pool.keepalive_expiry, pool.connect_timeout, pool.pool_timeout) == (False, 120, 1.5, 5.0)
+
+
+def test_telegram_request_keeps_pool_settings_after_restart():
+    async def scenario():
+        request = HttpPool(http2=False, keepalive_expiry=45).telegram_request(size=6, read_timeout=7)
+        clients = []
+        for _ in range(2):
+            await request.initialize()
+            clients.append(request._client)
+            await request.shutdown()
+        return clients
+
+    clients = asyncio.run(scenario())
+    # Клиент пересоздается python-telegram-bot, но с теми же лимитами и хуками
+    assert clients[0] is not clients[1]
+    for client in clients:
+        pool = client._transport._pool
+        assert (pool._max_connections, pool._max_keepalive_connections, pool._keepalive_expiry) == (6, 6, 45)
+        assert client.timeout.read == 7
+        assert len(client.event_hooks["request"]) == 1
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""База знаний: разбиение документов, поиск BM25 и проверка собранного индекса"""
+
+import logging
+
+import pytest
+
+import knowledge_base
+from knowledge_base import BM25Index, KnowledgeBase, chunk_markdown, documents_digest, load_documents, open_index
+
+DOCUMENTS = {
+    "feedback.md": "# Обратная связь\n\nМодель SBI: ситуация, поведение, влияние.\n\n"
+                   "## Пример\n\nОпишите ситуацию и поведение сотрудника без оценок.",
+    "meetings/one_on_one.md": "# Встреча один на один\n\nРегулярная встреча руководителя и сотрудника раз в неделю.",
+    "notes.txt": "Делегирование: задачу передают вместе с полномочиями.",
+}
+
+
+@pytest.fixture
+def knowledge_dir(tmp_path):
+    directory = tmp_path / "knowledge"
+    for name, text in DOCUMENTS.items():
+        path = directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text, encoding="utf-8")
+    (directory / "image.png").write_bytes(b"\x89PNG")
+    return directory
+
+
+def test_chunks_split_by_headings():
+    chunks = chunk_markdown("feedback.md", DOCUMENTS["feedback.md"])
+    assert [(chunk.title, chunk.text) for chunk in chunks] == [
+        ("Обратная связь", "Модель SBI: ситуация, поведение, влияние."),
+        ("Обратная связь — Пример", "Опишите ситуацию и поведение сотрудника без оценок."),
+    ]
+
+
+def test_search_ranks_relevant_chunks(knowledge_dir):
+    index = BM25Index.build(load_documents(str(knowledge_dir)))
+    assert {chunk.source for chunk in index.chunks} == {"feedback.md", "meetings/one_on_one.md", "notes.txt"}
+    (score, best), *_ = index.search("как провести встречу один на один с сотрудником")
+    assert best.source == "meetings/one_on_one.md" and score > 0
+    assert index.search("квантовая хромодинамика") == []
+
+    base = KnowledgeBase(index, top_k=3, min_score_ratio=0.9)
+    context = base.context("делегирование полномочий")
+    assert context.startswith("СПРАВОЧНЫЕ МАТЕРИАЛЫ") and "полномочиями" in context and "SBI" not in context
+
+
+def test_saved_index_matches_built(knowledge_dir, tmp_path):
+    built = BM25Index.build(load_documents(str(knowledge_dir)))
+    built.source_digest = documents_digest(str(knowledge_dir))
+    built.save(str(tmp_path / "knowledge.idx"))
+    loaded = BM25Index.load(str(tmp_path / "knowledge.idx"))
+
+    assert loaded.source_digest == built.source_digest and loaded.version == built.version
+    for query in ("обратная связь по модели SBI", "встреча раз в неделю", "передать задачу"):
+        assert [(round(score, 4), chunk) for score, chunk in loaded.search(query)] == \
+               [(round(score, 4), chunk) for score, chunk in built.search(query)]
+
+
+def test_python_search_matches_numpy(knowledge_dir, monkeypatch):
+    if knowledge_base.np is None:
+        pytest.skip("NumPy не установлен")
+    chunks = load_documents(str(knowledge_dir))
+    expected = BM25Index.build(chunks).search("ситуация и поведение сотрудника")
+    monkeypatch.setattr(knowledge_base, "np", None)
+    found = BM25Index.build(chunks).search("ситуация и поведение сотрудника")
+    assert [chunk for _, chunk in found] == [chunk for _, chunk in expected]
+    assert [score for score, _ in found] == pytest.approx([score for score, _ in expected], rel=1e-5)
+
+
+def test_digest_tracks_documents_and_chunk_size(knowledge_dir):
+    digest = documents_digest(str(knowledge_dir))
+    assert digest == documents_digest(str(knowledge_dir))
+    assert documents_digest(str(knowledge_dir), max_chars=400) != digest
+    (knowledge_dir / "notes.txt").write_text("Делегирование: задачу передают с полномочиями.", encoding="utf-8")
+    assert documents_digest(str(knowledge_dir)) != digest
+    assert documents_digest(str(knowledge_dir / "missing")) is None
+
+
+def test_stale_index_is_rebuilt(knowledge_dir, tmp_path, caplog):
+    index_path = str(tmp_path / "knowledge.idx")
+    built = BM25Index.build(load_documents(str(knowledge_dir)))
+    built.source_digest = documents_digest(str(knowledge_dir))
+    built.save(index_path)
+
+    index, source = open_index(index_path, str(knowledge_dir))
+    assert source == index_path
+
+    (knowledge_dir / "conflicts.md").write_text("# Конфликты\n\nМедиация спора в команде.", encoding="utf-8")
+    with caplog.at_level(logging.WARNING, logger="knowledge_base"):
+        index, source = open_index(index_path, str(knowledge_dir))
+    assert source == str(knowledge_dir) and "не соответствует документам" in caplog.text
+    assert index.search("медиация спора")[0][1].source == "conflicts.md"
+
+    # Без каталога документов рядом собранный индекс используется как есть
+    index, source = open_index(index_path, str(tmp_path / "missing"))
+    assert source == index_path and len(index.chunks) == len(built.chunks)
+
+
+def test_index_without_digest_is_rebuilt(knowledge_dir, tmp_path):
+    index_path = str(tmp_path / "knowledge.idx")
+    BM25Index.build(load_documents(str(knowledge_dir))).save(index_path)
+    index, source = open_index(index_path, str(knowledge_dir))
+    assert source == str(knowledge_dir) and index.source_digest == documents_digest(str(knowledge_dir))
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""Клиент Claude: планировщик запросов, повторы, дублирование запросов и резервная модель"""
+
+import asyncio
+import types
+from email.utils import formatdate
+
+import anthropic
+import httpx
+import pytest
+
+import llm_client
+from llm_client import CircuitBreaker, ClaudeScheduler, LLMUnavailable, ResilientClaude
+
+
+async def run_requests(scheduler: ClaudeScheduler, requests: list, hold: float = 0.01) -> list:
+    """Запустить запросы (user_id, метка) одновременно; вернуть порядок получения слота и пик параллельности"""
+    order = []
+    peak = [0]
+
+    async def request(user_id: int, label: str):
+        async with scheduler.slot(user_id):
+            order.append(label)
+            peak[0] = max(peak[0], scheduler.in_flight)
+            await asyncio.sleep(hold)
+
+    await asyncio.gather(*(request(user_id, label) for user_id, label in requests))
+    return order, peak[0]
+
+
+def test_concurrency_limit():
+    async def scenario():
+        scheduler = ClaudeScheduler(max_concurrency=3)
+        order, peak = await run_requests(scheduler, [(user_id, str(user_id)) for user_id in range(10)])
+        assert sorted(order) == sorted(str(user_id) for user_id in range(10))
+        assert peak == 3
+        assert scheduler.in_flight == 0 and scheduler.queue_depth == 0
+
+    asyncio.run(scenario())
+
+
+def test_round_robin_between_users():
+    async def scenario():
+        scheduler = ClaudeScheduler(max_concurrency=1)
+        # Пользователь 1 присылает пять запросов подряд, затем по одному — пользователи 2 и 3
+        requests = [(1, f"a{index}") for index in range(5)] + [(2, "b0"), (3, "c0")]
+        order, _ = await run_requests(scheduler, requests, hold=0.001)
+        # Первый запрос занял свободный слот сразу, дальше слоты раздаются по кругу
+        assert order == ["a0", "a1", "b0", "c0", "a2", "a3", "a4"]
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_queue_and_slot():
+    async def scenario():
+        scheduler = ClaudeScheduler(max_concurrency=1)
+        release = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot(1):
+                await release.wait()
+
+        async def waiter(user_id: int):
+            async with scheduler.slot(user_id):
+                return user_id
+
+        first = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(waiter(2))
+        served = asyncio.create_task(waiter(3))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 2
+
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 1
+        release.set()
+        assert await served == 3
+        await first
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert scheduler.in_flight == 0 and scheduler.queue_depth == 0
+
+    asyncio.run(scenario())
+
+
+def test_overload_and_wait_estimate():
+    async def scenario():
+        scheduler = ClaudeScheduler(max_concurrency=1, max_queue=2)
+        release = asyncio.Event()
+
+        async def request(user_id: int):
+            async with scheduler.slot(user_id):
+                await release.wait()
+
+        tasks = [asyncio.create_task(request(user_id)) for user_id in range(3)]
+        await asyncio.sleep(0)
+        assert scheduler.overloaded
+        assert scheduler.estimated_wait() == pytest.approx((2 / 1 + 1) * 5.0)
+        release.set()
+        await asyncio.gather(*tasks)
+        assert not scheduler.overloaded
+
+    asyncio.run(scenario())
+
+
+def test_invalid_concurrency():
+    with pytest.raises(ValueError):
+        ClaudeScheduler(max_concurrency=0)
+
+
+def api_error(status: int, headers=None) -> anthropic.APIStatusError:
+    request = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    error_class = {400: anthropic.BadRequestError, 429: anthropic.RateLimitError}.get(
+        status, anthropic.InternalServerError)
+    return error_class(f"status {status}", response=response, body=None)
+
+
+class FakeMessages:
+    """
+    Заглушка client.messages: по каждой модели — очередь исходов
+    (исключение, задержка в секундах перед ответом или текст ответа)
+    """
+
+    def __init__(self, script):
+        self.script = {model: list(outcomes) for model, outcomes in script.items()}
+        self.calls = []
+
+    async def create(self, model, timeout=None, **request):
+        self.calls.append(model)
+        outcome = self.script[model].pop(0)
+        delay = 0.0
+        if isinstance(outcome, tuple):
+            delay, outcome = outcome
+        await asyncio.sleep(delay)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return types.SimpleNamespace(model=model, text=outcome)
+
+    def stream(self, model, timeout=None, **request):
+        self.calls.append(model)
+        return FakeStream(model, self.script[model].pop(0))
+
+
+class FakeStream:
+    def __init__(self, model, outcome):
+        self.model = model
+        self.outcome = outcome
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    @property
+    async def text_stream(self):
+        for item in self.outcome:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    async def get_final_message(self):
+        return types.SimpleNamespace(model=self.model, text="".join(self.outcome))
+
+
+def claude(script, **kwargs) -> ResilientClaude:
+    kwargs.setdefault("base_delay", 0.001)
+    return ResilientClaude(types.SimpleNamespace(messages=FakeMessages(script)), "main", **kwargs)
+
+
+REQUEST = {"model": "main", "max_tokens": 10, "messages": [{"role": "user", "content": "вопрос"}]}
+
+
+def test_retries_transient_errors():
+    llm = claude({"main": [api_error(529), anthropic.APIConnectionError(request=httpx.Request("POST", "https://x")),
+                           "ответ"]})
+    response = asyncio.run(llm.create(REQUEST))
+    assert response.text == "ответ"
+    assert llm.client.messages.calls == ["main"] * 3
+
+
+def test_client_errors_are_not_retried():
+    llm = claude({"main": [api_error(400), "ответ"]})
+    with pytest.raises(anthropic.BadRequestError):
+        asyncio.run(llm.create(REQUEST))
+    assert llm.client.messages.calls == ["main"]
+
+
+def test_fallback_model_after_attempts_exhausted():
+    llm = claude({"main": [api_error(529)] * 2, "reserve": ["резервный ответ"]},
+                 fallback_model="reserve", max_attempts=2)
+    response = asyncio.run(llm.create(REQUEST))
+    assert (response.model, response.text) == ("reserve", "резервный ответ")
+    assert llm.client.messages.calls == ["main", "main", "reserve"]
+
+
+def test_retry_after_headers():
+    assert llm_client._retry_after(api_error(429, {"retry-after-ms": "1500"})) == 1.5
+    assert llm_client._retry_after(api_error(429, {"retry-after": "7"})) == 7.0
+    assert 55 <= llm_client._retry_after(api_error(429, {"retry-after": formatdate(llm_client.time.time() + 60,
+                                                                                  usegmt=True)})) <= 60
+    assert llm_client._retry_after(api_error(500)) is None
+    # Пауза сервера ограничена max_delay, без заголовка — случайная в пределах экспоненты
+    llm = claude({}, max_delay=5.0, base_delay=1.0)
+    assert llm._backoff(1, api_error(429, {"retry-after": "30"})) == 5.0
+    assert 0 <= llm._backoff(3, api_error(500)) <= 4.0
+
+
+def test_breaker_opens_and_half_opens(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(llm_client.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("test-breaker", failure_rate=0.5, window=10, min_calls=4, reset_timeout=30)
+    for result in (True, False, True, False):
+        (breaker.record_success if result else breaker.record_failure)()
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow()
+
+    now[0] += 30
+    assert breaker.state == CircuitBreaker.HALF_OPEN and breaker.allow()
+    # Пробный запрос неудачен — снова открыт, удачен — закрыт
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    now[0] += 30
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_open_breaker_skips_model():
+    llm = claude({"main": ["не должен вызываться"]}, max_attempts=1)
+    breaker = llm._breaker("main")
+    breaker._state, breaker._opened_at = CircuitBreaker.OPEN, llm_client.time.monotonic()
+    with pytest.raises(LLMUnavailable):
+        asyncio.run(llm.create(REQUEST))
+    assert llm.client.messages.calls == []
+
+
+def test_hedged_request_wins_over_slow_primary():
+    llm = claude({"main": [(1.0, "медленный"), (0.0, "быстрый")]}, hedge_percentile=0.9, hedge_min_samples=5)
+    llm._latencies.extend([0.02] * 5)
+
+    async def scenario():
+        started = asyncio.get_running_loop().time()
+        response = await llm.create(REQUEST)
+        return response.text, asyncio.get_running_loop().time() - started
+
+    text, elapsed = asyncio.run(scenario())
+    assert text == "быстрый" and elapsed < 0.5
+    assert llm.client.messages.calls == ["main", "main"]
+
+
+def test_stream_not_retried_after_first_text():
+    chunks = []
+
+    async def on_text(text):
+        chunks.append(text)
+
+    llm = claude({"main": [[api_error(529)], ["Нача", "ло", api_error(529)]], "reserve": [["резерв"]]},
+                 fallback_model="reserve")
+
+    async def scenario():
+        with pytest.raises(anthropic.InternalServerError):
+            await llm.stream(REQUEST, on_text)
+
+    asyncio.run(scenario())
+    # Ошибка до первого фрагмента повторяется, после — нет: показанный текст не заменить
+    assert llm.client.messages.calls == ["main", "main"]
+    assert chunks == ["Нача", "ло"]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+"""Нагрузочный стенд: короткий прогон против заглушек и сравнение с базовым прогоном"""
+
+import argparse
+import asyncio
+
+import load_test
+
+
+def test_percentile_nearest_rank():
+    values = [5.0, 1.0, 4.0, 2.0, 3.0]
+    assert load_test.percentile(values, 50) == 3.0
+    assert load_test.percentile(values, 99) == 5.0
+    assert load_test.percentile([], 95) == 0.0
+
+
+def test_compare_with_baseline():
+    baseline = {"msgs_per_sec": 10.0, "latency_p95": 1.0, "latency_p99": 2.0}
+    assert load_test.compare_with_baseline(
+        {"msgs_per_sec": 8.5, "latency_p95": 1.1, "latency_p99": 2.3}, baseline, 0.2) == []
+    regressions = load_test.compare_with_baseline(
+        {"msgs_per_sec": 7.0, "latency_p95": 1.1, "latency_p99": 2.5}, baseline, 0.2)
+    assert [regression.split(":")[0] for regression in regressions] == ["msgs/sec", "latency_p99"]
+
+
+def test_short_run_against_fakes(monkeypatch):
+    for name, value in {"STREAM_RESPONSES": "0", "KNOWLEDGE_RETRIEVAL": "0", "PHASE_ROUTING": "0",
+                        "RESPONSE_CACHE": "0", "CONVERSATION_STORE": "memory",
+                        "RATE_LIMIT_USER_RPM": "0", "RATE_LIMIT_USER_TPM": "0"}.items():
+        monkeypatch.setenv(name, value)
+    args = argparse.Namespace(
+        users=3, messages=2, ttft=0.01, tokens_per_second=10000, output_tokens=50, error_rate=0.0, slow_rate=0.0,
+        telegram_latency=0.0, stream=False, log_level="WARNING",
+    )
+
+    result = asyncio.run(load_test.run_benchmark(args))
+
+    assert result["messages"] == 6
+    assert result["anthropic_requests"] == 6
+    assert result["failed_replies"] == 0
+    assert result["telegram_calls"].get("sendMessage", 0) >= 6
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""
+Очистка markdown: золотой корпус и совпадение потоковой очистки с разовой
+
+Золотые пары лежат в tests/golden/markdown: <имя>.md — ответ Claude,
+<имя>.txt — ожидаемый текст для Telegram.
+"""
+
+import pathlib
+import random
+
+import pytest
+
+from markdown_cleaner import MarkdownCleaner, clean_markdown
+
+GOLDEN = pathlib.Path(__file__).parent / "golden" / "markdown"
+CASES = sorted(path.stem for path in GOLDEN.glob("*.md"))
+
+# Кусочки, из которых собираются случайные ответы: разметка, ее обрывки и обычный текст
+TOKENS = (
+    "**", "*", "_", "__", "`", "```", "```python\n", "~~", "\n", "\n\n", " ", "  ", "# ", "## ", "* ", "- ",
+    "слово", "Word", "snake_case_name", "2*3", "user_id", "https://example.com/a_b*c_", ":", ".", "—",
+)
+
+
+def stream(text: str, cuts) -> str:
+    """Очистить текст потоком, разрезав его в позициях cuts"""
+    cleaner = MarkdownCleaner()
+    previous = 0
+    for cut in sorted(cuts):
+        cleaner.feed(text[previous:cut])
+        previous = cut
+    cleaner.feed(text[previous:])
+    return cleaner.finish()
+
+
+def test_corpus_is_not_empty():
+    assert {"code_fences", "lists", "nested_emphasis", "snake_case", "urls"} <= set(CASES)
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_golden(name):
+    source = (GOLDEN / f"{name}.md").read_text(encoding="utf-8")
+    expected = (GOLDEN / f"{name}.txt").read_text(encoding="utf-8")
+    assert clean_markdown(source) == expected.rstrip("\n")
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_golden_streamed_in_arbitrary_chunks(name):
+    source = (GOLDEN / f"{name}.md").read_text(encoding="utf-8")
+    expected = clean_markdown(source)
+    generator = random.Random(name)
+    for _ in range(200):
+        cuts = generator.sample(range(1, len(source)), generator.randint(0, min(40, len(source) - 1)))
+        assert stream(source, cuts) == expected
+    # Крайний случай: по одному символу
+    assert stream(source, range(1, len(source))) == expected
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_streaming_matches_one_shot_on_random_text(seed):
+    generator = random.Random(seed)
+    text = "".join(generator.choice(TOKENS) for _ in range(generator.randint(1, 60)))
+    cuts = generator.sample(range(1, len(text)), generator.randint(0, len(text) - 1)) if len(text) > 1 else []
+    assert stream(text, cuts) == clean_markdown(text)
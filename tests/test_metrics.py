@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""Реестр метрик: текстовый формат Prometheus"""
+
+import pytest
+
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter_and_gauge_render():
+    registry = Registry()
+    requests = Counter("test_requests_total", "Запросы", ["stage", "type"], registry=registry)
+    requests.labels(stage="claude", type='Bad"Quote\\').inc()
+    requests.labels(stage="claude", type='Bad"Quote\\').inc(2)
+    users = Gauge("test_users", "Пользователи", registry=registry)
+    users.set(3)
+    users.dec()
+    broken = Gauge("test_broken", "Функция с ошибкой", registry=registry)
+    broken.set_function(lambda: 1 / 0)
+
+    assert registry.render().splitlines() == [
+        "# HELP test_requests_total Запросы",
+        "# TYPE test_requests_total counter",
+        'test_requests_total{stage="claude",type="Bad\\"Quote\\\\"} 3',
+        "# HELP test_users Пользователи",
+        "# TYPE test_users gauge",
+        "test_users 2",
+        "# HELP test_broken Функция с ошибкой",
+        "# TYPE test_broken gauge",
+        "test_broken nan",
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = Histogram("test_latency_seconds", "Задержка", ["mode"], buckets=(1.0, 0.1), registry=registry)
+    for value in (0.05, 0.5, 0.7, 3.0):
+        latency.labels(mode="sync").observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'test_latency_seconds_bucket{mode="sync",le="0.1"} 1',
+        'test_latency_seconds_bucket{mode="sync",le="1"} 3',
+        'test_latency_seconds_bucket{mode="sync",le="+Inf"} 4',
+        'test_latency_seconds_sum{mode="sync"} 4.25',
+        'test_latency_seconds_count{mode="sync"} 4',
+    ]
+
+
+def test_labels_required_and_names_unique():
+    registry = Registry()
+    labelled = Counter("test_labelled_total", "С метками", ["kind"], registry=registry)
+    with pytest.raises(ValueError):
+        labelled.inc()
+    with pytest.raises(ValueError):
+        Counter("test_labelled_total", "Повтор", registry=registry)
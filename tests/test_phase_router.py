@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""Маршрутизация по фазам консультации: классификация истории, лимиты и продолжение ответа"""
+
+import asyncio
+
+import pytest
+
+from phase_router import PHASE_CLARIFY, PHASE_FINAL, PhaseRouter, Route
+
+
+def turns(*texts):
+    """История из чередующихся реплик пользователя и ассистента (первая — пользователя)"""
+    return [{"role": "user" if index % 2 == 0 else "assistant", "content": text} for index, text in enumerate(texts)]
+
+
+@pytest.fixture
+def router():
+    return PhaseRouter("claude-final", 4096, clarify_model="claude-clarify", clarify_max_tokens=1024,
+                       max_questions=3, context_chars=300, final_answer_chars=500)
+
+
+@pytest.mark.parametrize("history, expected", [
+    (turns("Сотрудник постоянно опаздывает, что делать?"), (PHASE_CLARIFY, "first")),
+    (turns("Сотрудник опаздывает", "Как давно это происходит?", "Около месяца"), (PHASE_CLARIFY, "answered")),
+    (turns("Сотрудник опаздывает", "Как давно?", "Месяц. Что мне делать?"), (PHASE_FINAL, "asked")),
+    (turns("Сотрудник опаздывает", "Понятно. Расскажу подход.", "Хорошо"), (PHASE_FINAL, "no_question")),
+    (turns("Ситуация", "Вопрос 1?", "Ответ", "Вопрос 2?", "Ответ", "Вопрос 3?", "Ответ"), (PHASE_FINAL, "questions")),
+    (turns("Подробно: " + "контекст " * 40), (PHASE_FINAL, "context")),
+    (turns("Ситуация", "Диагностика: ... План действий: ... Есть вопросы?", "Да, еще один"),
+     (PHASE_FINAL, "follow_up")),
+    ([{"role": "summary", "content": "Краткое содержание"}] + turns("Продолжим"), (PHASE_FINAL, "summarized")),
+])
+def test_classify(router, history, expected):
+    assert router.classify(history) == expected
+
+
+def test_route_limits_and_extra_tokens(router):
+    clarify = router.route(turns("Сотрудник опаздывает"))
+    assert clarify == Route(PHASE_CLARIFY, "claude-clarify", 1024, "first", 3072)
+
+    # Дневной бюджет ограничивает обе фазы
+    assert router.route(turns("Сотрудник опаздывает"), limit=512) == \
+        Route(PHASE_CLARIFY, "claude-clarify", 512, "first", 0)
+    final = router.route(turns("Ситуация", "Ясно.", "Что делать?"), limit=2048)
+    assert final == Route(PHASE_FINAL, "claude-final", 2048, "asked", 0)
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.delenv("PHASE_ROUTING", raising=False)
+    assert PhaseRouter.from_env("claude-test", 4096) is None
+    monkeypatch.setenv("PHASE_ROUTING", "1")
+    monkeypatch.setenv("PHASE_CLARIFY_MAX_TOKENS", "8192")
+    router = PhaseRouter.from_env("claude-test", 4096)
+    # Лимит уточнения не больше общего лимита, модели по умолчанию — CLAUDE_MODEL
+    assert (router.clarify_model, router.clarify_max_tokens, router.final_model) == ("claude-test", 4096, "claude-test")
+
+
+def test_bot_continues_clarifying_reply_cut_at_limit(make_bot):
+    async def scenario():
+        bot = make_bot(["**Вопрос:** как давно", " это происходит?"], PHASE_ROUTING="1",
+                       PHASE_CLARIFY_MODEL="claude-clarify", PHASE_CLARIFY_MAX_TOKENS="256")
+        create = bot.llm.create
+
+        async def cut_first(request, mode="sync"):
+            response = await create(request, mode)
+            if len(bot.llm.requests) == 1:
+                response.stop_reason = "max_tokens"
+            return response
+
+        bot.llm.create = cut_first
+        reply = await bot.get_claude_response(1, "Сотрудник постоянно опаздывает")
+        await bot.conversation_store.close()
+        return reply, bot.llm.requests, bot.llm.max_tokens
+
+    reply, (first, continuation), max_tokens = asyncio.run(scenario())
+    assert (first["model"], first["max_tokens"]) == ("claude-clarify", 256)
+    # Продолжение дописывает ответ с того же места в пределах оставшегося лимита
+    assert continuation["messages"][-1] == {"role": "assistant", "content": "**Вопрос:** как давно"}
+    assert continuation["max_tokens"] == max_tokens - 256
+    assert reply == "Вопрос: как давно это происходит?"
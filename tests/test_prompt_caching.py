@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Кэширование промпта: граница кэша только там, где префикс достигает минимума модели"""
+
+import asyncio
+
+from llm_client import min_cacheable_tokens, with_cache_breakpoint
+
+# Ход пользователя около 1000 токенов по оценке estimate_tokens
+LONG_TURN = "Сотрудник срывает сроки, а на встречах молчит и не предлагает решений. " * 30
+
+
+def cached_blocks(request: dict) -> list:
+    """Места границ кэша в запросе: ("system", номер блока) или ("message", номер сообщения)"""
+    marks = [("system", index) for index, block in enumerate(request["system"]) if "cache_control" in block]
+    for index, message in enumerate(request["messages"]):
+        if isinstance(message["content"], list) and any("cache_control" in block for block in message["content"]):
+            marks.append(("message", index))
+    return marks
+
+
+def plain(message: dict) -> dict:
+    """Сообщение без разметки кэша — для сравнения префиксов соседних запросов"""
+    content = message["content"]
+    if isinstance(content, list):
+        content = [{key: value for key, value in block.items() if key != "cache_control"} for block in content]
+        if len(content) == 1:
+            content = content[0]["text"]
+    return {"role": message["role"], "content": content}
+
+
+async def conversation(bot, turns: int) -> list:
+    for _ in range(turns):
+        await bot.get_claude_response(1, LONG_TURN)
+    await bot.conversation_store.close()
+    return bot.llm.requests
+
+
+def test_min_cacheable_tokens():
+    assert min_cacheable_tokens("claude-haiku-4-5-20251001") == 4096
+    assert min_cacheable_tokens("claude-opus-4-5") == 4096
+    assert min_cacheable_tokens("claude-3-5-haiku-latest") == 2048
+    assert min_cacheable_tokens("claude-sonnet-4-5") == 1024
+
+
+def test_with_cache_breakpoint_marks_copy():
+    messages = [{"role": "user", "content": "вопрос"}, {"role": "assistant", "content": "ответ"},
+                {"role": "user", "content": [{"type": "text", "text": "еще"}]}]
+    marked = with_cache_breakpoint(messages, -2)
+
+    assert marked[1] == {"role": "assistant",
+                         "content": [{"type": "text", "text": "ответ", "cache_control": {"type": "ephemeral"}}]}
+    assert marked[0] is messages[0] and marked[2] is messages[2]
+    assert messages[1]["content"] == "ответ"
+    assert "cache_control" in with_cache_breakpoint(messages)[2]["content"][0]
+    assert "cache_control" not in messages[2]["content"][0]
+
+
+def test_short_system_prompt_is_not_marked_for_default_model(make_bot):
+    bot = make_bot(CLAUDE_MODEL="claude-haiku-4-5-20251001")
+    assert bot.static_prompt_tokens < 4096
+
+    requests = asyncio.run(conversation(bot, 3))
+
+    assert all(cached_blocks(request) == [] for request in requests)
+
+
+def test_system_prompt_marked_when_long_enough(make_bot):
+    bot = make_bot(CLAUDE_MODEL="claude-sonnet-4-5")
+
+    requests = asyncio.run(conversation(bot, 2))
+
+    assert all(cached_blocks(request) == [("system", 0)] for request in requests)
+
+
+def test_history_breakpoint_once_prefix_reaches_minimum(make_bot):
+    bot = make_bot(CLAUDE_MODEL="claude-haiku-4-5-20251001", PROMPT_CACHE_HISTORY="1")
+
+    requests = asyncio.run(conversation(bot, 4))
+
+    # Промпт ~2500 токенов: до минимума 4096 префикс дорастает со второго ответа
+    assert [cached_blocks(request) for request in requests] == [[], [], [("message", 3)], [("message", 5)]]
+    # Префикс до границы третьего запроса повторяется в четвертом без изменений
+    assert requests[2]["system"] == requests[3]["system"]
+    assert [plain(message) for message in requests[3]["messages"][:4]] == \
+        [plain(message) for message in requests[2]["messages"][:4]]
+
+
+def test_knowledge_goes_into_current_turn(make_bot):
+    bot = make_bot(CLAUDE_MODEL="claude-sonnet-4-5", KNOWLEDGE_RETRIEVAL="1", PROMPT_CACHE_HISTORY="1")
+
+    async def scenario():
+        await bot.get_claude_response(1, "Как провести встречу один на один с сотрудником?")
+        await bot.get_claude_response(1, "Сотрудник типа P по Адизесу, срывает сроки, что делать?")
+        await bot.conversation_store.close()
+        return bot.llm.requests
+
+    first, second = asyncio.run(scenario())
+
+    # Системный промпт не зависит от подобранных фрагментов, а история хранит только текст пользователя
+    assert first["system"] == second["system"] and len(second["system"]) == 1
+    context, text = second["messages"][-1]["content"]
+    assert context["text"].startswith("СПРАВОЧНЫЕ МАТЕРИАЛЫ") and text["text"].startswith("Сотрудник типа P")
+    assert plain(second["messages"][0]) == {"role": "user", "content": "Как провести встречу один на один с сотрудником?"}
+    assert cached_blocks(second) == [("system", 0), ("message", 1)]
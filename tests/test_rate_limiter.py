@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Допуск запросов: ведра на пользователя и на бот, возврат списанного, общее хранилище"""
+
+import asyncio
+
+import pytest
+
+import rate_limiter
+from rate_limiter import Admission, Limit, MemoryBucketBackend, RateLimiter, SQLiteBucketBackend
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Ручные часы для обоих видов времени, которые использует модуль"""
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(rate_limiter.time, "time", lambda: now[0])
+    return now
+
+
+def admit_all(limiter: RateLimiter, requests) -> list:
+    async def scenario():
+        return [await limiter.admit(user_id, tokens) for user_id, tokens in requests]
+
+    return asyncio.run(scenario())
+
+
+def test_requests_per_user_refill(clock):
+    limiter = RateLimiter(user_requests=3, user_tokens=0)
+
+    results = admit_all(limiter, [(1, 10)] * 4 + [(2, 10)])
+    assert results[:3] == [Admission(True)] * 3
+    # Ведро пополняется на 3 запроса в минуту — следующий через 20 секунд
+    assert results[3] == Admission(False, 20, "user_requests")
+    assert results[4].allowed
+
+    clock[0] += 20
+    assert admit_all(limiter, [(1, 10), (1, 10)]) == [Admission(True), Admission(False, 20, "user_requests")]
+
+
+def test_token_limit_refunds_request(clock):
+    limiter = RateLimiter(user_requests=2, user_tokens=1000)
+
+    assert admit_all(limiter, [(1, 800), (1, 800)]) == [Admission(True), Admission(False, 36, "user_tokens")]
+    # Отклоненный по токенам запрос не израсходовал ведро запросов
+    assert admit_all(limiter, [(1, 100)]) == [Admission(True)]
+    assert admit_all(limiter, [(1, 100)])[0].reason == "user_requests"
+
+
+def test_request_larger_than_bucket_still_passes_when_full(clock):
+    limiter = RateLimiter(user_requests=0, user_tokens=1000)
+    assert admit_all(limiter, [(1, 50_000), (1, 10)]) == [Admission(True), Admission(False, 1, "user_tokens")]
+
+
+def test_global_limit_shared_by_users(clock):
+    limiter = RateLimiter(user_requests=10, user_tokens=0, global_requests=2)
+    results = admit_all(limiter, [(1, 1), (2, 1), (3, 1)])
+    assert [result.allowed for result in results] == [True, True, False]
+    assert results[2].reason == "global_requests"
+    # Пользователю 3 отказали по общему лимиту — его личное ведро не тронуто
+    clock[0] += 30
+    assert admit_all(limiter, [(3, 1)]) == [Admission(True)]
+
+
+def test_zero_limits_disable_checks(clock):
+    limiter = RateLimiter(user_requests=0, user_tokens=0)
+    assert all(result.allowed for result in admit_all(limiter, [(1, 10 ** 9)] * 100))
+
+
+def test_sqlite_buckets_shared_between_processes(tmp_path, clock):
+    path = str(tmp_path / "limits.db")
+
+    async def scenario():
+        first = RateLimiter(SQLiteBucketBackend(path), user_requests=2, user_tokens=0)
+        second = RateLimiter(SQLiteBucketBackend(path), user_requests=2, user_tokens=0)
+        results = [await first.admit(1, 1), await second.admit(1, 1), await first.admit(1, 1)]
+        await first.close()
+        await second.close()
+        return results
+
+    assert asyncio.run(scenario()) == [Admission(True), Admission(True), Admission(False, 30, "user_requests")]
+
+
+def test_memory_backend_prunes_refilled_buckets(clock):
+    async def scenario():
+        backend = MemoryBucketBackend(sweep_every=4)
+        limit = Limit("requests", 6)  # ведро пополняется по единице за 10 с
+        for user_id in range(3):
+            await backend.take(f"user:{user_id}", limit, 1)
+        clock[0] += 5
+        # Ведро user:0 списано снова и еще не полное — оно переживает чистку
+        assert await backend.take("user:0", limit, 2) == 0
+        assert set(backend._buckets) == {"user:0", "user:1", "user:2"}
+
+        clock[0] += 10
+        for _ in range(4):
+            await backend.take("user:3", limit, 1)
+        assert set(backend._buckets) == {"user:0", "user:3"}
+
+        # Удаленное ведро снова начинается полным, как и было бы без чистки
+        clock[0] += 60
+        assert [await backend.take("user:1", limit, 6), await backend.take("user:1", limit, 1)] == [0, 10]
+
+    asyncio.run(scenario())
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""Кэш ответов на первые сообщения: нормализация, срок жизни, бюджет памяти, похожие вопросы"""
+
+import asyncio
+
+import response_cache
+from response_cache import ResponseCache, fingerprint, normalize
+
+
+def test_normalize_ignores_case_punctuation_and_yo():
+    assert normalize("  Как  провести ВСТРЕЧУ один-на-один?!") == "как провести встречу один на один"
+    assert normalize("Сотрудник ещё не ответил") == normalize("сотрудник еще не ответил.")
+    assert normalize("?!...") == ""
+
+
+def test_exact_hit_and_prompt_namespace():
+    cache = ResponseCache(fingerprint("промпт", "модель"))
+    cache.put("Как дать обратную связь?", "Используйте модель SBI.")
+
+    assert cache.get("как дать обратную связь") == "Используйте модель SBI."
+    assert cache.get("Как дать обратную связь сотруднику?") is None
+    # Ответ от другого промпта или модели не подходит
+    assert ResponseCache(fingerprint("промпт", "другая модель")).get("Как дать обратную связь?") is None
+    assert fingerprint("промпт", "модель") != fingerprint("промптмодель")
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "monotonic", lambda: now[0])
+    cache = ResponseCache("ns", ttl=60)
+    cache.put("Вопрос", "Ответ")
+
+    now[0] += 59
+    assert cache.get("Вопрос") == "Ответ"
+    now[0] += 2
+    assert cache.get("Вопрос") is None
+    assert len(cache) == 0
+
+
+def test_memory_budget_evicts_least_recently_used():
+    answer = "ответ " * 100
+    entry_size = len("ns:вопрос 1".encode("utf-8")) + len(answer.encode("utf-8")) + response_cache._ENTRY_OVERHEAD
+    cache = ResponseCache("ns", max_bytes=entry_size * 3)
+    for index in range(3):
+        cache.put(f"вопрос {index}", answer)
+    assert cache.get("вопрос 0") == answer
+
+    cache.put("вопрос 3", answer)
+    assert len(cache) == 3
+    assert cache.get("вопрос 1") is None
+    assert [cache.get(f"вопрос {index}") for index in (0, 2, 3)] == [answer] * 3
+    # Ответ больше всего бюджета не кэшируется и ничего не вытесняет
+    cache.put("длинный", answer * 10)
+    assert cache.get("длинный") is None and len(cache) == 3
+
+
+def test_similar_questions_only_when_enabled():
+    question = "Как провести первую встречу один на один с новым сотрудником отдела"
+    similar = "Как провести первые встречи один на один с новыми сотрудниками отдела"
+    other = "Сотрудник постоянно опаздывает на работу и не отвечает на сообщения"
+
+    exact_only = ResponseCache("ns")
+    exact_only.put(question, "Ответ")
+    assert exact_only.get(similar) is None
+
+    fuzzy = ResponseCache("ns", similarity=0.5)
+    fuzzy.put(question, "Ответ")
+    fuzzy.put(other, "Другой ответ")
+    assert fuzzy.get(similar) == "Ответ"
+    assert fuzzy.get("Сотрудник постоянно опаздывает на работу и не отвечает на звонки") == "Другой ответ"
+    # Короткие вопросы сравниваются только точно: «как уволить» и «как нанять» не одно и то же
+    fuzzy.put("как уволить", "Ответ про увольнение")
+    assert fuzzy.get("как нанять") is None
+
+    fuzzy.clear()
+    assert fuzzy.get(question) is None and not fuzzy._index
+
+
+def test_bot_answers_repeated_first_message_from_cache(make_bot):
+    async def scenario():
+        bot = make_bot(["Первый ответ", "Ответ на уточнение", "Третий ответ"], RESPONSE_CACHE="1")
+
+        first = await bot.get_claude_response(1, "Как провести встречу один на один?")
+        assert first == "Первый ответ"
+        # Тот же вопрос от другого пользователя — из кэша, без запроса к Claude
+        assert await bot.get_cached_response(2, "как провести встречу один-на-один") == "Первый ответ"
+        assert len(bot.llm.requests) == 1
+        history = await bot.get_conversation_history(2)
+        assert [(message["role"], message["content"]) for message in history] == [
+            ("user", "как провести встречу один-на-один"), ("assistant", "Первый ответ"),
+        ]
+
+        # Продолжение разговора уже не первое сообщение: кэш не используется и не пополняется
+        assert await bot.get_cached_response(1, "Как провести встречу один на один?") is None
+        await bot.get_claude_response(1, "Сотрудник новый")
+        assert await bot.get_cached_response(3, "Сотрудник новый") is None
+        await bot.conversation_store.close()
+
+    asyncio.run(scenario())
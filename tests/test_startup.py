@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""Быстрый старт: ранний HTTP сервер и разбивка времени запуска"""
+
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import startup
+
+
+def request(server: startup.EarlyServer, path: str, body: bytes = None):
+    port = server._httpd.server_address[1]
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", data=body, timeout=5) as response:
+            return response.status, response.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+        return e.code, ""
+
+
+@pytest.fixture
+def early_server():
+    server = startup.EarlyServer(0, webhook_wait=5)
+    yield server
+    server.detach().close()
+
+
+def test_health_answers_while_starting(early_server):
+    assert request(early_server, "/healthz") == (200, "HR Assistant Bot is starting")
+    assert request(early_server, "/missing")[0] == 404
+    early_server.set_ready()
+    assert request(early_server, "/") == (200, "HR Assistant Bot is running")
+    status, text = request(early_server, "/metrics")
+    assert status == 200 and "hr_bot_startup_seconds" in text
+
+
+def test_webhook_waits_for_ready(early_server):
+    received = []
+
+    def forward(secret: str, body: bytes) -> int:
+        received.append((secret, body))
+        return 200
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(request(early_server, "/webhook", b'{"update_id": 1}')))
+    thread.start()
+    time.sleep(0.1)
+    # Обновление, разбудившее сервис, не отклонено и ждет готовности бота
+    assert thread.is_alive() and not received
+    early_server.set_ready(forward)
+    thread.join(5)
+    assert results == [(200, "")]
+    assert received == [("", b'{"update_id": 1}')]
+
+
+def test_webhook_without_forwarder_or_timeout_returns_503():
+    server = startup.EarlyServer(0, webhook_wait=0.05)
+    try:
+        assert request(server, "/webhook", b"{}")[0] == 503
+        server.set_ready()
+        assert request(server, "/webhook", b"{}")[0] == 503
+    finally:
+        server.detach().close()
+
+
+def test_detach_hands_over_listening_socket(early_server):
+    port = early_server._httpd.server_address[1]
+    sock = early_server.detach()
+    # Сокет остается открытым: соединение ставится в очередь до нового сервера
+    assert sock.getsockname()[1] == port
+    with socket.create_connection(("127.0.0.1", port), timeout=5):
+        connection, _ = sock.accept()
+        connection.close()
+
+
+def test_take_early_server_matches_port(monkeypatch):
+    server = object.__new__(startup.EarlyServer)
+    server.port = 8080
+    monkeypatch.setattr(startup, "_early", server)
+    assert startup.take_early_server(9090) is None
+    assert startup.take_early_server(8080) is server
+    assert startup.take_early_server(8080) is None
+
+
+def test_fast_start_skipped_for_workers(monkeypatch):
+    monkeypatch.delenv("FAST_START", raising=False)
+    monkeypatch.delenv("BOT_ROLE", raising=False)
+    assert startup.fast_start_enabled()
+    monkeypatch.setenv("BOT_ROLE", "worker")
+    assert not startup.fast_start_enabled()
+    monkeypatch.setenv("BOT_ROLE", "standalone")
+    monkeypatch.setenv("FAST_START", "0")
+    assert not startup.fast_start_enabled()
+
+
+def test_timer_phases_add_up_and_report_once(caplog):
+    timer = startup.StartupTimer()
+    timer.mark("imports")
+    time.sleep(0.01)
+    timer.mark("clients")
+    with caplog.at_level("INFO", logger="startup"):
+        timer.report()
+        timer.report("again")
+    names = [name for name, _ in timer.phases]
+    assert names[-3:] == ["imports", "clients", "ready"]
+    assert dict(timer.phases)["clients"] >= 0.01
+    assert caplog.text.count("Запуск за") == 1
+    total = sum(seconds for _, seconds in timer.phases)
+    assert timer.elapsed() >= total - 1e-6
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""Структурированные логи: JSON, маскирование, выборка по trace_id и поток записи"""
+
+import io
+import json
+import logging
+import sys
+
+import pytest
+
+from structured_logging import (
+    JsonFormatter, SamplingFilter, TextFormatter, log_context, setup_logging, trace_id,
+)
+
+TOKEN = "123456789:AAHdqTcvCH1vGWJxfSeofSAs0K5PALDsaw"
+
+
+def make_record(message: str = "Ответ отправлен", level: int = logging.INFO, exc_info=None, **extra):
+    record = logging.LogRecord("hr_assistant_bot", level, __file__, 1, message, (), exc_info)
+    for name, value in extra.items():
+        setattr(record, name, value)
+    return record
+
+
+def failure():
+    try:
+        raise ConnectionError(f"POST https://api.telegram.org/bot{TOKEN}/sendMessage failed")
+    except ConnectionError:
+        return sys.exc_info()
+
+
+def test_json_entry_masks_user_text_and_token():
+    record = make_record(f"Запрос к bot{TOKEN}", event="message", text="Сотрудник опаздывает", user_id=7)
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["msg"] == "Запрос к bot<token>"
+    assert entry["event"] == "message" and entry["user_id"] == 7
+    assert entry["text"].startswith("<20 chars ") and "опаздывает" not in entry["text"]
+
+    plain = json.loads(JsonFormatter(redact=False).format(record))
+    assert plain["text"] == "Сотрудник опаздывает" and TOKEN in plain["msg"]
+
+
+def test_exception_and_stack_are_masked():
+    record = make_record("Ошибка отправки", logging.ERROR, exc_info=failure())
+    record.stack_info = f"Stack (most recent call last):\n  url = 'https://api.telegram.org/bot{TOKEN}/getMe'"
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["exc_type"] == "ConnectionError"
+    assert "bot<token>/sendMessage" in entry["exc"] and "bot<token>/getMe" in entry["stack"]
+    assert TOKEN not in json.dumps(entry)
+
+    # Трассировка, уже отформатированная другим обработчиком, тоже маскируется
+    cached = make_record("Ошибка отправки", logging.ERROR)
+    cached.exc_text = f"Traceback ...\nConnectionError: bot{TOKEN}"
+    assert TOKEN not in JsonFormatter().format(cached)
+    assert TOKEN not in TextFormatter().format(make_record("Ошибка", logging.ERROR, exc_info=failure()))
+    assert TOKEN in JsonFormatter(redact=False).format(make_record("Ошибка", logging.ERROR, exc_info=failure()))
+
+
+def test_sampling_keeps_or_drops_whole_trace():
+    sampling = SamplingFilter.parse("message=0.5, httpx=0")
+    decisions = {}
+    for update_id in range(200):
+        trace = trace_id(update_id)
+        kept = [sampling.filter(make_record(event="message", trace_id=trace)) for _ in range(3)]
+        assert len(set(kept)) == 1
+        decisions[trace] = kept[0]
+    assert 40 < sum(decisions.values()) < 160
+
+    assert not sampling.filter(logging.LogRecord("httpx", logging.INFO, __file__, 1, "GET", (), None))
+    assert sampling.filter(logging.LogRecord("httpx", logging.WARNING, __file__, 1, "GET", (), None))
+    assert sampling.filter(make_record(event="tokens"))
+
+
+@pytest.fixture
+def listeners():
+    """Запущенные в тесте потоки записи; корневой логгер восстанавливается после теста"""
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    listeners = []
+    yield listeners
+    for listener in listeners:
+        listener.stop()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_listener_writes_context_and_restarts_cleanly(listeners, monkeypatch):
+    # stderr подменяется в самом тесте: на время теста pytest ставит свой перехват
+    stream = io.StringIO()
+    monkeypatch.setattr(sys, "stderr", stream)
+    first = setup_logging(sample="")
+    listeners.append(first)
+    logger = logging.getLogger("hr_assistant_bot")
+    with log_context(trace_id=trace_id(255), user_id=7):
+        logger.info("Сообщение получено", extra={"event": "message"})
+
+    # Повторная настройка останавливает прежний поток записи, дописав его очередь
+    second = setup_logging(fmt="text")
+    listeners.append(second)
+    assert not first.running and second.running
+    logger.warning("Повтор через 5 с")
+    second.stop()
+    second.stop()
+
+    lines = stream.getvalue().splitlines()
+    entry = json.loads(lines[0])
+    assert (entry["msg"], entry["trace_id"], entry["user_id"], entry["event"]) == ("Сообщение получено", "ff", 7, "message")
+    assert lines[1].endswith("WARNING - Повтор через 5 с")
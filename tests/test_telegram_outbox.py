@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""Очередь исходящих вызовов Bot API: порядок в чате, приоритеты, лимиты и флуд-контроль"""
+
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+from telegram_outbox import PRIORITY_COMMAND, PRIORITY_REPLY, PRIORITY_STREAM, TelegramOutbox
+
+
+class Calls:
+    """Вызовы Bot API: запоминают момент начала, могут отвечать RetryAfter"""
+
+    def __init__(self):
+        self.started = []
+        self.flood = {}
+
+    def make(self, name: str, duration: float = 0.0):
+        async def call():
+            loop = asyncio.get_running_loop()
+            self.started.append((name, loop.time()))
+            if self.flood.get(name):
+                self.flood[name] -= 1
+                raise RetryAfter(0.05)
+            await asyncio.sleep(duration)
+            return name
+
+        return call
+
+
+def names(calls: Calls) -> list:
+    return [name for name, _ in calls.started]
+
+
+def test_chat_calls_in_order_at_chat_rate():
+    async def scenario():
+        outbox = TelegramOutbox(global_rate=0, chat_rate=20, chat_burst=1)
+        calls = Calls()
+        results = await asyncio.gather(*(outbox.submit(1, calls.make(f"m{index}"), "sendMessage")
+                                         for index in range(4)))
+        await outbox.close()
+        return results, calls.started
+
+    results, started = asyncio.run(scenario())
+    assert results == ["m0", "m1", "m2", "m3"]
+    assert [name for name, _ in started] == ["m0", "m1", "m2", "m3"]
+    # Одно сообщение в 50 мс на чат: вызовы не уходят пачкой
+    gaps = [later - earlier for (_, earlier), (_, later) in zip(started, started[1:])]
+    assert all(gap >= 0.04 for gap in gaps)
+
+
+def test_priority_between_chats():
+    async def scenario():
+        outbox = TelegramOutbox(global_rate=0, chat_rate=0)
+        calls = Calls()
+        # Все вызовы уже в очереди к первому проходу планировщика
+        tasks = [
+            asyncio.ensure_future(outbox.submit(1, calls.make("stream"), "editMessageText", PRIORITY_STREAM)),
+            asyncio.ensure_future(outbox.submit(2, calls.make("reply"), "sendMessage", PRIORITY_REPLY)),
+            asyncio.ensure_future(outbox.submit(3, calls.make("command"), "sendMessage", PRIORITY_COMMAND)),
+            asyncio.ensure_future(outbox.submit(4, calls.make("reply 2"), "sendMessage", PRIORITY_REPLY)),
+        ]
+        await asyncio.gather(*tasks)
+        await outbox.close()
+        return names(calls)
+
+    assert asyncio.run(scenario()) == ["command", "reply", "reply 2", "stream"]
+
+
+def test_global_rate_spreads_chats():
+    async def scenario():
+        outbox = TelegramOutbox(global_rate=20, chat_rate=0)
+        outbox._global_tokens = 1
+        calls = Calls()
+        await asyncio.gather(*(outbox.submit(chat_id, calls.make(str(chat_id)), "sendMessage")
+                               for chat_id in range(3)))
+        await outbox.close()
+        return calls.started
+
+    started = asyncio.run(scenario())
+    assert started[-1][1] - started[0][1] >= 0.09
+
+
+def test_retry_after_pauses_chat_and_retries():
+    async def scenario():
+        outbox = TelegramOutbox(global_rate=0, chat_rate=0)
+        calls = Calls()
+        calls.flood = {"first": 1, "no retry": 1}
+        first = await outbox.submit(1, calls.make("first"), "sendMessage")
+        with pytest.raises(RetryAfter):
+            await outbox.submit(2, calls.make("no retry"), "editMessageText", retries=0)
+        await outbox.close()
+        return first, calls.started
+
+    first, started = asyncio.run(scenario())
+    assert first == "first"
+    assert [name for name, _ in started] == ["first", "first", "no retry"]
+    # Повтор уходит не раньше паузы retry_after
+    assert started[1][1] - started[0][1] >= 0.05
+
+
+def test_cancelled_sender_is_skipped_and_close_drains():
+    async def scenario():
+        outbox = TelegramOutbox(global_rate=0, chat_rate=0)
+        calls = Calls()
+        busy = asyncio.ensure_future(outbox.submit(1, calls.make("busy", 0.05), "sendMessage"))
+        await asyncio.sleep(0.01)
+        stale = asyncio.ensure_future(outbox.submit(1, calls.make("stale"), "editMessageText"))
+        fresh = asyncio.ensure_future(outbox.submit(1, calls.make("fresh"), "sendMessage"))
+        await asyncio.sleep(0)
+        stale.cancel()
+        await outbox.close()
+        return names(calls), busy.done() and fresh.done()
+
+    started, done = asyncio.run(scenario())
+    assert started == ["busy", "fresh"] and done
+
+
+def test_close_waits_for_calls_in_progress():
+    async def scenario():
+        outbox = TelegramOutbox(global_rate=0, chat_rate=0)
+        calls = Calls()
+        last = asyncio.ensure_future(outbox.submit(1, calls.make("last part", 0.2), "sendMessage"))
+        await asyncio.sleep(0.01)
+        # Очередь уже пуста, но вызов еще идет: close() не должен вернуться раньше него
+        assert outbox._depth == 0 and len(outbox._sending) == 1
+        await outbox.close()
+        return last.done() and last.result(), outbox._sending
+
+    result, sending = asyncio.run(scenario())
+    assert result == "last part" and not sending
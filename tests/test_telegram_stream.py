@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""Вывод ответа в Telegram: разбивка на сообщения, отправка частей подряд и потоковый вывод"""
+
+import asyncio
+import types
+
+from telegram.error import RetryAfter
+
+from markdown_cleaner import clean_markdown
+from telegram_stream import StreamingReply, send_message_parts, split_message, split_point, utf16_len
+
+
+class FakeOutbox:
+    """Заглушка TelegramOutbox: сообщения — объекты с изменяемым текстом, вызовы записываются"""
+
+    def __init__(self, edit_failures: int = 0):
+        self.calls = []
+        self.edit_failures = edit_failures
+
+    async def reply_text(self, reply_to, text: str, priority: int = 0):
+        self.calls.append(("send", text))
+        return types.SimpleNamespace(text=text)
+
+    async def edit_text(self, message, text: str, priority: int = 0, retries: int = 3):
+        if self.edit_failures:
+            self.edit_failures -= 1
+            self.calls.append(("retry_after", retries))
+            raise RetryAfter(1)
+        self.calls.append(("edit", text))
+        message.text = text
+
+
+def stream(chunks, outbox, **kwargs):
+    async def scenario():
+        reply = StreamingReply(object(), outbox, **kwargs)
+        for chunk in chunks:
+            await reply.feed(chunk)
+        return reply, await reply.finish()
+
+    return asyncio.run(scenario())
+
+
+ANSWER = ["**Диагностика:** сотрудник ", "типа _P_ по Адизесу.\n\n", "## План\n", "* поговорить\n", "* договориться"]
+
+
+def test_first_chunk_sent_at_once_and_edits_throttled():
+    outbox = FakeOutbox()
+    reply, final = stream(ANSWER, outbox, min_interval=3600)
+
+    assert final == clean_markdown("".join(ANSWER))
+    # Первый фрагмент уходит сразу, промежуточные правки ждут интервала, окончательный текст — всегда
+    assert outbox.calls == [("send", "Диагностика: сотрудник"), ("edit", final)]
+    assert [message.text for message in reply.messages] == [final]
+
+
+def test_every_chunk_shown_without_throttle():
+    outbox = FakeOutbox()
+    _, final = stream(ANSWER, outbox, min_interval=0)
+
+    shown = [text for kind, text in outbox.calls]
+    assert shown[0] == "Диагностика: сотрудник" and shown[-1] == final
+    # Разметка не видна даже в промежуточных версиях
+    assert not any("**" in text or "## " in text for text in shown)
+    assert len(shown) == len(set(shown))
+
+
+def test_long_answer_continues_in_new_messages():
+    sentences = [f"Предложение номер {index} о работе с командой. " for index in range(60)]
+    outbox = FakeOutbox()
+    reply, final = stream(sentences, outbox, min_interval=0, limit=500)
+
+    texts = [message.text for message in reply.messages]
+    assert len(texts) > 1
+    assert all(utf16_len(text) <= 500 for text in texts)
+    assert " ".join(texts) == final
+    # Заполненные сообщения больше не редактируются
+    assert all(text.endswith(".") for text in texts[:-1])
+
+
+def test_retry_after_skips_intermediate_edit_but_not_final():
+    outbox = FakeOutbox(edit_failures=3)
+    reply, final = stream(["Первая часть. ", "Вторая часть. ", "Третья часть."], outbox, min_interval=0)
+
+    assert outbox.calls[0] == ("send", "Первая часть.")
+    # Промежуточные правки без повторов пропускаются, окончательная повторяется, пока не дойдет
+    assert outbox.calls[1:] == [("retry_after", 0), ("retry_after", 0), ("retry_after", 3), ("edit", final)]
+    assert reply.messages[0].text == final == "Первая часть. Вторая часть. Третья часть."
+
+
+def test_short_text_is_one_part():
+    assert split_message("  Короткий ответ.  ") == ["Короткий ответ."]
+    assert split_message("") == []
+
+
+def test_split_prefers_paragraph_then_line_then_sentence_then_word():
+    paragraph = "Первый абзац. " * 3 + "\n\n" + "Второй абзац. " * 3
+    assert split_point(paragraph, 60) == paragraph.index("\n\n")
+    lines = "- пункт списка номер один\n- пункт списка номер два\n- пункт три"
+    assert split_message(lines, 50) == ["- пункт списка номер один\n- пункт списка номер два", "- пункт три"]
+    sentences = "Первое предложение ответа. Второе предложение ответа. Третье."
+    assert split_message(sentences, 40) == ["Первое предложение ответа.", "Второе предложение ответа. Третье."]
+    words = "слово " * 20
+    assert all(part.startswith("слово") and part.endswith("слово") for part in split_message(words, 30))
+    # Без границ в окне текст режется по лимиту
+    assert split_message("а" * 25, 10) == ["а" * 10, "а" * 10, "а" * 5]
+
+
+def test_limit_counts_utf16_units():
+    # Эмодзи занимает две единицы UTF-16: Telegram считает лимит именно так
+    text = "👍" * 30
+    parts = split_message(text, 20)
+    assert [len(part) for part in parts] == [10, 10, 10]
+    assert all(utf16_len(part) <= 20 for part in parts)
+
+
+def test_split_keeps_all_text():
+    text = "\n\n".join(f"Абзац {index}. " + "Текст рекомендации для руководителя. " * (index % 7 + 1)
+                       for index in range(40))
+    parts = split_message(text, 300)
+    assert all(utf16_len(part) <= 300 for part in parts)
+    assert "".join(parts).replace(" ", "").replace("\n", "") == text.replace(" ", "").replace("\n", "")
+
+
+def test_parts_queued_at_once():
+    class SlowOutbox(FakeOutbox):
+        async def reply_text(self, reply_to, text, priority=0):
+            await asyncio.sleep(0.05)
+            return await super().reply_text(reply_to, text, priority)
+
+    async def scenario():
+        started = asyncio.get_running_loop().time()
+        messages = await send_message_parts(SlowOutbox(), object(), ["первая", "вторая", "третья"])
+        return messages, asyncio.get_running_loop().time() - started
+
+    messages, elapsed = asyncio.run(scenario())
+    # Части не ждут друг друга: порядок и паузы между ними обеспечивает очередь outbox
+    assert [message.text for message in messages] == ["первая", "вторая", "третья"]
+    assert elapsed < 0.1
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""Журнал расхода токенов: дневные агрегаты, бюджет и отложенная запись"""
+
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+import usage_ledger
+from usage_ledger import UsageLedger, UsageRecord, format_stats
+
+
+def usage(user_id: int, input_tokens: int = 100, output_tokens: int = 50, cache_read: int = 0,
+          cache_creation: int = 0) -> UsageRecord:
+    return UsageRecord(user_id, "sync", "claude-test", input_tokens, output_tokens, cache_read, cache_creation, 1.5)
+
+
+def test_billed_tokens_discount_cache_reads():
+    assert usage(1, 100, 50, cache_read=1000, cache_creation=200).billed_tokens == 100 + 200 + 50 + 100
+
+
+def test_budget_reduces_then_rejects(tmp_path):
+    async def scenario():
+        ledger = UsageLedger(str(tmp_path / "usage.db"), daily_tokens=1000, soft_ratio=0.8, reduced_max_tokens=256)
+        decisions = [await ledger.check(1, 4096)]
+        ledger.record(usage(1, 700, 100))
+        decisions.append(await ledger.check(1, 4096))
+        # Короткий ответ уже и так не длиннее пониженного лимита
+        decisions.append(await ledger.check(1, 200))
+        ledger.record(usage(1, 150, 50))
+        decisions.append(await ledger.check(1, 4096))
+        decisions.append(await ledger.check(2, 4096))
+        await ledger.close()
+        return decisions
+
+    fresh, reduced, short, rejected, other = asyncio.run(scenario())
+    assert fresh.allowed and fresh.max_tokens is None
+    assert reduced == (True, 256, 800)
+    assert short == (True, None, 800)
+    assert rejected == (False, None, 1000)
+    assert other.allowed and other.used == 0
+
+
+def test_usage_survives_restart_with_pending_records(tmp_path):
+    path = str(tmp_path / "usage.db")
+
+    async def scenario():
+        ledger = UsageLedger(path, daily_tokens=10_000, flush_interval=60)
+        ledger.record(usage(1))
+        ledger.record(usage(1))
+        await ledger.flush()
+        # Запись, еще не дошедшая до базы, тоже учитывается в расходе
+        ledger.record(usage(1, 1000, 0))
+        used = await ledger.used_today(1)
+        await ledger.close()
+
+        reopened = UsageLedger(path, daily_tokens=10_000)
+        return used, await reopened.used_today(1), await reopened.stats()
+
+    used, after_restart, stats = asyncio.run(scenario())
+    assert used == after_restart == 1300
+    (day, users, requests, input_tokens, output_tokens, cache_read, cache_creation, latency), = stats["days"]
+    assert (users, requests, input_tokens, output_tokens) == (1, 3, 1200, 100)
+    assert stats["top"] == [(1, 3, 1300)]
+
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM usage_events").fetchone() == (3,)
+
+
+def test_day_rollover_resets_budget(tmp_path, monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(usage_ledger, "today", lambda: "2026-10-17")
+        ledger = UsageLedger(str(tmp_path / "usage.db"), daily_tokens=100)
+        ledger.record(usage(1, 100, 0))
+        rejected = await ledger.check(1, 4096)
+        monkeypatch.setattr(usage_ledger, "today", lambda: "2026-10-18")
+        allowed = await ledger.check(1, 4096)
+        await ledger.close()
+        return rejected, allowed
+
+    rejected, allowed = asyncio.run(scenario())
+    assert not rejected.allowed and allowed.allowed
+
+
+def test_failed_write_keeps_pending(tmp_path, monkeypatch):
+    async def scenario():
+        ledger = UsageLedger(str(tmp_path / "usage.db"), flush_interval=60)
+        ledger.record(usage(1))
+
+        def broken(batch):
+            raise sqlite3.OperationalError("database is locked")
+
+        monkeypatch.setattr(ledger, "_write", broken)
+        with pytest.raises(sqlite3.OperationalError):
+            await ledger.flush()
+        ledger.record(usage(2))
+        pending = [record.user_id for _, _, record in ledger._pending]
+        monkeypatch.undo()
+        await ledger.close()
+        return pending
+
+    assert asyncio.run(scenario()) == [1, 2]
+
+
+def test_format_stats():
+    assert "Данных пока нет" in format_stats({"days": [], "top": []})
+    text = format_stats({"days": [("2026-10-18", 2, 4, 400, 200, 0, 0, 6.0)], "top": [(7, 3, 250)]}, daily_tokens=1000)
+    assert "запросов 4" in text and "средняя задержка 1.5 с" in text
+    assert "7: запросов 3, токенов 250 (25% бюджета)" in text
+
+
+def test_bot_records_usage_of_replies(make_bot, tmp_path):
+    async def scenario():
+        bot = make_bot(["Ответ консультанта"], USAGE_LEDGER="1", USAGE_DB_PATH=str(tmp_path / "usage.db"))
+        await bot.get_claude_response(1, "Как провести встречу один на один?")
+        used = await bot.usage_ledger.used_today(1)
+        await bot.usage_ledger.close()
+        await bot.conversation_store.close()
+        return used
+
+    # FakeClaude: 100 входных токенов и по токену на слово ответа
+    assert asyncio.run(scenario()) == 102
+
+
+def test_first_read_does_not_miss_batch_flushed_meanwhile(tmp_path, monkeypatch):
+    async def scenario():
+        ledger = UsageLedger(str(tmp_path / "usage.db"), daily_tokens=10_000, flush_interval=60)
+        ledger.record(usage(1))
+        load_used = ledger._load_used
+
+        def slow_load(day, user_id):
+            # Агрегаты прочитаны до записи пачки, а ответ приходит уже после нее
+            stored = load_used(day, user_id)
+            time.sleep(0.05)
+            return stored
+
+        monkeypatch.setattr(ledger, "_load_used", slow_load)
+        used, _ = await asyncio.gather(ledger.used_today(1), ledger.flush())
+        await ledger.close()
+        return used
+
+    assert asyncio.run(scenario()) == 150
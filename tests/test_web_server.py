@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""HTTP сервер бота: health check, метрики и вебхук Telegram на одном порту"""
+
+import asyncio
+import json
+import types
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from metrics import CONTENT_TYPE
+from web_server import HEALTH_TEXT, BotWebServer
+
+UPDATE = {"update_id": 7, "message": {"message_id": 1, "date": 0, "chat": {"id": 5, "type": "private"},
+                                      "from": {"id": 5, "is_bot": False, "first_name": "Анна"}, "text": "Привет"}}
+
+
+async def request(server: BotWebServer, method: str, path: str, **kwargs):
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.request(method, path, **kwargs)
+        return response.status, await response.text(), response.headers
+
+
+def test_health_and_metrics():
+    async def scenario():
+        server = BotWebServer(0)
+        assert (await request(server, "GET", "/healthz"))[:2] == (200, HEALTH_TEXT)
+        assert (await request(server, "GET", "/"))[0] == 200
+        status, body, headers = await request(server, "GET", "/metrics")
+        assert status == 200 and headers["Content-Type"] == CONTENT_TYPE
+        assert "# TYPE hr_bot_startup_seconds gauge" in body
+        # Без приложения и диспетчера вебхук не регистрируется
+        assert (await request(server, "POST", "/telegram", data=b"{}"))[0] == 404
+
+    asyncio.run(scenario())
+
+
+def test_webhook_checks_secret_and_queues_update():
+    async def scenario():
+        application = types.SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        server = BotWebServer(0, application, webhook_path="/hook/", secret_token="s3cret")
+        headers = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+
+        assert (await request(server, "POST", "/hook", data=json.dumps(UPDATE)))[0] == 403
+        assert (await request(server, "POST", "/hook", data=json.dumps(UPDATE),
+                              headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}))[0] == 403
+        assert (await request(server, "POST", "/hook", data=b"not json", headers=headers))[0] == 400
+        assert application.update_queue.empty()
+
+        assert (await request(server, "POST", "/hook", data=json.dumps(UPDATE), headers=headers))[0] == 200
+        update = application.update_queue.get_nowait()
+        assert update.update_id == 7 and update.message.text == "Привет"
+
+    asyncio.run(scenario())
+
+
+def test_webhook_hands_json_to_dispatcher():
+    received = []
+
+    async def on_update(data):
+        received.append(data)
+
+    async def scenario():
+        server = BotWebServer(0, on_update=on_update)
+        return await request(server, "POST", "/telegram", data=json.dumps(UPDATE))
+
+    assert asyncio.run(scenario())[0] == 200
+    assert received == [UPDATE]
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+Несколько процессов-воркеров на одном хосте за диспетчером
+
+Проверяется закрепление чатов: каждый чат всегда обрабатывает один и тот же
+воркер (результат jump hash стабилен), а сообщения чата приходят к нему в
+исходном порядке.
+"""
+
+import asyncio
+
+from dispatcher import Dispatcher, ProcessTransport, WorkerPool, jump_hash, worker_for
+
+WORKERS = 3
+CHATS = 40
+MESSAGES = 15
+
+
+def echo_worker(index: int, transport: ProcessTransport):
+    """Процесс-воркер: пересылает (воркер, чат, номер сообщения) в последнюю очередь транспорта"""
+    async def run():
+        results = len(transport.queues) - 1
+        while True:
+            data = await transport.get(index, timeout=0.2)
+            if data is None:
+                continue
+            if data.get("stop"):
+                await transport.put(results, {"worker": index, "stop": True})
+                return
+            message = data["message"]
+            await transport.put(results, {"worker": index, "chat": message["chat"]["id"], "seq": int(message["text"])})
+
+    asyncio.run(run())
+
+
+def update(update_id: int, chat_id: int, seq: int) -> dict:
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "from": {"id": chat_id}, "text": str(seq)}}
+
+
+def test_chats_stick_to_one_worker_and_keep_order():
+    async def run():
+        # Последняя очередь — обратный канал от воркеров к тесту
+        transport = ProcessTransport(WORKERS + 1)
+        pool = WorkerPool(echo_worker, transport, WORKERS)
+        pool.start()
+        dispatcher = Dispatcher(transport, WORKERS)
+        try:
+            update_id = 0
+            # Сообщения разных чатов перемешаны, как в настоящем потоке обновлений
+            for seq in range(MESSAGES):
+                for chat_id in range(CHATS):
+                    update_id += 1
+                    await dispatcher.route(update(update_id, 5000 + chat_id * 7919, seq))
+            for worker in range(WORKERS):
+                await transport.put(worker, {"stop": True})
+
+            received, stopped = [], 0
+            while stopped < WORKERS:
+                item = await transport.get(WORKERS, timeout=30)
+                assert item is not None, "воркеры не ответили за 30 с"
+                if item.get("stop"):
+                    stopped += 1
+                else:
+                    received.append(item)
+            return received
+        finally:
+            await pool.stop(timeout=5)
+
+    received = asyncio.run(run())
+
+    assert len(received) == CHATS * MESSAGES
+    workers_of_chat, sequences = {}, {}
+    for item in received:
+        workers_of_chat.setdefault(item["chat"], set()).add(item["worker"])
+        sequences.setdefault(item["chat"], []).append(item["seq"])
+    for chat_id, workers in workers_of_chat.items():
+        assert workers == {worker_for(chat_id, WORKERS)}
+        assert sequences[chat_id] == list(range(MESSAGES))
+    # Нагрузка разошлась по всем воркерам
+    assert set().union(*workers_of_chat.values()) == set(range(WORKERS))
+
+
+def test_worker_assignment_is_stable():
+    # Значения зафиксированы: смена хеша переселила бы чаты между воркерами при деплое
+    chat_ids = (1, 42, 1000, 777777, 123456789, 987654321, -100123, -1001234567890)
+    assert [worker_for(chat_id, 4) for chat_id in chat_ids] == [2, 0, 1, 1, 0, 3, 1, 0]
+    assert [worker_for(chat_id, 8) for chat_id in chat_ids] == [4, 5, 4, 1, 0, 4, 1, 4]
+    assert all(worker_for(chat_id, 1) == 0 for chat_id in range(100))
+
+
+def test_adding_a_worker_moves_chats_only_to_the_new_worker():
+    for chat_id in range(2000):
+        before, after = worker_for(chat_id, 4), worker_for(chat_id, 5)
+        assert after == before or after == 4
+    moved = sum(jump_hash(key, 4) != jump_hash(key, 5) for key in range(10000))
+    assert 1500 < moved < 2500
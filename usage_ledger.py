@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Учет расхода токенов по пользователям и дневные бюджеты
+
+Каждый ответ Claude записывается в журнал (SQLite) отложенно и пачками.
+Вместе с сырыми строками в той же транзакции обновляются дневные агрегаты
+по пользователям, поэтому /stats и проверка бюджета не сканируют журнал.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+USAGE_PENDING = Gauge("hr_bot_usage_pending", "Записи журнала расхода, ожидающие записи в базу")
+BUDGET_ACTIONS = Counter("hr_bot_budget_actions_total", "Срабатывания дневного бюджета", ["action"])
+
+# Порядок полей в агрегатах и в UsageRecord
+_TOKEN_FIELDS = ("input_tokens", "output_tokens", "cache_read_tokens", "cache_creation_tokens")
+
+
+def today() -> str:
+    """Текущие сутки по UTC (граница дневного бюджета)"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+class UsageRecord(NamedTuple):
+    """Расход одного запроса к Claude"""
+
+    user_id: int
+    mode: str
+    model: str
+    input_tokens: int
+    output_tokens: int
+    cache_read_tokens: int
+    cache_creation_tokens: int
+    latency: float
+
+    @property
+    def billed_tokens(self) -> int:
+        """Токены для бюджета: чтение из кэша промпта стоит около 10% обычного входа"""
+        return self.input_tokens + self.cache_creation_tokens + self.output_tokens + self.cache_read_tokens // 10
+
+
+class Budget(NamedTuple):
+    """Решение по дневному бюджету пользователя"""
+
+    allowed: bool
+    max_tokens: Optional[int] = None
+    used: int = 0
+
+
+class UsageLedger:
+    """
+    Журнал расхода в SQLite с отложенной записью и дневным бюджетом.
+
+    Расход пользователя за текущие сутки держится в памяти (при первом
+    обращении читается из агрегатов), поэтому проверка бюджета не ходит
+    в базу на каждое сообщение. После soft_ratio бюджета max_tokens ответа
+    снижается, после исчерпания бюджета запросы отклоняются до конца суток.
+    """
+
+    def __init__(self, path: str, daily_tokens: int = 0, soft_ratio: float = 0.8, reduced_max_tokens: int = 1024,
+                 flush_interval: float = 2.0, batch_size: int = 200):
+        """
+        Args:
+            path: Файл базы SQLite
+            daily_tokens: Дневной бюджет токенов на пользователя (0 — без ограничения)
+            soft_ratio: Доля бюджета, после которой ответы укорачиваются
+            reduced_max_tokens: max_tokens ответа после soft_ratio
+            flush_interval: Период отложенной записи (секунды)
+            batch_size: Размер пачки, при котором запись начинается досрочно
+        """
+        self.path = path
+        self.daily_tokens = daily_tokens
+        self.soft_ratio = soft_ratio
+        self.reduced_max_tokens = reduced_max_tokens
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage_events ("
+            "ts REAL NOT NULL, day TEXT NOT NULL, user_id INTEGER NOT NULL, mode TEXT NOT NULL, "
+            "model TEXT NOT NULL, input_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL, "
+            "cache_read_tokens INTEGER NOT NULL, cache_creation_tokens INTEGER NOT NULL, latency REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage_daily ("
+            "day TEXT NOT NULL, user_id INTEGER NOT NULL, requests INTEGER NOT NULL, "
+            "input_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL, cache_read_tokens INTEGER NOT NULL, "
+            "cache_creation_tokens INTEGER NOT NULL, billed_tokens INTEGER NOT NULL, latency_sum REAL NOT NULL, "
+            "PRIMARY KEY (day, user_id))"
+        )
+
+        self._pending: List[Tuple[float, str, UsageRecord]] = []
+        self._day = today()
+        self._used: Dict[int, int] = {}
+        # Первое чтение расхода и запись пачки не пересекаются: иначе пачка, записанная во время
+        # чтения, не попадет ни в прочитанное, ни в _pending
+        self._io_lock = asyncio.Lock()
+        self._flush_event: Optional[asyncio.Event] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+        USAGE_PENDING.set_function(lambda: len(self._pending))
+
+    @classmethod
+    def from_env(cls) -> Optional["UsageLedger"]:
+        """Создать журнал с настройками из переменных окружения или None, если учет выключен"""
+        if os.getenv("USAGE_LEDGER", "0") != "1":
+            return None
+        ledger = cls(
+            os.getenv("USAGE_DB_PATH", "usage.db"),
+            daily_tokens=int(os.getenv("USAGE_DAILY_TOKENS", 0)),
+            soft_ratio=float(os.getenv("USAGE_SOFT_RATIO", 0.8)),
+            reduced_max_tokens=int(os.getenv("USAGE_REDUCED_MAX_TOKENS", 1024)),
+        )
+        logger.info(f"Учет расхода токенов включен ({ledger.path}), дневной бюджет: {ledger.daily_tokens or 'нет'}")
+        return ledger
+
+    def _roll_day(self):
+        day = today()
+        if day != self._day:
+            self._day = day
+            self._used.clear()
+
+    def _load_used(self, day: str, user_id: int) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT billed_tokens FROM usage_daily WHERE day = ? AND user_id = ?", (day, user_id)
+            ).fetchone()
+        return row[0] if row else 0
+
+    async def used_today(self, user_id: int) -> int:
+        """Токены пользователя за текущие сутки (с учетом еще не записанных)"""
+        self._roll_day()
+        used = self._used.get(user_id)
+        if used is None:
+            day = self._day
+            async with self._io_lock:
+                stored = await asyncio.to_thread(self._load_used, day, user_id)
+                pending = sum(record.billed_tokens for _, pending_day, record in self._pending
+                              if pending_day == day and record.user_id == user_id)
+            # Записи, пришедшие во время чтения, лежат в _pending и учтены выше
+            used = self._used.setdefault(user_id, stored + pending)
+        return used
+
+    async def check(self, user_id: int, max_tokens: int) -> Budget:
+        """Решение по бюджету перед запросом к Claude"""
+        if self.daily_tokens <= 0:
+            return Budget(True)
+        used = await self.used_today(user_id)
+        if used >= self.daily_tokens:
+            BUDGET_ACTIONS.labels(action="rejected").inc()
+            return Budget(False, used=used)
+        if used >= self.daily_tokens * self.soft_ratio and max_tokens > self.reduced_max_tokens:
+            BUDGET_ACTIONS.labels(action="reduced").inc()
+            return Budget(True, self.reduced_max_tokens, used)
+        return Budget(True, used=used)
+
+    def record(self, record: UsageRecord):
+        """Добавить расход запроса в журнал (запись в базу — отложенная)"""
+        self._roll_day()
+        self._pending.append((time.time(), self._day, record))
+        if record.user_id in self._used:
+            self._used[record.user_id] += record.billed_tokens
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_event = asyncio.Event()
+            self._flush_task = loop.create_task(self._flush_loop())
+        if len(self._pending) >= self.batch_size:
+            self._flush_event.set()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала расхода: {e}")
+            if not self._pending:
+                self._flush_task = None
+                return
+
+    def _write(self, batch: List[Tuple[float, str, UsageRecord]]):
+        # Агрегаты пачки считаются в памяти: одна строка usage_daily на пользователя и день
+        daily: Dict[Tuple[str, int], List[float]] = {}
+        for _, day, record in batch:
+            totals = daily.setdefault((day, record.user_id), [0] * 7)
+            totals[0] += 1
+            for index, field in enumerate(_TOKEN_FIELDS, start=1):
+                totals[index] += getattr(record, field)
+            totals[5] += record.billed_tokens
+            totals[6] += record.latency
+
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO usage_events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(ts, day, record.user_id, record.mode, record.model,
+                      *(getattr(record, field) for field in _TOKEN_FIELDS), record.latency)
+                     for ts, day, record in batch],
+                )
+                self._conn.executemany(
+                    "INSERT INTO usage_daily VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(day, user_id) DO UPDATE SET "
+                    "requests = requests + excluded.requests, "
+                    "input_tokens = input_tokens + excluded.input_tokens, "
+                    "output_tokens = output_tokens + excluded.output_tokens, "
+                    "cache_read_tokens = cache_read_tokens + excluded.cache_read_tokens, "
+                    "cache_creation_tokens = cache_creation_tokens + excluded.cache_creation_tokens, "
+                    "billed_tokens = billed_tokens + excluded.billed_tokens, "
+                    "latency_sum = latency_sum + excluded.latency_sum",
+                    [(day, user_id, *totals) for (day, user_id), totals in daily.items()],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def flush(self):
+        """Записать накопленные записи в базу"""
+        async with self._io_lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except BaseException:
+                self._pending = batch + self._pending
+                raise
+
+    def _daily_totals(self, days: int) -> List[Tuple]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT day, COUNT(*), SUM(requests), SUM(input_tokens), SUM(output_tokens), "
+                "SUM(cache_read_tokens), SUM(cache_creation_tokens), SUM(latency_sum) "
+                "FROM usage_daily WHERE day > date('now', ?) GROUP BY day ORDER BY day DESC",
+                (f"-{days} days",),
+            ).fetchall()
+
+    def _top_users(self, day: str, limit: int) -> List[Tuple]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT user_id, requests, billed_tokens FROM usage_daily WHERE day = ? "
+                "ORDER BY billed_tokens DESC LIMIT ?",
+                (day, limit),
+            ).fetchall()
+
+    async def stats(self, days: int = 7, top: int = 5) -> Dict:
+        """Сводка по дневным агрегатам: итоги по дням и самые активные пользователи сегодня"""
+        await self.flush()
+        self._roll_day()
+        return {
+            "days": await asyncio.to_thread(self._daily_totals, days),
+            "top": await asyncio.to_thread(self._top_users, self._day, top),
+        }
+
+    async def close(self):
+        """Записать журнал и закрыть базу"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        with self._lock:
+            self._conn.close()
+
+
+def format_stats(stats: Dict, daily_tokens: int = 0) -> str:
+    """Текст ответа на /stats"""
+    lines = ["📊 Расход токенов (UTC)", ""]
+    if not stats["days"]:
+        lines.append("Данных пока нет.")
+        return "\n".join(lines)
+    for day, users, requests, input_tokens, output_tokens, cache_read, cache_creation, latency_sum in stats["days"]:
+        lines.append(
+            f"{day}: пользователей {users}, запросов {requests}, вход {input_tokens}, выход {output_tokens}, "
+            f"кэш {cache_read}/{cache_creation}, средняя задержка {latency_sum / max(requests, 1):.1f} с"
+        )
+    if stats["top"]:
+        lines += ["", "Больше всего сегодня:"]
+        for user_id, requests, billed in stats["top"]:
+            share = f" ({billed * 100 // daily_tokens}% бюджета)" if daily_tokens else ""
+            lines.append(f"{user_id}: запросов {requests}, токенов {billed}{share}")
+    return "\n".join(lines)
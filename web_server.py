@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Асинхронный HTTP сервер: вебхук Telegram, health check и метрики на одном порту
+"""
+
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from typing import Awaitable, Callable, Dict, Optional
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from metrics import REGISTRY, CONTENT_TYPE
+from startup import take_early_server
+
+logger = logging.getLogger(__name__)
+
+HEALTH_TEXT = "HR Assistant Bot is running"
+
+
+class BotWebServer:
+    """
+    HTTP сервер на aiohttp, работающий в том же event loop, что и бот.
+
+    Маршруты:
+        GET  /, /healthz      — проверка здоровья для облачных платформ
+        GET  /metrics         — метрики в формате Prometheus
+        POST /<webhook_path>  — обновления от Telegram (только в режиме вебхука)
+    """
+
+    def __init__(self, port: int, application: Optional[Application] = None,
+                 webhook_path: str = "telegram", secret_token: Optional[str] = None,
+                 on_update: Optional[Callable[[Dict], Awaitable[None]]] = None,
+                 health_check: Optional[Callable[[], bool]] = None):
+        """
+        Args:
+            port: Порт для прослушивания
+            application: Приложение python-telegram-bot; без него и on_update вебхук не регистрируется
+            webhook_path: Путь, на который Telegram присылает обновления
+            secret_token: Секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+            on_update: Обработчик JSON обновления вместо приложения (диспетчер воркеров)
+            health_check: Проверка работоспособности для /healthz (False — ответ 503)
+        """
+        self.port = port
+        self.application = application
+        self.on_update = on_update
+        self.webhook_path = webhook_path.strip("/")
+        self.secret_token = secret_token
+        self.health_check = health_check
+        self._runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application()
+        self.app.router.add_get("/", self.handle_health)
+        self.app.router.add_get("/healthz", self.handle_health)
+        self.app.router.add_get("/metrics", self.handle_metrics)
+        if application is not None or on_update is not None:
+            self.app.router.add_post(f"/{self.webhook_path}", self.handle_webhook)
+
+    async def start(self):
+        """Начать принимать соединения (на сокете, открытом заранее при быстром старте, если он есть)"""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        early = take_early_server(self.port)
+        if early is not None:
+            site = web.SockSite(self._runner, early.detach())
+        else:
+            site = web.TCPSite(self._runner, "0.0.0.0", self.port)
+        await site.start()
+        if early is not None:
+            # Обновления, принятые ранним сервером, обрабатываются в этом event loop
+            loop = asyncio.get_running_loop()
+            early.set_ready(lambda secret, body: asyncio.run_coroutine_threadsafe(
+                self.process_update(secret, body), loop).result())
+        logger.info(f"HTTP сервер запущен на порту {self.port}")
+
+    async def stop(self):
+        """Остановить сервер"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        if self.health_check is not None and not self.health_check():
+            return web.Response(status=503, text="HR Assistant Bot is unhealthy")
+        return web.Response(text=HEALTH_TEXT)
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=REGISTRY.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        """Принять обновление от Telegram и передать его в очередь приложения"""
+        status = await self.process_update(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), await request.read()
+        )
+        return web.Response(status=status)
+
+    async def process_update(self, secret: str, body: bytes) -> int:
+        """Проверить секрет и передать обновление дальше; возвращает HTTP статус ответа Telegram"""
+        if self.application is None and self.on_update is None:
+            return 404
+        if self.secret_token and not hmac.compare_digest(secret, self.secret_token):
+            return 403
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+
+        if self.on_update is not None:
+            try:
+                await self.on_update(data)
+            except Exception as e:
+                # 500 — Telegram доставит обновление повторно
+                logger.error(f"Не удалось принять обновление: {type(e).__name__}: {e}")
+                return 500
+            return 200
+
+        update = Update.de_json(data, self.application.bot)
+        # Отвечаем сразу: обработка идет в фоне, Telegram не ждет ответа Claude
+        await self.application.update_queue.put(update)
+        return 200
+
+
+async def wait_for_stop_signal():
+    """Дождаться SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: остается KeyboardInterrupt
+            pass
+    await stop.wait()